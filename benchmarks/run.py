@@ -0,0 +1,228 @@
+"""
+Micro-benchmarks of the document processing hot paths.
+
+Run from the repository root:
+
+    python -m benchmarks.run                    # compare against benchmarks/baseline.json
+    python -m benchmarks.run --update-baseline  # record new baselines
+    python -m benchmarks.run --filter table     # only benchmarks whose name contains "table"
+
+Each benchmark is timed over --repeat runs after a warm-up, and its peak memory is measured with
+tracemalloc in one more call, apart from the timed ones. A timed run makes as many calls as it
+takes to last MIN_RUN_SECONDS, each on a fresh setup, and the time per call is reported, so that
+benchmarks of a millisecond or two are not dominated by timer and scheduling noise. The run fails,
+with exit status 1, when the fastest time or the peak grows past the baseline by more than the
+tolerance. The fastest run is compared rather than the median, as it is the least disturbed by
+other load on the machine.
+Baselines are only comparable on the machine they were recorded on.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import statistics
+import tracemalloc
+from unittest import mock
+import openai
+from benchmarks import synthetic
+from azblobhanlder import BlobBuffer
+from documentprocessing import ProcessDocument
+from documentsplitter import DocumentSplitter
+from utils import fix_json
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Regressions smaller than these are noise rather than a slowdown or growth
+MIN_TIME_DELTA = 0.01
+MIN_MEMORY_DELTA = 64 * 1024
+# Shortest timed run, shorter benchmarks are called several times per run
+MIN_RUN_SECONDS = 0.05
+MAX_CALLS_PER_RUN = 1000
+
+METADATA = {"contractName": "Supply agreement", "contractID": "SA-2024-001", "contractDate": "01012024",
+            "buyerName": "Contoso Ltd", "sellerName": "Fabrikam Inc"}
+
+
+class Benchmark():
+    """
+    A named operation, with a setup whose result is passed to it and whose cost is not measured.
+    """
+
+    def __init__(self, name: str, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda: None)
+
+
+def _processor(result):
+    return ProcessDocument(form_recognizer_results=result)
+
+
+def _indexed_processor(result):
+    processor = ProcessDocument(form_recognizer_results=result)
+    processor._build_table_index()
+    return processor
+
+
+def _split_pdf(state):
+    splitter, document = state
+    with mock.patch.object(openai, "ChatCompletion", synthetic.StubChatCompletion(METADATA)):
+        return splitter.split(document, mode="sequential")
+
+
+def _pdf_buffer(data: bytes):
+    document = BlobBuffer(len(data), source="benchmark.pdf", etag="0")
+    document.writer().write(data)
+    return document
+
+
+def build_benchmarks():
+    """
+    Returns the benchmarks, on synthetic documents built once here.
+    """
+    small = synthetic.make_analyze_result(pages=5)
+    large = synthetic.make_analyze_result(pages=100)
+    wide_table = synthetic.make_analyze_result(pages=1, lines_per_page=5, tables_per_page=1, rows=200, columns=12)
+    truncated = synthetic.make_truncated_json()
+    pdf = synthetic.make_pdf(pages=30)
+    splitter = DocumentSplitter(api_key="benchmark", api_base="https://benchmark.invalid", deployment_id="benchmark")
+
+    return [
+        Benchmark("get_document_text_5_pages", lambda processor: processor._get_document_text(),
+                  lambda: _processor(small)),
+        Benchmark("get_document_text_100_pages", lambda processor: processor._get_document_text(),
+                  lambda: _processor(large)),
+        Benchmark("split_text_100_pages", lambda processor: processor.split_text(),
+                  lambda: _processor(large)),
+        Benchmark("table_to_html_200x12", lambda processor: processor._table_to_html(wide_table.tables[0]),
+                  lambda: _indexed_processor(wide_table)),
+        Benchmark("table_to_html_100_tables", lambda processor: [processor._table_to_html(table) for table in large.tables],
+                  lambda: _indexed_processor(large)),
+        Benchmark("fix_json_x100", lambda text: [fix_json(text) for _ in range(100)],
+                  lambda: truncated),
+        Benchmark("document_splitter_split_30_pages", _split_pdf,
+                  lambda: (splitter, _pdf_buffer(pdf))),
+    ]
+
+
+def _time_calls(benchmark: Benchmark, calls: int):
+    """
+    Returns the seconds that calls runs of benchmark take, on states set up beforehand.
+    """
+    states = [benchmark.setup() for _ in range(calls)]
+    # Like timeit, keep collections triggered by earlier garbage out of the timing
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for state in states:
+            benchmark.run(state)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def _calls_per_run(benchmark: Benchmark):
+    """
+    Returns how many calls make a timed run last MIN_RUN_SECONDS, warming the benchmark up on the way.
+    """
+    calls = 1
+    while calls < MAX_CALLS_PER_RUN:
+        elapsed = _time_calls(benchmark, calls)
+        if elapsed >= MIN_RUN_SECONDS:
+            break
+        calls = min(calls * 2 if elapsed <= 0 else int(calls * MIN_RUN_SECONDS / elapsed) + 1, MAX_CALLS_PER_RUN)
+    return calls
+
+
+def measure(benchmark: Benchmark, repeat: int):
+    """
+    Returns the median and minimum time per call in seconds, the calls per timed run and the peak
+    traced memory in bytes.
+    """
+    calls = _calls_per_run(benchmark)
+    times = [_time_calls(benchmark, calls) / calls for _ in range(repeat)]
+
+    state = benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"median_seconds": statistics.median(times), "min_seconds": min(times), "calls_per_run": calls,
+            "peak_bytes": peak}
+
+
+def compare(name: str, result: dict, baseline: dict, time_tolerance: float, memory_tolerance: float):
+    """
+    Returns the regressions of result against baseline, as messages.
+    """
+    regressions = []
+    time_limit = max(baseline["min_seconds"] * (1 + time_tolerance), baseline["min_seconds"] + MIN_TIME_DELTA)
+    if result["min_seconds"] > time_limit:
+        regressions.append(f"{name}: {result['min_seconds'] * 1000:.2f} ms, "
+                           f"baseline {baseline['min_seconds'] * 1000:.2f} ms")
+    memory_limit = max(baseline["peak_bytes"] * (1 + memory_tolerance), baseline["peak_bytes"] + MIN_MEMORY_DELTA)
+    if result["peak_bytes"] > memory_limit:
+        regressions.append(f"{name}: peak {result['peak_bytes'] / 1024:.0f} KiB, "
+                           f"baseline {baseline['peak_bytes'] / 1024:.0f} KiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the document processing hot paths")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare against or update")
+    parser.add_argument("--update-baseline", action="store_true", help="Record the results as the new baseline")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed runs of each benchmark")
+    parser.add_argument("--filter", default="", help="Only run the benchmarks whose name contains this")
+    parser.add_argument("--time-tolerance", type=float, default=0.5, help="Allowed growth of the fastest time")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="Allowed growth of the peak memory")
+    args = parser.parse_args(argv)
+
+    # Measure the code, not the debug log written for every call
+    logging.disable(logging.CRITICAL)
+
+    baseline = {"benchmarks": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    environment = {"python": platform.python_version(), "machine": platform.machine(), "system": platform.system()}
+    if not args.update_baseline and baseline.get("environment") not in (None, environment):
+        print(f"Warning: the baseline was recorded on {baseline['environment']}, this is {environment}")
+
+    results = {}
+    regressions = []
+    for benchmark in build_benchmarks():
+        if args.filter not in benchmark.name:
+            continue
+        result = measure(benchmark, args.repeat)
+        results[benchmark.name] = result
+        reference = baseline["benchmarks"].get(benchmark.name)
+        status = "new"
+        if reference is not None:
+            found = compare(benchmark.name, result, reference, args.time_tolerance, args.memory_tolerance)
+            regressions.extend(found)
+            status = "REGRESSION" if found else "ok"
+        print(f"{benchmark.name:<36} {result['median_seconds'] * 1000:>10.2f} ms {result['min_seconds'] * 1000:>10.2f} ms min "
+              f"{result['peak_bytes'] / 1024:>10.0f} KiB  {status}")
+
+    if args.update_baseline:
+        baseline["environment"] = environment
+        baseline["benchmarks"].update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
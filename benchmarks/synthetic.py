@@ -0,0 +1,136 @@
+import io
+import json
+import random
+from openai.openai_object import OpenAIObject
+from analyzecache import analyze_result_from_dict
+
+
+WORDS = ("contract agreement party buyer seller delivery payment invoice clause term date amount price goods "
+         "services shall obligation liability warranty notice period schedule annex section article total "
+         "quantity currency signature effective termination").split()
+
+
+def _sentence(rng: random.Random, words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def make_analyze_result_dict(pages: int = 20, lines_per_page: int = 40, words_per_line: int = 10, tables_per_page: int = 1,
+                             rows: int = 10, columns: int = 5, seed: int = 0):
+    """
+    Builds a synthetic prebuilt-document analysis result, in the form of AnalyzeResult.to_dict.
+
+    Every page has lines of words followed by its tables, whose cells are laid out in the content
+    row by row with a header row. All spans are offsets into the content of the whole document.
+
+    Returns:
+        dict: The result.
+    """
+    rng = random.Random(seed)
+    content = []
+    page_dicts = []
+    table_dicts = []
+    offset = 0
+    for page_number in range(1, pages + 1):
+        page_start = offset
+        lines = []
+        words = []
+        page_parts = []
+        for _ in range(lines_per_page):
+            line_text = _sentence(rng, words_per_line)
+            line_start = offset
+            for word in line_text.split(" "):
+                words.append({"content": word, "polygon": [], "span": {"offset": offset, "length": len(word)},
+                              "confidence": 0.99})
+                offset += len(word) + 1
+            lines.append({"content": line_text, "polygon": [], "spans": [{"offset": line_start, "length": len(line_text)}]})
+            page_parts.append(line_text + "\n")
+        for _ in range(tables_per_page):
+            table_start = offset
+            cells = []
+            for row in range(rows):
+                for column in range(columns):
+                    cell_text = rng.choice(WORDS) if row else f"Column {column}"
+                    cells.append({"kind": "columnHeader" if row == 0 else "content", "row_index": row,
+                                  "column_index": column, "row_span": 1, "column_span": 1, "content": cell_text,
+                                  "bounding_regions": [{"page_number": page_number, "polygon": []}],
+                                  "spans": [{"offset": offset, "length": len(cell_text)}]})
+                    page_parts.append(cell_text + "\n")
+                    offset += len(cell_text) + 1
+            table_dicts.append({"row_count": rows, "column_count": columns, "cells": cells,
+                                "bounding_regions": [{"page_number": page_number, "polygon": []}],
+                                "spans": [{"offset": table_start, "length": offset - table_start}]})
+        page_text = "".join(page_parts)
+        content.append(page_text)
+        page_dicts.append({"page_number": page_number, "angle": 0, "width": 8.5, "height": 11, "unit": "inch",
+                           "spans": [{"offset": page_start, "length": len(page_text)}], "lines": lines, "words": words,
+                           "selection_marks": []})
+    return {"api_version": "2023-07-31", "model_id": "prebuilt-document", "content": "".join(content),
+            "pages": page_dicts, "tables": table_dicts, "paragraphs": [], "key_value_pairs": [], "styles": [],
+            "languages": [], "documents": []}
+
+
+def make_analyze_result(**kwargs):
+    """
+    Same as make_analyze_result_dict, as an AnalyzeResult with its lines linked to their pages.
+    """
+    return analyze_result_from_dict(make_analyze_result_dict(**kwargs))
+
+
+def make_pdf(pages: int = 20, lines_per_page: int = 40, words_per_line: int = 10, seed: int = 0):
+    """
+    Builds a text PDF with the given number of pages of random sentences.
+
+    Returns:
+        bytes: The PDF file.
+    """
+    rng = random.Random(seed)
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>",
+               3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    for index in range(pages):
+        page_id, content_id = 4 + 2 * index, 5 + 2 * index
+        lines = [_sentence(rng, words_per_line) for _ in range(lines_per_page)]
+        stream = "BT /F1 9 Tf 12 TL 36 760 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects[content_id] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream.encode("latin-1"))
+        objects[page_id] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(b"%d 0 R" % page_id)
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), pages)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = out.tell()
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (object_id, objects[object_id]))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for object_id in sorted(objects):
+        out.write(b"%010d 00000 n \n" % offsets[object_id])
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_truncated_json(fields: int = 40, seed: int = 0):
+    """
+    Builds a metadata answer cut off mid-value, the kind of reply utils.fix_json repairs.
+    """
+    rng = random.Random(seed)
+    data = {f"field{i}": {"value": _sentence(rng, 6), "items": [rng.choice(WORDS) for _ in range(4)]} for i in range(fields)}
+    text = json.dumps(data, indent=4)
+    return text[:int(len(text) * 0.9)]
+
+
+class StubChatCompletion():
+    """
+    Stands in for openai.ChatCompletion, answering every request with the same filled-in metadata.
+    """
+
+    def __init__(self, metadata: dict):
+        self.content = json.dumps(metadata)
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        return OpenAIObject.construct_from({"choices": [{"index": 0, "finish_reason": "stop",
+                                                         "message": {"role": "assistant", "content": self.content}}]})
@@ -1,9 +1,14 @@
 import os
+import json
 import logging
 import azure.functions as func
 from dotenv import load_dotenv
 from scripts.common import logger_config
 from scripts.eventcreateandmodify import BlobCreateModifyEventHandler
+from scripts.aiohandlers import AsyncBlobCreateModifyEventHandler
+from scripts.eventbatchhandler import BlobEventBatchHandler, get_validation_response
+# Imported by its top-level name, as the handlers do, so both record into the same histograms
+from instrumentation import metrics, stage
 
 app = func.FunctionApp()
 logger_config()
@@ -12,6 +17,7 @@ load_dotenv()
 openai_api_key = os.getenv("AZURE_OPENAI_KEY")
 openai_api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
 openai_deployment_id = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+instrumentation_output = os.getenv("INSTRUMENTATION_OUTPUT")
 
 
 @app.event_grid_trigger(arg_name="azeventgrid")
@@ -19,8 +25,67 @@ def BlobStorageTrigger(azeventgrid: func.EventGridEvent):
     event_json = azeventgrid.get_json()
     logger.debug(event_json)
     if event_json["api"].lower() == "putblob":
-        event_handler = BlobCreateModifyEventHandler(blob_url=event_json["url"],
-                                                     openai_api_key=openai_api_key,
-                                                     openai_api_base=openai_api_base,
-                                                     openai_deployment_id=openai_deployment_id)
-        event_handler.split_and_blob_upload()
+        with stage("invocation"):
+            event_handler = BlobCreateModifyEventHandler(blob_url=event_json["url"],
+                                                         openai_api_key=openai_api_key,
+                                                         openai_api_base=openai_api_base,
+                                                         openai_deployment_id=openai_deployment_id)
+            if event_handler.is_unchanged():
+                logger.info(f"Skipping {event_json['url']}, already processed with the same content")
+            else:
+                # process raises when a chunk or a section failed, the blob is then retried rather than recorded
+                event_handler.process()
+                event_handler.record_processed()
+        if metrics.enabled:
+            metrics.dump(instrumentation_output)
+
+
+@app.event_grid_trigger(arg_name="azeventgrid")
+async def BlobStorageTriggerAsync(azeventgrid: func.EventGridEvent):
+    """
+    Same as BlobStorageTrigger on the aio clients. Invocations run concurrently on the worker's event loop.
+    """
+    event_json = azeventgrid.get_json()
+    logger.debug(event_json)
+    if event_json["api"].lower() == "putblob":
+        with stage("invocation"):
+            event_handler = AsyncBlobCreateModifyEventHandler(blob_url=event_json["url"],
+                                                              openai_api_key=openai_api_key,
+                                                              openai_api_base=openai_api_base,
+                                                              openai_deployment_id=openai_deployment_id)
+            if await event_handler.is_unchanged():
+                logger.info(f"Skipping {event_json['url']}, already processed with the same content")
+            else:
+                await event_handler.process()
+                await event_handler.record_processed()
+        if metrics.enabled:
+            metrics.dump(instrumentation_output)
+
+
+@app.route(route="blobevents", methods=["POST", "OPTIONS"], auth_level=func.AuthLevel.FUNCTION)
+def BlobStorageBatchTrigger(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Webhook endpoint for an Event Grid subscription with batching enabled, it receives a list of blob events per call.
+    """
+    if req.method == "OPTIONS":
+        # Abuse protection handshake of CloudEvents webhooks
+        return func.HttpResponse(status_code=200,
+                                 headers={"WebHook-Allowed-Origin": req.headers.get("WebHook-Request-Origin", "*")})
+    events = req.get_json()
+    if isinstance(events, dict):
+        events = [events]
+    validation_response = get_validation_response(events)
+    if validation_response is not None:
+        return func.HttpResponse(json.dumps(validation_response), mimetype="application/json")
+    logger.debug(f"Received {len(events)} events")
+    with stage("invocation"):
+        batch_handler = BlobEventBatchHandler(events=events,
+                                              openai_api_key=openai_api_key,
+                                              openai_api_base=openai_api_base,
+                                              openai_deployment_id=openai_deployment_id)
+        summary = batch_handler.process()
+    if metrics.enabled:
+        metrics.dump(instrumentation_output)
+    # Event Grid redelivers the whole batch on failure, the processing manifest skips what already succeeded
+    return func.HttpResponse(json.dumps(summary), status_code=500 if summary["failed"] else 200,
+                             mimetype="application/json")
@@ -0,0 +1,10 @@
+import os
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+scripts_dir = os.path.join(os.path.dirname(current_dir), 'scripts/')
+sys.path.append(current_dir)
+sys.path.append(scripts_dir)
+
+# The modules log to ./logs, which has to exist before they are imported
+os.makedirs("logs", exist_ok=True)
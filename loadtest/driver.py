@@ -0,0 +1,210 @@
+"""
+Offline end-to-end load test of BlobStorageTrigger against in-process stand-ins of Blob Storage,
+Form Recognizer, Cognitive Search and Azure OpenAI.
+
+Run from the repository root:
+
+    python -m loadtest.driver --events 100 --rate 5 --concurrency 8
+    python -m loadtest.driver --mode unified --config loadtest.json --output report.json
+
+The stand-ins replace the network through a requests adapter mounted on the session that
+clientregistry and the OpenAI library use, so the SDK clients, their retry policies and the
+long-running operation polling all run for real. --config is a JSON file of ServiceBehavior
+settings by service, for example:
+
+    {"openai": {"latency": 1.2, "rate_limit": 5, "retry_after": 2}, "storage": {"error_rate": 0.01}}
+
+Synthetic PutBlob events are replayed at --rate per second whatever the progress of earlier
+ones, and up to --concurrency invocations run at a time, like the threads of the Functions
+worker. The report gives the throughput, the latency percentiles from the scheduled time of
+each event, so queueing is included, the time spent in every pipeline stage and the traffic
+each stand-in served.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import openai
+import azure.functions as func
+from benchmarks import synthetic
+from loadtest.fakeservices import FakeServices
+import clientregistry
+from instrumentation import metrics
+
+
+SOURCE_CONTAINER = "documents"
+
+
+def install(services: FakeServices, mode: str):
+    """
+    Points the function app at the stand-ins, before function_app is imported as it reads its settings then.
+    """
+    os.environ.update(services.environment())
+    os.environ["INGESTION_MODE"] = mode
+    os.environ["INSTRUMENTATION_ENABLED"] = "true"
+    # Nothing may be answered from a previous run
+    for name in ("INSTRUMENTATION_OUTPUT", "LLM_CACHE_PATH", "ANALYZE_CACHE_PATH", "ANALYZE_CACHE_CONTAINER",
+                 "PROCESSING_MANIFEST_PATH", "PROCESSING_MANIFEST_CONTAINER"):
+        os.environ.pop(name, None)
+    session = requests.Session()
+    session.mount("https://", services.adapter)
+    session.mount("http://", services.adapter)
+    clientregistry.use_session(session)
+    openai.requestssession = session
+    metrics.configure(enabled=True)
+    metrics.reset()
+
+
+def seed_documents(services: FakeServices, events: int, documents: int, pages: int):
+    """
+    Uploads one blob per event, cycling through documents distinct synthetic PDFs, and returns their URLs.
+    """
+    pdfs = [synthetic.make_pdf(pages=pages, seed=seed) for seed in range(documents)]
+    services.storage.containers.setdefault(SOURCE_CONTAINER, {})
+    urls = []
+    for i in range(events):
+        name = f"document-{i:05d}.pdf"
+        services.storage.put_blob(SOURCE_CONTAINER, name, pdfs[i % documents])
+        urls.append(f"{services.account_url}/{SOURCE_CONTAINER}/{name}")
+    return urls
+
+
+def make_event(url: str, sequence: int):
+    return func.EventGridEvent(id=f"loadtest-{sequence}", topic="/subscriptions/loadtest/resourceGroups/loadtest",
+                               subject=f"/blobServices/default/containers/{SOURCE_CONTAINER}/blobs/{url.rsplit('/', 1)[1]}",
+                               event_type="Microsoft.Storage.BlobCreated", event_time=None, data_version="1",
+                               data={"api": "PutBlob", "url": url, "contentType": "application/pdf", "blobType": "BlockBlob"})
+
+
+def replay(trigger, events: list, rate: float, concurrency: int):
+    """
+    Invokes trigger with every event, starting one every 1 / rate seconds.
+
+    Returns:
+        tuple: The outcome of every invocation and the wall-clock duration of the run.
+    """
+    outcomes = []
+    lock = threading.Lock()
+
+    def _invoke(event, scheduled_at):
+        started_at = time.perf_counter()
+        error = None
+        try:
+            trigger(event)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:300]
+        finished_at = time.perf_counter()
+        with lock:
+            outcomes.append({"latency": finished_at - scheduled_at, "service_time": finished_at - started_at,
+                             "queued": started_at - scheduled_at, "error": error})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, event in enumerate(events):
+            scheduled_at = start + i / rate
+            wait = scheduled_at - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(_invoke, event, scheduled_at)
+    return outcomes, time.perf_counter() - start
+
+
+def _percentiles(values: list):
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    if len(values) == 1:
+        return {"p50": values[0], "p90": values[0], "p99": values[0], "max": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p90": cuts[89], "p99": cuts[98], "max": max(values)}
+
+
+def build_report(outcomes: list, duration: float, services: FakeServices, target_rate: float):
+    succeeded = [outcome for outcome in outcomes if outcome["error"] is None]
+    errors = {}
+    for outcome in outcomes:
+        if outcome["error"] is not None:
+            errors[outcome["error"]] = errors.get(outcome["error"], 0) + 1
+    stages = {}
+    for name, histogram in metrics.snapshot()["histograms"].items():
+        if name.startswith("stage."):
+            stages[name[len("stage."):]] = {"count": histogram["count"], "total_seconds": histogram["sum"],
+                                            "mean_seconds": histogram["mean"], "p99_seconds": histogram["p99"]}
+    return {
+        "events": len(outcomes),
+        "succeeded": len(succeeded),
+        "failed": len(outcomes) - len(succeeded),
+        "errors": errors,
+        "duration_seconds": duration,
+        "target_rate": target_rate,
+        "throughput": len(succeeded) / duration if duration else 0.0,
+        "latency_seconds": _percentiles([outcome["latency"] for outcome in outcomes]),
+        "service_time_seconds": _percentiles([outcome["service_time"] for outcome in outcomes]),
+        "queued_seconds": _percentiles([outcome["queued"] for outcome in outcomes]),
+        "stages": stages,
+        "services": services.stats()
+    }
+
+
+def print_report(report: dict):
+    print(f"Events {report['events']}: {report['succeeded']} succeeded, {report['failed']} failed "
+          f"in {report['duration_seconds']:.1f} s")
+    print(f"Throughput {report['throughput']:.2f}/s for a target of {report['target_rate']:.2f}/s")
+    for name in ("latency_seconds", "service_time_seconds", "queued_seconds"):
+        values = report[name]
+        print(f"{name[:-len('_seconds')]:<14} p50 {values['p50']:8.3f} s  p90 {values['p90']:8.3f} s  "
+              f"p99 {values['p99']:8.3f} s  max {values['max']:8.3f} s")
+    print("Stages:")
+    for name, stage in sorted(report["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+        print(f"  {name:<14} {stage['count']:>7} calls  total {stage['total_seconds']:9.2f} s  "
+              f"mean {stage['mean_seconds']:8.3f} s  p99 {stage['p99_seconds']:8.3f} s")
+    print("Services:")
+    for name, stats in report["services"].items():
+        print(f"  {name:<14} {stats['requests']:>7} requests  {stats['throttled']:>6} throttled  {stats['errors']:>6} errors")
+    for error, count in report["errors"].items():
+        print(f"Error x{count}: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of BlobStorageTrigger")
+    parser.add_argument("--events", type=int, default=50, help="PutBlob events to replay")
+    parser.add_argument("--rate", type=float, default=5.0, help="Events started per second")
+    parser.add_argument("--concurrency", type=int, default=8, help="Invocations running at a time")
+    parser.add_argument("--documents", type=int, default=5, help="Distinct synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=10, help="Pages of every PDF")
+    parser.add_argument("--mode", default="chunks", choices=["chunks", "unified"], help="INGESTION_MODE of the function app")
+    parser.add_argument("--config", help="JSON file of ServiceBehavior settings by service")
+    parser.add_argument("--analyze-seconds", type=float, default=1.0, help="Base duration of a Form Recognizer analysis")
+    parser.add_argument("--analyze-seconds-per-page", type=float, default=0.1, help="Added duration per analyzed page")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected latency, failures and throttling")
+    parser.add_argument("--output", help="Also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    services = FakeServices(config, seed=args.seed, analyze_seconds=args.analyze_seconds,
+                            analyze_seconds_per_page=args.analyze_seconds_per_page)
+    install(services, args.mode)
+    urls = seed_documents(services, args.events, args.documents, args.pages)
+
+    import function_app
+    trigger = function_app.BlobStorageTrigger._function.get_user_function()
+    events = [make_event(url, i) for i, url in enumerate(urls)]
+    outcomes, duration = replay(trigger, events, args.rate, args.concurrency)
+
+    report = build_report(outcomes, duration, services, args.rate)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
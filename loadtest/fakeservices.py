@@ -0,0 +1,514 @@
+import io
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import threading
+import http.client
+from email.utils import formatdate
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs, unquote
+import pypdf
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+from benchmarks.synthetic import make_analyze_result_dict
+
+
+class ServiceBehavior():
+    """
+    How a stand-in service responds: its latency, its failures and its throttling.
+
+    Every request takes latency seconds, varied by up to jitter times that either way, plus
+    latency_per_kb for each kilobyte of request body. A throttle_rate fraction of requests, and
+    every request beyond rate_limit per second, is throttled with throttle_status and a
+    Retry-After of retry_after seconds. An error_rate fraction of the others fails with a 500.
+    """
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.5, latency_per_kb: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, rate_limit: float = None, throttle_status: int = 429, retry_after: float = 1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_per_kb = latency_per_kb
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.throttle_status = throttle_status
+        self.retry_after = retry_after
+
+
+class FakeService():
+    """
+    Base of the stand-ins. handle() applies the behavior, then serve() answers the request.
+
+    Requests are given as (method, url, headers, body) and answered with (status, headers, body).
+    DEFAULT_BEHAVIOR holds the ServiceBehavior settings of the service when none is given.
+    """
+    name = "service"
+    DEFAULT_BEHAVIOR = {}
+
+    def __init__(self, behavior: ServiceBehavior = None, seed: int = 0):
+        self.behavior = behavior or ServiceBehavior(**self.DEFAULT_BEHAVIOR)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self._tokens = None
+        self._refilled_at = time.monotonic()
+
+    def _over_rate_limit(self):
+        if not self.behavior.rate_limit:
+            return False
+        now = time.monotonic()
+        if self._tokens is None:
+            self._tokens = self.behavior.rate_limit
+        self._tokens = min(self.behavior.rate_limit, self._tokens + (now - self._refilled_at) * self.behavior.rate_limit)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def handle(self, method: str, url, headers: dict, body: bytes):
+        behavior = self.behavior
+        with self.lock:
+            self.requests += 1
+            throttled = self._over_rate_limit() or self.random.random() < behavior.throttle_rate
+            failed = not throttled and self.random.random() < behavior.error_rate
+            delay = behavior.latency * (1 + behavior.jitter * (2 * self.random.random() - 1))
+            if throttled:
+                self.throttled += 1
+            elif failed:
+                self.errors += 1
+        time.sleep(max(delay, 0) + behavior.latency_per_kb * len(body or b"") / 1024)
+        if throttled:
+            return self.error(behavior.throttle_status, "TooManyRequests", "The request was throttled",
+                              {"Retry-After": str(behavior.retry_after)})
+        if failed:
+            return self.error(500, "InternalServerError", "Injected failure")
+        return self.serve(method, url, headers, body)
+
+    def error(self, status: int, code: str, message: str, headers: dict = None):
+        body = json.dumps({"error": {"code": code, "message": message}}).encode("utf-8")
+        return status, dict(headers or {}, **{"Content-Type": "application/json"}), body
+
+    def json_response(self, status: int, data, headers: dict = None):
+        return status, dict(headers or {}, **{"Content-Type": "application/json"}), json.dumps(data).encode("utf-8")
+
+    def serve(self, method: str, url, headers: dict, body: bytes):
+        raise NotImplementedError
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "throttled": self.throttled, "errors": self.errors}
+
+
+class FakeBlobStorage(FakeService):
+    """
+    Blob Storage stand-in with containers and block blobs kept in memory.
+
+    Serves what the pipeline uses: container properties and creation, blob properties, ranged
+    downloads, single-shot uploads with If-None-Match, metadata updates and deletes. It
+    throttles with 503 Server Busy, as Storage does.
+    """
+    name = "storage"
+    DEFAULT_BEHAVIOR = {"latency": 0.01, "throttle_status": 503}
+
+    def __init__(self, behavior: ServiceBehavior = None, seed: int = 0):
+        super().__init__(behavior, seed)
+        self.containers = {}
+
+    def put_blob(self, container: str, name: str, data: bytes, metadata: dict = None):
+        blob = {"data": bytes(data), "metadata": dict(metadata or {}), "etag": f'"0x{uuid.uuid4().hex[:16].upper()}"',
+                "last_modified": formatdate(usegmt=True), "content_md5": base64.b64encode(hashlib.md5(data).digest()).decode("ascii")}
+        with self.lock:
+            self.containers.setdefault(container, {})[name] = blob
+        return blob
+
+    def error(self, status: int, code: str, message: str, headers: dict = None):
+        body = (f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code>'
+                f'<Message>{message}</Message></Error>').encode("utf-8")
+        return status, dict(headers or {}, **{"Content-Type": "application/xml", "x-ms-error-code": code}), body
+
+    def _blob_headers(self, blob):
+        return {"ETag": blob["etag"], "Last-Modified": blob["last_modified"], "Content-Type": "application/octet-stream",
+                "Content-MD5": blob["content_md5"], "x-ms-blob-type": "BlockBlob", "x-ms-creation-time": blob["last_modified"],
+                "x-ms-lease-state": "available", "x-ms-lease-status": "unlocked", "Accept-Ranges": "bytes",
+                "x-ms-server-encrypted": "true",
+                **{f"x-ms-meta-{key}": value for key, value in blob["metadata"].items()}}
+
+    def serve(self, method: str, url, headers: dict, body: bytes):
+        query = parse_qs(url.query)
+        parts = unquote(url.path).lstrip("/").split("/", 1)
+        container = parts[0]
+        blob_name = parts[1] if len(parts) > 1 else None
+        if blob_name is None:
+            return self._serve_container(method, container, query)
+        with self.lock:
+            blobs = self.containers.get(container)
+            blob = blobs.get(blob_name) if blobs is not None else None
+        if blobs is None:
+            return self.error(404, "ContainerNotFound", "The specified container does not exist.")
+
+        if method == "PUT" and query.get("comp") == ["metadata"]:
+            if blob is None:
+                return self.error(404, "BlobNotFound", "The specified blob does not exist.")
+            blob["metadata"] = {key[len("x-ms-meta-"):]: value for key, value in headers.items()
+                                if key.lower().startswith("x-ms-meta-")}
+            return 200, {"ETag": blob["etag"], "Last-Modified": blob["last_modified"]}, b""
+        if method == "PUT":
+            if blob is not None and headers.get("If-None-Match") == "*":
+                return self.error(409, "BlobAlreadyExists", "The specified blob already exists.")
+            metadata = {key[len("x-ms-meta-"):]: value for key, value in headers.items() if key.lower().startswith("x-ms-meta-")}
+            blob = self.put_blob(container, blob_name, body or b"", metadata)
+            return 201, {"ETag": blob["etag"], "Last-Modified": blob["last_modified"], "Content-MD5": blob["content_md5"],
+                         "x-ms-request-server-encrypted": "true"}, b""
+        if blob is None:
+            return self.error(404, "BlobNotFound", "The specified blob does not exist.")
+        if method == "HEAD":
+            return 200, dict(self._blob_headers(blob), **{"Content-Length": str(len(blob["data"]))}), b""
+        if method == "DELETE":
+            with self.lock:
+                blobs.pop(blob_name, None)
+            return 202, {}, b""
+        if method == "GET":
+            data = blob["data"]
+            match = re.match(r"bytes=(\d+)-(\d*)", headers.get("x-ms-range") or headers.get("Range") or "")
+            if not match:
+                return 200, self._blob_headers(blob), data
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            if start >= len(data):
+                return self.error(416, "InvalidRange", "The range specified is invalid for the current size of the resource.")
+            response_headers = self._blob_headers(blob)
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return 206, response_headers, data[start:end + 1]
+        return self.error(405, "UnsupportedHttpVerb", f"{method} is not supported.")
+
+    def _serve_container(self, method: str, container: str, query: dict):
+        if query.get("restype") != ["container"]:
+            return self.error(400, "InvalidQueryParameterValue", "Only container operations are supported.")
+        with self.lock:
+            exists = container in self.containers
+            if method == "PUT" and not exists:
+                self.containers[container] = {}
+        if method == "PUT":
+            if exists:
+                return self.error(409, "ContainerAlreadyExists", "The specified container already exists.")
+            return 201, {"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True)}, b""
+        if not exists:
+            return self.error(404, "ContainerNotFound", "The specified container does not exist.")
+        return 200, {"ETag": '"0x1"', "Last-Modified": formatdate(usegmt=True), "x-ms-lease-state": "available",
+                     "x-ms-lease-status": "unlocked", "x-ms-has-immutability-policy": "false", "x-ms-has-legal-hold": "false"}, b""
+
+
+def _iso_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _camel_case(value):
+    if isinstance(value, list):
+        return [_camel_case(item) for item in value]
+    if isinstance(value, dict):
+        return {re.sub(r"_([a-z])", lambda match: match.group(1).upper(), key): _camel_case(item) for key, item in value.items()}
+    return value
+
+
+class FakeFormRecognizer(FakeService):
+    """
+    Form Recognizer stand-in for prebuilt-document analysis as a long-running operation.
+
+    An analysis takes analyze_seconds plus analyze_seconds_per_page for every page of the
+    posted PDF, or of the requested page range. Until then polls answer "running", after that
+    "succeeded" with a synthetic result of as many pages.
+    """
+    name = "formrecognizer"
+    DEFAULT_BEHAVIOR = {"latency": 0.05}
+
+    def __init__(self, behavior: ServiceBehavior = None, seed: int = 0, analyze_seconds: float = 1.0,
+                 analyze_seconds_per_page: float = 0.1):
+        super().__init__(behavior, seed)
+        self.analyze_seconds = analyze_seconds
+        self.analyze_seconds_per_page = analyze_seconds_per_page
+        self.operations = {}
+
+    def _page_count(self, body: bytes, pages: str = None):
+        if pages:
+            match = re.match(r"\s*(\d+)\s*-\s*(\d+)", pages)
+            if match:
+                return int(match.group(2)) - int(match.group(1)) + 1
+        try:
+            return len(pypdf.PdfReader(io.BytesIO(body)).pages)
+        except Exception:
+            return 1
+
+    def serve(self, method: str, url, headers: dict, body: bytes):
+        query = parse_qs(url.query)
+        match = re.match(r"/formrecognizer/documentModels/([^/:]+):analyze$", url.path)
+        if method == "POST" and match:
+            operation_id = uuid.uuid4().hex
+            page_count = self._page_count(body, (query.get("pages") or [None])[0])
+            with self.lock:
+                self.operations[operation_id] = {
+                    "model_id": match.group(1),
+                    "pages": page_count,
+                    "ready_at": time.monotonic() + self.analyze_seconds + self.analyze_seconds_per_page * page_count,
+                    "created": _iso_now()
+                }
+            location = (f"{url.scheme}://{url.netloc}/formrecognizer/documentModels/{match.group(1)}"
+                        f"/analyzeResults/{operation_id}?api-version={(query.get('api-version') or ['2023-07-31'])[0]}")
+            return 202, {"Operation-Location": location, "apim-request-id": operation_id}, b""
+
+        match = re.match(r"/formrecognizer/documentModels/[^/]+/analyzeResults/([0-9a-f]+)$", url.path)
+        if method == "GET" and match:
+            with self.lock:
+                operation = self.operations.get(match.group(1))
+            if operation is None:
+                return self.error(404, "NotFound", "Resource not found.")
+            status = {"createdDateTime": operation["created"], "lastUpdatedDateTime": _iso_now()}
+            if time.monotonic() < operation["ready_at"]:
+                return self.json_response(200, dict(status, status="running"))
+            result = _camel_case(make_analyze_result_dict(pages=operation["pages"], seed=int(match.group(1)[:8], 16)))
+            result.update({"apiVersion": "2023-07-31", "modelId": operation["model_id"], "stringIndexType": "unicodeCodePoint"})
+            with self.lock:
+                self.operations.pop(match.group(1), None)
+            return self.json_response(200, dict(status, status="succeeded", analyzeResult=result))
+        return self.error(404, "NotFound", "Resource not found.")
+
+
+class FakeCognitiveSearch(FakeService):
+    """
+    Cognitive Search stand-in with indexes and their documents kept in memory.
+
+    Serves index listing, creation and updates, document batches, and searches filtered on
+    sourcefile and paged by key the way CognitiveSearchHandler queries them. It throttles with
+    503, as Search does.
+    """
+    name = "search"
+    DEFAULT_BEHAVIOR = {"latency": 0.03, "throttle_status": 503}
+
+    def __init__(self, behavior: ServiceBehavior = None, seed: int = 0):
+        super().__init__(behavior, seed)
+        self.indexes = {}
+        self.documents = {}
+
+    def _matches(self, document: dict, filter: str):
+        if not filter:
+            return True
+        after = re.search(r"id gt '((?:[^']|'')*)'", filter)
+        if after:
+            if not document.get("id") > after.group(1).replace("''", "'"):
+                return False
+            filter = filter[:after.start()] + filter[after.end():]
+        names = set()
+        for value in re.findall(r"'((?:[^']|'')*)'", filter):
+            names.update(value.replace("''", "'").split("|"))
+        return not names or document.get("sourcefile") in names
+
+    def _sortable(self, index: dict, name: str):
+        return any(field.get("name") == name and field.get("sortable", True) for field in index.get("fields") or [])
+
+    def serve(self, method: str, url, headers: dict, body: bytes):
+        path = unquote(url.path)
+        request = json.loads(body) if body else {}
+        if path == "/indexes" and method == "GET":
+            with self.lock:
+                return self.json_response(200, {"value": [{"name": name} for name in self.indexes]})
+        if path == "/indexes" and method == "POST":
+            with self.lock:
+                self.indexes[request["name"]] = request
+                self.documents.setdefault(request["name"], {})
+            return self.json_response(201, request)
+
+        match = re.match(r"/indexes\('([^']+)'\)(.*)$", path)
+        if not match:
+            return self.error(404, "NotFound", "Resource not found.")
+        index_name, rest = match.group(1), match.group(2)
+        with self.lock:
+            index = self.indexes.get(index_name)
+            documents = self.documents.get(index_name)
+        if rest == "" and method == "PUT":
+            with self.lock:
+                self.indexes[index_name] = request
+                self.documents.setdefault(index_name, {})
+            return self.json_response(200, request)
+        if index is None:
+            return self.error(404, "ResourceNotFound", f"No index with the name '{index_name}' was found.")
+        if rest == "" and method == "GET":
+            return self.json_response(200, index)
+        if rest == "/docs/search.index" and method == "POST":
+            results = []
+            with self.lock:
+                for action in request.get("value", []):
+                    key = action.get("id")
+                    kind = action.get("@search.action", "upload")
+                    if kind == "delete":
+                        documents.pop(key, None)
+                    else:
+                        fields = {name: value for name, value in action.items() if not name.startswith("@")}
+                        if kind in ("merge", "mergeOrUpload") and key in documents:
+                            documents[key].update(fields)
+                        else:
+                            documents[key] = fields
+                    results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200})
+            return self.json_response(200, {"value": results})
+        if rest == "/docs/search.post.search" and method == "POST":
+            with self.lock:
+                found = [document for document in documents.values() if self._matches(document, request.get("filter"))]
+            if request.get("orderby") == "id":
+                if not self._sortable(index, "id"):
+                    return self.error(400, "InvalidRequestParameter", "Field 'id' is not sortable.")
+                found.sort(key=lambda document: document["id"])
+            select = [field.strip() for field in (request.get("select") or "").split(",") if field.strip()]
+            top = request.get("top")
+            response = {"value": [dict({"@search.score": 1.0},
+                                       **({field: document.get(field) for field in select} if select else document))
+                                  for document in found[:top] if top != 0]}
+            if request.get("count"):
+                response["@odata.count"] = len(found)
+            return self.json_response(200, response)
+        if rest == "/docs/$count" and method == "GET":
+            return 200, {"Content-Type": "text/plain"}, str(len(documents)).encode("utf-8")
+        return self.error(404, "NotFound", "Resource not found.")
+
+
+class FakeOpenAI(FakeService):
+    """
+    Azure OpenAI stand-in for chat completions, answering with the same filled-in metadata.
+
+    Latency grows with the prompt through latency_per_kb, as it does with the real service.
+    """
+    name = "openai"
+    DEFAULT_BEHAVIOR = {"latency": 0.5, "latency_per_kb": 0.05}
+
+    def __init__(self, behavior: ServiceBehavior = None, seed: int = 0, metadata: dict = None):
+        super().__init__(behavior, seed)
+        self.metadata = metadata or {"contractName": "Supply agreement", "contractID": "SA-2024-001",
+                                     "contractDate": "01012024", "buyerName": "Contoso Ltd", "sellerName": "Fabrikam Inc"}
+
+    def serve(self, method: str, url, headers: dict, body: bytes):
+        match = re.match(r"/openai/deployments/([^/]+)/chat/completions$", url.path)
+        if method != "POST" or not match:
+            return self.error(404, "NotFound", "Resource not found.")
+        request = json.loads(body)
+        prompt_tokens = sum(len(message.get("content") or "") for message in request.get("messages", [])) // 4
+        content = json.dumps(self.metadata)
+        return self.json_response(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": match.group(1),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                      "total_tokens": prompt_tokens + len(content) // 4}
+        })
+
+
+class FakeServiceAdapter(HTTPAdapter):
+    """
+    requests transport adapter that answers requests from the stand-in registered for their host.
+
+    Mounted on a session, it takes the place of the network for every SDK client and the OpenAI
+    library using that session. Hosts are matched by suffix, e.g. ".blob.core.windows.net".
+    """
+
+    def __init__(self, services: dict):
+        super().__init__()
+        self.services = services
+
+    def _service(self, host: str):
+        for suffix, service in self.services.items():
+            if host == suffix.lstrip(".") or host.endswith(suffix):
+                return service
+        return None
+
+    def _read_body(self, body):
+        if body is None:
+            return b""
+        if isinstance(body, str):
+            return body.encode("utf-8")
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            return bytes(body)
+        if hasattr(body, "read"):
+            return body.read()
+        return b"".join(part.encode("utf-8") if isinstance(part, str) else bytes(part) for part in body)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlparse(request.url)
+        # Endpoints configured with a trailing slash lead to paths starting with "//"
+        url = url._replace(path="/" + url.path.lstrip("/"))
+        service = self._service(url.hostname)
+        if service is None:
+            status, headers, body = 502, {"Content-Type": "text/plain"}, f"No stand-in for {url.hostname}".encode("utf-8")
+        else:
+            status, headers, body = service.handle(request.method, url, request.headers, self._read_body(request.body))
+        headers = dict(headers)
+        if request.method != "HEAD":
+            headers["Content-Length"] = str(len(body))
+        headers.setdefault("x-ms-request-id", str(uuid.uuid4()))
+        headers.setdefault("Date", formatdate(usegmt=True))
+        raw = HTTPResponse(body=io.BytesIO(body if request.method != "HEAD" else b""), headers=headers, status=status,
+                           reason=http.client.responses.get(status, ""), preload_content=False, decode_content=False,
+                           request_method=request.method)
+        return self.build_response(request, raw)
+
+
+class FakeServices():
+    """
+    One stand-in for each service the pipeline talks to, and the adapter routing requests to them.
+    """
+    STORAGE_ACCOUNT = "loadtest"
+    STORAGE_HOST = ".blob.core.windows.net"
+    FORMRECOGNIZER_ENDPOINT = "https://loadtest.cognitiveservices.azure.com/"
+    SEARCH_ENDPOINT = "https://loadtest.search.windows.net"
+    OPENAI_ENDPOINT = "https://loadtest.openai.azure.com/"
+
+    def __init__(self, config: dict = None, seed: int = 0, analyze_seconds: float = 1.0,
+                 analyze_seconds_per_page: float = 0.1):
+        """
+        Args:
+            config (dict): ServiceBehavior settings by service name ("storage", "formrecognizer",
+                "search", "openai"), overriding the defaults of each service.
+        """
+        config = config or {}
+
+        def _behavior(service_class):
+            return ServiceBehavior(**dict(service_class.DEFAULT_BEHAVIOR, **config.get(service_class.name, {})))
+
+        self.storage = FakeBlobStorage(_behavior(FakeBlobStorage), seed)
+        self.formrecognizer = FakeFormRecognizer(_behavior(FakeFormRecognizer), seed, analyze_seconds,
+                                                 analyze_seconds_per_page)
+        self.search = FakeCognitiveSearch(_behavior(FakeCognitiveSearch), seed)
+        self.openai = FakeOpenAI(_behavior(FakeOpenAI), seed)
+        self.adapter = FakeServiceAdapter({
+            self.STORAGE_HOST: self.storage,
+            ".cognitiveservices.azure.com": self.formrecognizer,
+            ".search.windows.net": self.search,
+            ".openai.azure.com": self.openai
+        })
+
+    @property
+    def account_url(self):
+        return f"https://{self.STORAGE_ACCOUNT}{self.STORAGE_HOST}"
+
+    def environment(self):
+        """
+        Returns the settings that point the function app at the stand-ins.
+        """
+        return {
+            "AZURE_STORAGEACCOUNT_SAS": "sv=2021-12-02&ss=b&srt=sco&sp=rwdlac&sig=loadtest",
+            "AZ_FORMRECOGNIZER_ENDPOINT": self.FORMRECOGNIZER_ENDPOINT,
+            "AZ_FORMRECOGNIZER_KEY": "loadtest",
+            "AZURE_COGNITIVESEARCH_ENDPOINT": self.SEARCH_ENDPOINT,
+            "AZURE_COGNITIVESEARCH_KEY": "loadtest",
+            "AZURE_COGNITIVESEARCH_INDEXNAME": "loadtest",
+            "AZURE_OPENAI_ENDPOINT": self.OPENAI_ENDPOINT,
+            "AZURE_OPENAI_KEY": "loadtest",
+            "AZURE_OPENAI_DEPLOYMENT": "loadtest"
+        }
+
+    def stats(self):
+        return {service.name: service.stats() for service in (self.storage, self.formrecognizer, self.search, self.openai)}
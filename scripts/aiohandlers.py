@@ -0,0 +1,546 @@
+import os
+import time
+import asyncio
+import logging
+import openai
+from openai.openai_object import OpenAIObject
+from common import logger_config, log_function_call
+from instrumentation import stage
+from azure.core.exceptions import HttpResponseError, ResourceExistsError
+from azblobhanlder import BlobHandler, BlobBuffer, _known_containers
+from azformrecognizerhandler import FormRecognizerHandler, merge_analyze_results
+from azcognitivesearchhandler import (CognitiveSearchHandler, MAX_BATCH_DOCUMENTS, MAX_BATCH_BYTES, KEY_PAGE_SIZE, _IndexRun,
+                                       _IndexSync, _known_indexes)
+from documentsplitter import DocumentSplitter, _ConvergenceDetector
+from ingestionpipeline import IngestionPipeline
+from eventcreateandmodify import BlobCreateModifyEventHandler
+from clientregistry import (get_aiohttp_session, get_async_default_credential, get_async_blob_service_client,
+                            get_async_document_analysis_client, get_async_search_index_client, get_async_search_client)
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+# Async variants of the handlers, built on the azure.*.aio clients and openai's acreate. They must be
+# created and used on a running event loop, the clients they get from clientregistry belong to that loop.
+# Only the I/O lives here, everything else is shared with the synchronous handlers they extend.
+
+
+class AsyncBlobHandler(BlobHandler):
+
+    @log_function_call
+    def create_blob_service_client(self):
+        self.blob_service_client = get_async_blob_service_client(account_url=self.blob_info["account_url"], credential=self.credential)
+        return self.blob_service_client
+
+    @log_function_call
+    async def _ensure_container(self, container: str):
+        self._ensure_blob_service_client()
+        container_client = self.blob_service_client.get_container_client(container)
+        key = self._container_key(container)
+        if key not in _known_containers:
+            if not await container_client.exists():
+                try:
+                    await container_client.create_container()
+                except ResourceExistsError:
+                    pass
+            _known_containers.add(key)
+        self.blob_container_client = container_client
+        return container_client
+
+    @log_function_call
+    async def _upload_blob(self, container_client, blob_name, data, metadata: dict[str, str] = None):
+        await container_client.upload_blob(blob_name, data, overwrite=True, metadata=metadata)
+
+    @log_function_call
+    async def upload_file(self, blob_name, data: str, container: str = None, metadata: dict[str, str] = None):
+        if container == None:
+            container = self.blob_info["container_name"]
+        container_client = await self._ensure_container(container)
+        await self._upload_blob(container_client, blob_name, data, metadata)
+
+    @log_function_call
+    async def upload_files(self, blobs, container: str = None, metadata: dict[str, str] = None, max_workers: int = 8):
+        """
+        Same as BlobHandler.upload_files, with at most max_workers uploads in flight on the event loop.
+        """
+        if container == None:
+            container = self.blob_info["container_name"]
+        container_client = await self._ensure_container(container)
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def _upload(blob):
+            blob_name, data = blob
+            async with semaphore:
+                try:
+                    await self._upload_blob(container_client, blob_name, data, metadata)
+                    return self._upload_status(blob_name, container)
+                except Exception as e:
+                    return self._upload_status(blob_name, container, e)
+
+        with stage("blob_upload"):
+            upload_status = list(await asyncio.gather(*(_upload(blob) for blob in blobs)))
+        return self._check_uploads(container, upload_status)
+
+    @log_function_call
+    async def get_blob_properties(self):
+        if not hasattr(self, "blob_client"):
+            self.create_blob_client()
+        self.blob_properties = await self.blob_client.get_blob_properties()
+        return self.blob_properties
+
+    @log_function_call
+    async def download_to_buffer(self, max_concurrency: int = 8):
+        if not hasattr(self, "blob_client"):
+            self.create_blob_client()
+        with stage("download"):
+            downloader = await self.blob_client.download_blob(max_concurrency=max_concurrency)
+            self.blob_buffer = BlobBuffer(downloader.size, source=self.blob_url, etag=downloader.properties.etag)
+            await downloader.readinto(self.blob_buffer.writer())
+        return self.blob_buffer
+
+
+class AsyncFormRecognizerHandler(FormRecognizerHandler):
+
+    def _default_credential(self):
+        return get_async_default_credential()
+
+    @log_function_call
+    def create_formrecognizer_client(self):
+        self._ensure_crendetial()
+        self.formrecognizer_client = get_async_document_analysis_client(endpoint=self.service_info["endpoint"], credential=self.credential)
+        return self.formrecognizer_client
+
+    @log_function_call
+    async def _analyze_range(self, document, page_range):
+        poller = await self._begin(document, pages=f"{page_range[0]}-{page_range[1]}")
+        return await poller.result()
+
+    @log_function_call
+    async def _analyze_in_ranges(self, document, page_ranges):
+        logger.info(f"Analyzing {document.source} as {len(page_ranges)} page ranges")
+        semaphore = asyncio.Semaphore(self.range_concurrency)
+
+        async def _analyze(page_range):
+            async with semaphore:
+                return await self._analyze_range(document, page_range)
+
+        partials = await asyncio.gather(*(_analyze(page_range) for page_range in page_ranges))
+        return merge_analyze_results(list(partials), [first for first, _ in page_ranges])
+
+    @log_function_call
+    async def analyze_blob(self, blob_handler):
+        if self.cache is not None:
+            properties = await blob_handler.get_blob_properties()
+            cached = await asyncio.to_thread(self.cache.get, self._cache_key(blob_handler.blob_url, properties.etag))
+            if cached is not None:
+                logger.info(f"Using the cached analysis of {blob_handler.blob_url}")
+                self.result = cached
+                return self.result
+        return await self.analyze_document(await blob_handler.download_to_buffer(), use_cache=False)
+
+    @log_function_call
+    async def analyze_document(self, document, use_cache: bool = True):
+        """
+        Same as FormRecognizerHandler.analyze_document, the poller waits on the event loop instead of blocking a thread.
+        """
+        try:
+            # The cache is synchronous, its reads and writes go to a worker thread
+            cache_key = self._document_cache_key(document)
+            if cache_key is not None and use_cache:
+                cached = await asyncio.to_thread(self.cache.get, cache_key)
+                if cached is not None:
+                    self.result = cached
+                    return cached
+            self._ensure_formrecognizer_client()
+            with stage("analyze"):
+                # Counting the pages parses the whole PDF, which would hold up every other coroutine
+                page_ranges = None if isinstance(document, str) else await asyncio.to_thread(self._page_ranges, document)
+                if page_ranges:
+                    result = await self._analyze_in_ranges(document, page_ranges)
+                else:
+                    result = await (await self._begin(document)).result()
+            # Kept in a local, other analyses of this handler may set self.result while the cache is written
+            self.result = result
+            if cache_key is not None:
+                await asyncio.to_thread(self.cache.put, cache_key, result)
+            return result
+        except Exception as e:
+            logger.error("Error occurred during document analysis: %s", str(e))
+            raise
+
+
+    @log_function_call
+    async def analyze_documents(self, documents, max_in_flight: int = None):
+        """
+        Same as FormRecognizerHandler.analyze_documents, as an async generator of (document, result, error).
+
+        The aio pollers already wait on the event loop, so the analyses run as tasks, at most
+        max_in_flight at a time, rather than through an AnalysisScheduler. They are yielded as
+        they complete, so documents found in the cache come first.
+        """
+        semaphore = asyncio.Semaphore(max_in_flight or int(os.getenv("FORMRECOGNIZER_MAX_IN_FLIGHT") or 8))
+
+        async def _analyze(document):
+            async with semaphore:
+                try:
+                    return document, await self.analyze_document(document), None
+                except Exception as e:
+                    return document, None, e
+
+        for analysis in asyncio.as_completed([_analyze(document) for document in documents]):
+            yield await analysis
+
+
+class AsyncCognitiveSearchHandler(CognitiveSearchHandler):
+
+    @log_function_call
+    def _create_search_index_client(self):
+        self.index_client = get_async_search_index_client(endpoint=self.endpoint, credential=self.credential)
+        return self.index_client
+
+    @log_function_call
+    async def create_search_index(self):
+        index_key = self._index_key()
+        if index_key in _known_indexes:
+            return
+        logger.debug(f"Ensuring search index {self.index_name} exists")
+        self._create_search_index_client()
+        fields = self._index_fields()
+        if self.index_name not in [name async for name in self.index_client.list_index_names()]:
+            search_index = self._new_search_index(fields)
+            logger.debug(f"Creating {self.index_name} search index")
+            await self.index_client.create_index(search_index)
+        else:
+            search_index = await self.index_client.get_index(self.index_name)
+            if self._missing_fields(search_index, fields):
+                await self.index_client.create_or_update_index(search_index)
+        _known_indexes.add(index_key)
+
+    @log_function_call
+    async def _create_search_client(self):
+        await self.create_search_index()
+        self.search_client = get_async_search_client(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
+        return self.search_client
+
+    @log_function_call
+    async def _send_batch(self, batch: list, action: str, max_retries: int, retry_delay: float):
+        send = getattr(self.search_client, f"{action}_documents")
+        pending = batch
+        succeeded = 0
+        failed_keys = []
+        for attempt in range(max_retries + 1):
+            try:
+                results = await send(documents=pending)
+            except HttpResponseError as e:
+                self._check_retryable(e, attempt, max_retries, pending)
+            else:
+                succeeded += sum([1 for r in results if r.succeeded])
+                given_up, pending = self._retry_pending(results, pending, attempt, max_retries)
+                failed_keys.extend(given_up)
+                if pending is None:
+                    return succeeded, sorted(failed_keys)
+            await asyncio.sleep(retry_delay * (2 ** attempt))
+
+    @log_function_call
+    async def _index_documents(self, documents, action: str = "upload", batch_size: int = MAX_BATCH_DOCUMENTS,
+                               max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4,
+                               max_retries: int = 3, retry_delay: float = 1):
+        """
+        Same as CognitiveSearchHandler._index_documents, with the batches in flight as tasks on the event loop.
+        """
+        run = _IndexRun(action)
+        with stage("index"):
+            in_flight = set()
+            for batch in self._iter_batches(documents, batch_size, max_batch_bytes):
+                if len(in_flight) >= max_concurrency:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        run.collect(task.result())
+                in_flight.add(asyncio.ensure_future(self._send_batch(batch, action, max_retries, retry_delay)))
+                run.sent(batch)
+            if in_flight:
+                for task in (await asyncio.wait(in_flight))[0]:
+                    run.collect(task.result())
+        return run.finish()
+
+    @log_function_call
+    async def upload_index_document(self, filename: str, sections: any, batch_size: int = MAX_BATCH_DOCUMENTS,
+                                    max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4, max_retries: int = 3):
+        logger.debug(f"Indexing sections from '{filename}' into search index '{self.index_name}'")
+        await self._create_search_client()
+        return await self._index_documents(sections, action="upload", batch_size=batch_size, max_batch_bytes=max_batch_bytes,
+                                           max_concurrency=max_concurrency, max_retries=max_retries)
+
+    @log_function_call
+    async def _iter_by_key(self, filter: str, select: list, page_size: int = KEY_PAGE_SIZE):
+        """
+        Same as CognitiveSearchHandler._iter_by_key.
+        """
+        if not self._keys_sortable():
+            async for r in await self.search_client.search("", filter=filter, select=select):
+                yield r
+            return
+        last_key = None
+        while True:
+            results = await self.search_client.search("", filter=self._key_page_filter(filter, last_key), select=select,
+                                                      order_by=["id"], top=page_size)
+            page = [r async for r in results]
+            for r in page:
+                yield r
+            if len(page) < page_size:
+                return
+            last_key = page[-1]["id"]
+
+    @log_function_call
+    async def get_indexed_hashes(self, filename: str):
+        await self._create_search_client()
+        return {r["id"]: r.get("contenthash")
+                async for r in self._iter_by_key(self._sourcefile_filter([filename]), select=["id", "contenthash"])}
+
+    @log_function_call
+    async def sync_index_document(self, filename: str, sections: any, batch_size: int = MAX_BATCH_DOCUMENTS,
+                                  max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4, max_retries: int = 3):
+        """
+        Same as CognitiveSearchHandler.sync_index_document.
+        """
+        return await self.sync_index_documents({filename: sections}, batch_size=batch_size, max_batch_bytes=max_batch_bytes,
+                                               max_concurrency=max_concurrency, max_retries=max_retries)
+
+    @log_function_call
+    async def sync_index_documents(self, sections_by_file: dict, batch_size: int = MAX_BATCH_DOCUMENTS,
+                                   max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4, max_retries: int = 3):
+        """
+        Same as CognitiveSearchHandler.sync_index_documents.
+        """
+        logger.debug(f"Syncing sections from {len(sections_by_file)} files into search index '{self.index_name}'")
+        await self._create_search_client()
+        sync = _IndexSync(sections_by_file)
+        async for r in self._iter_by_key(self._sourcefile_filter(list(sections_by_file)), select=["id", "contenthash", "sourcefile"]):
+            sync.add_indexed(r)
+        sync.uploaded(await self._index_documents(sync.changed_sections(), action="merge_or_upload", batch_size=batch_size,
+                                                  max_batch_bytes=max_batch_bytes, max_concurrency=max_concurrency,
+                                                  max_retries=max_retries))
+        vanished = sync.vanished()
+        if vanished:
+            sync.deleted(await self._index_documents(vanished, action="delete", max_concurrency=max_concurrency,
+                                                     max_retries=max_retries))
+        return sync.finish()
+
+    @log_function_call
+    async def _count(self, filter: str):
+        results = await self.search_client.search("", filter=filter, top=0, include_total_count=True)
+        return await results.get_count()
+
+    @log_function_call
+    async def remove_from_index(self, filename: any = None, max_concurrency: int = 4, confirm: bool = True, timeout: float = 30):
+        """
+        Same as CognitiveSearchHandler.remove_from_index.
+        """
+        stats = {"deleted": 0, "remaining": None}
+        filenames = self._files_to_remove(filename)
+        if filenames == []:
+            return stats
+        await self._create_search_client()
+        filter = None if filenames is None else self._sourcefile_filter(filenames)
+        keys = [r["id"] async for r in self._iter_by_key(filter, select=["id"])]
+        if keys:
+            delete_stats = await self._index_documents(({"id": key} for key in keys), action="delete",
+                                                       max_concurrency=max_concurrency)
+            stats["deleted"] = delete_stats["succeeded"]
+            logger.debug(f"\tRemoved {stats['deleted']} sections from index")
+        if confirm:
+            deadline = time.time() + timeout
+            delay = 0.25
+            stats["remaining"] = await self._count(filter)
+            while stats["remaining"] > 0 and time.time() < deadline:
+                await asyncio.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay *= 2
+                stats["remaining"] = await self._count(filter)
+            if stats["remaining"] > 0:
+                logger.warning(f"\t{stats['remaining']} sections still visible in index after {timeout}s")
+        return stats
+
+
+class AsyncDocumentSplitter(DocumentSplitter):
+    # Same schedule as the @retry on DocumentSplitter._openai_chat_request
+    RETRY_TRIES = 4
+    RETRY_DELAY = 2
+    RETRY_BACKOFF = 2
+
+    @log_function_call
+    async def _openai_chat_request(self, messages: list[dict[str, str]]):
+        # acreate takes its aiohttp session from this context variable, share the one of the event loop
+        openai.aiosession.set(get_aiohttp_session())
+        delay = self.RETRY_DELAY
+        for attempt in range(self.RETRY_TRIES):
+            try:
+                return await openai.ChatCompletion.acreate(engine=self.deployment_id, messages=messages, **self.chat_parameters)
+            except Exception as e:
+                if attempt == self.RETRY_TRIES - 1:
+                    raise
+                logger.warning(f"{e}, retrying in {delay} seconds...")
+                await asyncio.sleep(delay)
+                delay *= self.RETRY_BACKOFF
+
+    @log_function_call
+    async def _openai_chat(self, messages: list[dict[str, str]], max_tries: int = 3):
+        if self.cache is None:
+            with stage("llm"):
+                self.chat = await self._openai_chat_request(messages)
+            return self.chat
+        # The cache is SQLite, its reads and writes go to a worker thread instead of blocking the event loop
+        key = self._chat_cache_key(messages)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            self.chat = OpenAIObject.construct_from(cached)
+            return self.chat
+        with stage("llm"):
+            self.chat = await self._openai_chat_request(messages)
+        await asyncio.to_thread(self.cache.put, key, self.chat.to_dict_recursive())
+        return self.chat
+
+    @log_function_call
+    async def _extract_partial(self, text):
+        return self._parse_partial(await self._openai_chat(messages=self._partial_messages(text)))
+
+    @log_function_call
+    async def _split_sequential(self, chunks, result):
+        self._construct_system_message()
+        detector = _ConvergenceDetector(self, self.early_stop_rounds)
+        start_time = time.perf_counter()
+        requests = 0
+        for chunk in chunks:
+            self._next_message(message=chunk.page_content)
+            self.chat = await self._openai_chat(messages=self.messages)
+            requests += 1
+            if self._take_answer(detector):
+                break
+        return self._sequential_result(result, len(chunks), requests, start_time)
+
+    @log_function_call
+    async def _split_map_reduce(self, chunks, result, max_concurrency: int, group_size: int):
+        groups = self._map_groups(chunks, group_size)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _extract(group):
+            async with semaphore:
+                return await self._extract_partial(group)
+
+        start_time = time.perf_counter()
+        partials = await asyncio.gather(*(_extract(group) for group in groups))
+        return self._map_reduce_result(result, list(partials), start_time)
+
+    @log_function_call
+    async def _split_chunks(self, chunks, mode: str, max_concurrency: int, group_size: int):
+        result, request_chunks = self._start_split(chunks, mode)
+        if mode == "map_reduce":
+            return await self._split_map_reduce(request_chunks, result, max_concurrency, group_size)
+        return await self._split_sequential(request_chunks, result)
+
+    @log_function_call
+    async def split(self, document, mode: str = "sequential", max_concurrency: int = 4, group_size: int = 1):
+        # Parsing the PDF is CPU bound, keep it off the event loop
+        chunks = await asyncio.to_thread(self._document_splitter, document)
+        return await self._split_chunks(chunks, mode, max_concurrency, group_size)
+
+    @log_function_call
+    async def split_text(self, text: str, mode: str = "sequential", max_concurrency: int = 4, group_size: int = 1):
+        chunks = await asyncio.to_thread(self._text_splitter, text)
+        return await self._split_chunks(chunks, mode, max_concurrency, group_size)
+
+
+class AsyncIngestionPipeline(IngestionPipeline):
+    """
+    IngestionPipeline on the async handlers. The search index is checked while the document is
+    analyzed, and the chunk upload and the index sync run side by side.
+    """
+
+    @log_function_call
+    async def analyze(self):
+        form_recog_proc = AsyncFormRecognizerHandler(cache=self.analyze_cache)
+        await form_recog_proc.analyze_blob(self.blob_handler)
+        return await asyncio.to_thread(self.use_analysis, form_recog_proc.result)
+
+    @log_function_call
+    async def extract_metadata(self):
+        if self.document_proc is None:
+            await self.analyze()
+        splitted_doc = await self.doc_splitter.split_text(self._metadata_text(), mode=self.split_mode,
+                                                          max_concurrency=self.split_concurrency)
+        return self._take_split(splitted_doc)
+
+    @log_function_call
+    async def upload_chunks(self):
+        return await self.blob_handler.upload_files(self._chunk_blobs(), container=self.chunk_container, metadata=self.metadata)
+
+    @log_function_call
+    async def index_sections(self, search_handler: AsyncCognitiveSearchHandler = None):
+        if search_handler is None:
+            search_handler = AsyncCognitiveSearchHandler(metadata_fields=self.doc_splitter.metadata_list)
+        return await search_handler.sync_index_document(filename=self.filename, sections=self.iter_index_sections())
+
+    @log_function_call
+    async def run(self, search_handler: AsyncCognitiveSearchHandler = None):
+        if search_handler is None:
+            search_handler = AsyncCognitiveSearchHandler(metadata_fields=self.doc_splitter.metadata_list)
+        with stage("pipeline"):
+            prepare_index = asyncio.ensure_future(search_handler.create_search_index())
+            try:
+                await self.analyze()
+                await self.extract_metadata()
+            finally:
+                await prepare_index
+            upload_status, index_stats = await asyncio.gather(self.upload_chunks(), self.index_sections(search_handler))
+        return self._run_result(upload_status, index_stats)
+
+
+class AsyncBlobCreateModifyEventHandler(BlobCreateModifyEventHandler):
+    """
+    BlobCreateModifyEventHandler on the async handlers, so many documents can be processed concurrently on one event loop.
+
+    The processing manifest stays synchronous and is read and written from a worker thread.
+    """
+    doc_splitter_class = AsyncDocumentSplitter
+    blob_handler_class = AsyncBlobHandler
+    pipeline_class = AsyncIngestionPipeline
+
+    @log_function_call
+    async def is_unchanged(self):
+        if self.manifest is None:
+            return False
+        self.blob_properties = await self.blob_handler.get_blob_properties()
+        return await asyncio.to_thread(self.manifest.is_unchanged, self.blob_url, self.blob_properties)
+
+    @log_function_call
+    async def record_processed(self):
+        if self.manifest is None:
+            return
+        if not hasattr(self, "blob_properties"):
+            self.blob_properties = await self.blob_handler.get_blob_properties()
+        await asyncio.to_thread(self.manifest.record, self.blob_url, self.blob_properties)
+
+    @log_function_call
+    async def split_and_blob_upload(self):
+        # The chunk container is checked while the document is downloaded and split
+        prepare_container = asyncio.ensure_future(self.blob_handler._ensure_container("index"))
+        try:
+            document = await self.blob_handler.download_to_buffer()
+            splitted_doc = await self.doc_splitter.split(document, mode=self.split_mode, max_concurrency=self.split_concurrency)
+        finally:
+            await prepare_container
+        if self.llm_cache is not None:
+            logger.info(f"LLM cache: {self.llm_cache.stats()}")
+        return await self.blob_handler.upload_files(self._chunk_blobs(splitted_doc), container="index",
+                                                    metadata=splitted_doc["metadata"])
+
+    @log_function_call
+    async def ingest(self):
+        pipeline = self.create_pipeline()
+        return self._check_ingested(pipeline, await pipeline.run())
+
+    @log_function_call
+    async def process(self):
+        if self._check_mode() == "unified":
+            return await self.ingest()
+        return await self.split_and_blob_upload()
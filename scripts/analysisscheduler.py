@@ -0,0 +1,173 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import email.utils
+from datetime import datetime, timezone
+from common import logger_config, log_function_call
+from azure.core.exceptions import HttpResponseError
+from azure.core.polling.base_polling import LROBasePolling, BadStatus, BadResponse
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+# Marks the end of the items, which may themselves be None
+_NO_MORE_ITEMS = object()
+
+
+class ScheduledPolling(LROBasePolling):
+    """
+    Polling method that leaves the polling to an AnalysisScheduler.
+
+    The LROPoller of an SDK client normally starts a thread per operation that sleeps and polls
+    until the operation completes. With this polling method run() returns at once, and the
+    scheduler calls poll() whenever the operation is due instead.
+    """
+
+    def run(self):
+        pass
+
+    def poll(self):
+        """
+        Requests the status of the operation once.
+
+        Returns:
+            bool: Whether the operation has completed, its result is then available from resource().
+
+        Raises:
+            HttpResponseError: If the operation failed or its status could not be read.
+        """
+        if not self.finished():
+            try:
+                self.update_status()
+            except (BadStatus, BadResponse) as err:
+                self._status = "Failed"
+                raise HttpResponseError(response=self._pipeline_response.http_response, message=str(err), error=err) from err
+            if not self.finished():
+                return False
+        # Already finished, this only checks for a failure and fetches the final resource if the operation has one
+        super().run()
+        return True
+
+    def retry_after(self):
+        """
+        Returns the delay in seconds the service asked for in its last response, or None.
+
+        The delay is read from retry-after-ms or x-ms-retry-after-ms, or from Retry-After in seconds or as an HTTP date.
+        """
+        headers = self._pipeline_response.http_response.headers
+        for header in ("retry-after-ms", "x-ms-retry-after-ms"):
+            try:
+                return float(headers[header]) / 1000
+            except (KeyError, TypeError, ValueError):
+                pass
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max((email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class AnalysisScheduler():
+    """
+    Runs many long-running analyses at once and polls all of them from a single loop.
+
+    At most max_in_flight operations are started at a time, a new one is started whenever one
+    completes. Each operation is first polled after the time operations have typically taken so
+    far, then at an interval growing by backoff from min_interval up to max_interval, but never
+    sooner than the Retry-After of the service. The loop sleeps until the next poll is due.
+
+    Operations are started by a begin callable given an item, which returns an object with poll(),
+    retry_after() and resource(), such as ScheduledPolling. A fake with these three methods is
+    enough to exercise the scheduler without a service.
+    """
+
+    def __init__(self, max_in_flight: int = None, min_interval: float = None, max_interval: float = None,
+                 backoff: float = 1.5, sleep=time.sleep, clock=time.monotonic):
+        self.max_in_flight = max_in_flight or int(os.getenv("FORMRECOGNIZER_MAX_IN_FLIGHT") or 8)
+        self.min_interval = min_interval if min_interval is not None else float(os.getenv("FORMRECOGNIZER_POLL_INTERVAL") or 1)
+        self.max_interval = max_interval if max_interval is not None else float(os.getenv("FORMRECOGNIZER_MAX_POLL_INTERVAL") or 10)
+        self.backoff = backoff
+        self.sleep = sleep
+        self.clock = clock
+        # Moving average of how long operations took, used to time the first poll of new ones
+        self.typical_duration = None
+        self.polls = 0
+
+    def _first_delay(self):
+        if self.typical_duration is None:
+            return self.min_interval
+        return min(max(self.min_interval, 0.8 * self.typical_duration), self.max_interval)
+
+    def _record_duration(self, seconds: float):
+        if self.typical_duration is None:
+            self.typical_duration = seconds
+        else:
+            self.typical_duration = 0.8 * self.typical_duration + 0.2 * seconds
+
+    @log_function_call
+    def run(self, items, begin):
+        """
+        Analyzes every item and yields (item, result, error) as each operation completes.
+
+        error is None on success. An item whose operation could not be started or failed is
+        yielded with its exception, and does not stop the others.
+
+        Args:
+            items (iterable): The items to analyze, consumed as slots free up.
+            begin (callable): Starts the operation of an item and returns its polling method.
+        """
+        pending = iter(items)
+        exhausted = False
+        # (due, sequence, item, operation, started, interval), ordered by when the next poll is due
+        in_flight = []
+        sequence = itertools.count()
+        while True:
+            while not exhausted and len(in_flight) < self.max_in_flight:
+                item = next(pending, _NO_MORE_ITEMS)
+                if item is _NO_MORE_ITEMS:
+                    exhausted = True
+                    break
+                try:
+                    operation = begin(item)
+                except Exception as e:
+                    logger.error(f"Failed to start the analysis of {item}: {e}")
+                    yield item, None, e
+                    continue
+                now = self.clock()
+                heapq.heappush(in_flight, (now + self._first_delay(), next(sequence), item, operation, now, self.min_interval))
+            if not in_flight:
+                return
+
+            due, _, item, operation, started, interval = heapq.heappop(in_flight)
+            wait = due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            self.polls += 1
+            try:
+                finished = operation.poll()
+            except Exception as e:
+                logger.error(f"Analysis of {item} failed: {e}")
+                yield item, None, e
+                continue
+            if not finished:
+                delay = max(interval, operation.retry_after() or 0)
+                heapq.heappush(in_flight, (self.clock() + delay, next(sequence), item, operation, started,
+                                           min(interval * self.backoff, self.max_interval)))
+                continue
+            self._record_duration(self.clock() - started)
+            try:
+                result = operation.resource()
+            except Exception as e:
+                logger.error(f"Failed to read the analysis result of {item}: {e}")
+                yield item, None, e
+                continue
+            yield item, result, None
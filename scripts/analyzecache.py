@@ -0,0 +1,267 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from common import logger_config, log_function_call
+from azure.core.exceptions import ResourceNotFoundError
+from azure.ai.formrecognizer import AnalyzeResult
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def analyze_result_from_dict(data: dict):
+    """
+    AnalyzeResult.from_dict, with the lines linked back to their page as DocumentLine.get_words needs.
+    """
+    result = AnalyzeResult.from_dict(data)
+    for page in result.pages or []:
+        for line in page.lines or []:
+            line._parent = page
+    return result
+
+
+class LocalAnalyzeResultStore():
+    """
+    Keeps compressed analysis results as files in a local directory, the modification time marks the last use.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def get(self, name: str):
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, data: bytes):
+        # Write to a temporary file first so a reader never sees a partial entry
+        temp_path = f"{self._path(name)}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self._path(name))
+
+    def touch(self, name: str):
+        try:
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def list(self):
+        """
+        Returns (name, size, last_used) for every entry.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".json.gz"):
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def delete(self, name: str):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+
+class BlobAnalyzeResultStore():
+    """
+    Keeps compressed analysis results as blobs in a container, the last_used metadata marks the last use.
+    """
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+        self._container_checked = False
+
+    def get(self, name: str):
+        try:
+            return self.container_client.download_blob(name).readall()
+        except ResourceNotFoundError:
+            return None
+
+    def put(self, name: str, data: bytes):
+        if not self._container_checked:
+            if not self.container_client.exists():
+                self.container_client.create_container()
+            self._container_checked = True
+        self.container_client.upload_blob(name, data, overwrite=True, metadata={"last_used": str(time.time())})
+
+    def touch(self, name: str):
+        try:
+            self.container_client.get_blob_client(name).set_blob_metadata({"last_used": str(time.time())})
+        except ResourceNotFoundError:
+            pass
+
+    def list(self):
+        entries = []
+        for blob in self.container_client.list_blobs(include=["metadata"]):
+            last_used = float((blob.metadata or {}).get("last_used") or blob.last_modified.timestamp())
+            entries.append((blob.name, blob.size, last_used))
+        return entries
+
+    def delete(self, name: str):
+        try:
+            self.container_client.delete_blob(name)
+        except ResourceNotFoundError:
+            pass
+
+
+class LazyAnalyzeResult():
+    """
+    Stands in for a cached AnalyzeResult and decompresses and parses it on first attribute access.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._result = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._result is None:
+            with self._lock:
+                if self._result is None:
+                    self._result = self._loader()
+        return self._result
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+class AnalyzeResultCache():
+    """
+    Size-bounded cache of Form Recognizer AnalyzeResults, stored as gzip-compressed JSON.
+
+    Entries are keyed by the blob ETag, which changes whenever the blob is written, together with
+    the model ID and the blob URL. A hit is read right away, so a concurrent eviction cannot take
+    it away, and returned as LazyAnalyzeResult, so it is only parsed once it is used.
+
+    When the stored results grow past max_bytes, the least recently used ones are evicted. The total
+    size is listed from the store once, then tracked from the entries this cache writes, and listed
+    again only when that total goes over the limit. Entries written by other processes sharing the
+    store are therefore noticed at the next eviction, not at every put.
+    """
+
+    def __init__(self, store, max_bytes: int = 1024 * 1024 * 1024):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Approximate size of the store, None until it is first listed
+        self._total = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(source: str, etag: str, model_id: str):
+        key = json.dumps({"source": source, "etag": etag, "model_id": model_id}, sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json.gz"
+
+    def _parse(self, data: bytes):
+        return analyze_result_from_dict(json.loads(gzip.decompress(data)))
+
+    @log_function_call
+    def get(self, key: str):
+        """
+        Returns the cached result for key as a LazyAnalyzeResult, or None on a miss.
+        """
+        data = self.store.get(key)
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self.store.touch(key)
+        with self._lock:
+            self.hits += 1
+        return LazyAnalyzeResult(lambda: self._parse(data))
+
+    @log_function_call
+    def put(self, key: str, result):
+        data = gzip.compress(json.dumps(result.to_dict(), separators=(",", ":")).encode("utf-8"))
+        self.store.put(key, data)
+        self._evict(len(data))
+        return len(data)
+
+    def _evict(self, added: int):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self.store.list())
+            else:
+                self._total += added
+            if self._total <= self.max_bytes:
+                return
+            entries = sorted(self.store.list(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            for name, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                self.store.delete(name)
+                total -= size
+                self.evictions += 1
+            self._total = total
+
+    @log_function_call
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
+
+
+@log_function_call
+def get_analyze_cache(directory: str, max_bytes: int = 1024 * 1024 * 1024):
+    """
+    Returns the process-wide cache stored in the local directory, creating it on first use.
+    """
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = AnalyzeResultCache(LocalAnalyzeResultStore(directory), max_bytes=max_bytes)
+        return _caches[directory]
+
+
+@log_function_call
+def get_blob_analyze_cache(blob_service_client, container: str, max_bytes: int = 1024 * 1024 * 1024):
+    """
+    Returns the process-wide cache stored in container of the account of blob_service_client, creating it on first use.
+
+    Sharing it keeps the size total and the container check across events, instead of listing the
+    whole container again at the first put of each.
+    """
+    key = (blob_service_client.url, container)
+    with _caches_lock:
+        if key not in _caches:
+            container_client = blob_service_client.get_container_client(container)
+            _caches[key] = AnalyzeResultCache(BlobAnalyzeResultStore(container_client), max_bytes=max_bytes)
+        return _caches[key]
+
+
+@log_function_call
+def analyze_cache_from_env(blob_service_client=None):
+    """
+    Returns the cache configured by ANALYZE_CACHE_CONTAINER or ANALYZE_CACHE_PATH, or None when neither is set.
+
+    The container is looked up on blob_service_client, the account of the documents.
+    """
+    max_bytes = int(os.getenv("ANALYZE_CACHE_MAX_MB") or 1024) * 1024 * 1024
+    if os.getenv("ANALYZE_CACHE_CONTAINER") and blob_service_client is not None:
+        return get_blob_analyze_cache(blob_service_client, os.getenv("ANALYZE_CACHE_CONTAINER"), max_bytes=max_bytes)
+    if os.getenv("ANALYZE_CACHE_PATH"):
+        return get_analyze_cache(os.getenv("ANALYZE_CACHE_PATH"), max_bytes=max_bytes)
+    return None
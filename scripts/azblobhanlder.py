@@ -1,15 +1,136 @@
+import io
 import os
 import re
+import mmap
 import logging
+import threading
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
 from common import logger_config, log_function_call
+from instrumentation import stage
 from azure.identity import ChainedTokenCredential
 from azure.core.credentials import AzureSasCredential
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceExistsError
+from clientregistry import get_blob_service_client
 
 
 logger_config()
 logger = logging.getLogger("file")
 
+# Containers already checked or created in this process, keyed by (account_url, container)
+_known_containers = set()
+_known_containers_lock = threading.Lock()
+
+# Blobs of at least this size are buffered in an anonymous memory map rather than a bytearray
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+class BlobUploadError(Exception):
+    """
+    Raised by upload_files when some of the blobs failed to upload, after the others were uploaded.
+
+    Attributes:
+        container (str): The target container.
+        statuses (list): The {"blob_name", "succeeded", "error"} dict of every blob, in input order.
+        failed (list): The statuses of the blobs that failed.
+    """
+
+    def __init__(self, container: str, statuses: list):
+        self.container = container
+        self.statuses = statuses
+        self.failed = [status for status in statuses if not status["succeeded"]]
+        errors = "; ".join(f"{status['blob_name']}: {status['error']}" for status in self.failed[:5])
+        super().__init__(f"{len(self.failed)} of {len(statuses)} uploads to {container} failed: {errors}")
+
+
+class _BufferWriter(io.RawIOBase):
+    """
+    Seekable writable stream over a memoryview, so parallel ranged downloads land in place.
+    """
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = base + offset
+        return self._position
+
+    def write(self, data):
+        length = len(data)
+        self._view[self._position:self._position + length] = data
+        self._position += length
+        return length
+
+
+class _BufferReader(io.RawIOBase):
+    """
+    Seekable read-only stream over a memoryview, each reader keeps its own position.
+    """
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        data = self._view[self._position:self._position + len(buffer)]
+        length = len(data)
+        buffer[:length] = data
+        self._position += length
+        return length
+
+
+class BlobBuffer():
+    """
+    A blob downloaded once into memory and shared by every consumer of its content.
+
+    open() returns an independent read-only file object over the same memory, so the PDF parser
+    and Form Recognizer can both read the document without another download or copy.
+    """
+
+    def __init__(self, size: int, source: str = None, etag: str = None):
+        self.size = size
+        self.source = source
+        self.etag = etag
+        self._storage = mmap.mmap(-1, size) if size >= MMAP_THRESHOLD else bytearray(size)
+        self.view = memoryview(self._storage)
+
+    def writer(self):
+        return _BufferWriter(self.view)
+
+    def open(self):
+        return _BufferReader(self.view)
+
+    def close(self):
+        self.view.release()
+        if isinstance(self._storage, mmap.mmap):
+            self._storage.close()
+
+
 class BlobHandler():
     def __init__(self, blob_url: str, credential):
         self.blob_url = blob_url
@@ -66,13 +187,14 @@ class BlobHandler():
         if self.blob_info == "" or self.blob_info == None:
             logger.error("blob_info attribute is not identifed")
             raise AttributeError("blob_info attribute is not identifed")
-        self.blob_service_client = BlobServiceClient(account_url=self.blob_info["account_url"], credential=self.credential)
+        # Shared with every handler for the same account and credential, see clientregistry
+        self.blob_service_client = get_blob_service_client(account_url=self.blob_info["account_url"], credential=self.credential)
         return self.blob_service_client
 
     @log_function_call
     def _ensure_blob_service_client(self):
         if not hasattr(self, "blob_service_client"):
-            self.create_blob_client()
+            self.create_blob_service_client()
         return self.blob_service_client
 
     @log_function_call
@@ -102,19 +224,90 @@ class BlobHandler():
     #         logger.error("container is not defined")
     #         raise ValueError("container is not defined")
 
+    def _container_key(self, container: str):
+        return (self.blob_info["account_url"], container)
+
+    @log_function_call
+    def _ensure_container(self, container: str):
+        """
+        Returns a client for the container, creating the container the first time it is used.
+
+        Whether the container exists is remembered for the lifetime of the process, so the
+        exists() round-trip is made once per container rather than once per upload.
+        """
+        self._ensure_blob_service_client()
+        container_client = self.blob_service_client.get_container_client(container)
+        key = self._container_key(container)
+        if key not in _known_containers:
+            with _known_containers_lock:
+                if key not in _known_containers:
+                    if not container_client.exists():
+                        try:
+                            container_client.create_container()
+                        except ResourceExistsError:
+                            pass
+                    _known_containers.add(key)
+        self.blob_container_client = container_client
+        return container_client
+
+    @log_function_call
+    def _upload_blob(self, container_client, blob_name, data, metadata: dict[str, str] = None):
+        # Reprocessing a blob replaces the chunks of the previous run
+        container_client.upload_blob(blob_name, data, overwrite=True, metadata=metadata)
+
     @log_function_call
     def upload_file(self, blob_name, data: str, container: str = None, metadata: dict[str, str] = None):
         # TODO: this function has to return state
         if container == None:
             container = self.blob_info["container_name"]
-        self.create_container_client(container)
-        if not self.blob_container_client.exists():
-            self.blob_container_client.create_container()
-        # TODO: handling error, double check on this code, this will get IO stream ouput from formrecoginzer
-        if metadata == None:
-            self.blob_container_client.upload_blob(blob_name, data, overwrite=True)
-        else:
-            self.blob_container_client.upload_blob(blob_name, data, metadata=metadata)
+        container_client = self._ensure_container(container)
+        self._upload_blob(container_client, blob_name, data, metadata)
+
+    @log_function_call
+    def upload_files(self, blobs, container: str = None, metadata: dict[str, str] = None, max_workers: int = 8):
+        """
+        Uploads several blobs to one container concurrently.
+
+        Args:
+            blobs (iterable): (blob_name, data) pairs to upload.
+            container (str): The target container, defaults to the container of blob_url.
+            metadata (dict): Metadata set on every uploaded blob.
+            max_workers (int): The maximum number of uploads in flight.
+
+        Returns:
+            list: One {"blob_name", "succeeded", "error"} dict per blob, in input order.
+
+        Raises:
+            BlobUploadError: Some of the blobs failed to upload, every upload was attempted.
+        """
+        if container == None:
+            container = self.blob_info["container_name"]
+        container_client = self._ensure_container(container)
+
+        def _upload(blob):
+            blob_name, data = blob
+            try:
+                self._upload_blob(container_client, blob_name, data, metadata)
+                return self._upload_status(blob_name, container)
+            except Exception as e:
+                return self._upload_status(blob_name, container, e)
+
+        with stage("blob_upload"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return self._check_uploads(container, list(executor.map(_upload, blobs)))
+
+    def _upload_status(self, blob_name: str, container: str, error: Exception = None):
+        if error is None:
+            return {"blob_name": blob_name, "succeeded": True, "error": None}
+        logger.error("Failed to upload %s to %s: %s", blob_name, container, str(error))
+        return {"blob_name": blob_name, "succeeded": False, "error": str(error)}
+
+    def _check_uploads(self, container: str, upload_status: list):
+        """
+        Returns the statuses of upload_files, or raises BlobUploadError when any upload failed.
+        """
+        if not all(status["succeeded"] for status in upload_status):
+            raise BlobUploadError(container, upload_status)
+        return upload_status
 
     @log_function_call
     def remove_blobs(self, blob_path: str, container: str = ""):
@@ -125,18 +318,43 @@ class BlobHandler():
     
     @log_function_call
     def create_blob_client(self, file_path: str = None, container: str = None):
-        self._ensure_blob_service_client(self)
+        self._ensure_blob_service_client()
+        if container == None:
+            container = self.blob_info["container_name"]
+            if container == None or container == "":
+                logger.error("container_name is not defined")
+                raise ValueError("container_name is not defined")
         if file_path == None:
-            file_path = self.blob_info["file_path"]
+            # file_path of blob_info starts with the container, the blob name is the rest of it
+            file_path = unquote(self.blob_info["file_path"][len(self.blob_info["container_name"]) + 1:])
             if file_path == None or file_path == "":
                 logger.error("blob_path is not defined")
                 raise ValueError("blob_path is not defined")
-        if container == None:
-            container = self.blob_container_client
-            if container == None or container == "":
-                container = self.blob_info["container_name"]
-                if container == None or container == "":
-                    logger.error("container_name is not defined")
-                    raise ValueError("container_name is not defined")
         self.blob_client = self.blob_service_client.get_blob_client(container=container, blob=file_path)
         return self.blob_client
+
+    @log_function_call
+    def get_blob_properties(self):
+        """
+        Fetches the properties of the blob at blob_url, such as its ETag and content MD5, without downloading it.
+        """
+        if not hasattr(self, "blob_client"):
+            self.create_blob_client()
+        self.blob_properties = self.blob_client.get_blob_properties()
+        return self.blob_properties
+
+    @log_function_call
+    def download_to_buffer(self, max_concurrency: int = 8):
+        """
+        Downloads the blob at blob_url once, with parallel ranged reads straight into a BlobBuffer.
+
+        Returns:
+            BlobBuffer: The content of the blob.
+        """
+        if not hasattr(self, "blob_client"):
+            self.create_blob_client()
+        with stage("download"):
+            downloader = self.blob_client.download_blob(max_concurrency=max_concurrency)
+            self.blob_buffer = BlobBuffer(downloader.size, source=self.blob_url, etag=downloader.properties.etag)
+            downloader.readinto(self.blob_buffer.writer())
+        return self.blob_buffer
@@ -1,93 +1,496 @@
 import os
+import json
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from common import logger_config, log_function_call
+from instrumentation import stage
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents.indexes import SearchIndexClient
+from azure.core.exceptions import HttpResponseError
 from azure.search.documents.indexes.models import SearchIndex, SimpleField, SearchableField, SemanticSettings, SemanticConfiguration, PrioritizedFields, SemanticField
-from azure.search.documents import SearchClient
+from clientregistry import get_search_index_client, get_search_client
 
 
 logger_config()
 logger = logging.getLogger("file")
 
+# Limits of a single indexing request, the service rejects payloads over 16 MB
+MAX_BATCH_DOCUMENTS = 1000
+MAX_BATCH_BYTES = 15 * 1024 * 1024
+# Per-document and per-request status codes that are worth retrying
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+# Results per query when reading keys back, the largest top the service accepts
+KEY_PAGE_SIZE = 1000
+
+# Indexes already checked or created in this process, keyed by (endpoint, index_name, metadata_fields)
+_known_indexes = set()
+# Those of them whose key field cannot be ordered by, see _iter_by_key
+_unsortable_key_indexes = set()
+
+
+class IndexingError(Exception):
+    """
+    Raised when sections of a document could not be indexed or deleted.
+
+    Attributes:
+        filename (str): The source file of the sections.
+        failed_ids (list): The ids of the sections that failed.
+    """
+
+    def __init__(self, filename: str, failed_ids: list):
+        self.filename = filename
+        self.failed_ids = failed_ids
+        super().__init__(f"{len(failed_ids)} sections of {filename} failed to index: {failed_ids[:5]}")
+
+
+class _IndexRun():
+    """
+    Tallies the batches of one indexing action, see CognitiveSearchHandler._index_documents.
+    """
+
+    def __init__(self, action: str):
+        self.action = action
+        self.stats = {"documents": 0, "succeeded": 0, "failed": 0, "batches": 0}
+        self.failed_keys = []
+        self.start_time = time.time()
+
+    def sent(self, batch: list):
+        self.stats["documents"] += len(batch)
+        self.stats["batches"] += 1
+
+    def collect(self, outcome: tuple):
+        succeeded, failed = outcome
+        self.stats["succeeded"] += succeeded
+        self.failed_keys.extend(failed)
+
+    def finish(self):
+        stats = self.stats
+        stats["failed"] = len(self.failed_keys)
+        stats["failed_keys"] = self.failed_keys
+        stats["seconds"] = time.time() - self.start_time
+        stats["documents_per_second"] = stats["documents"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        if self.failed_keys:
+            logger.error(f"\t{len(self.failed_keys)} sections failed to {self.action}: {self.failed_keys}")
+        logger.info(f"\t{self.action}: {stats['succeeded']}/{stats['documents']} sections in {stats['batches']} batches, "
+                    f"{stats['seconds']:.2f}s ({stats['documents_per_second']:.1f} docs/s)")
+        return stats
+
+
+class _IndexSync():
+    """
+    The diff of sync_index_documents between the sections of some files and what the index holds for them.
+
+    The indexed sections are fed to add_indexed, then changed_sections yields the sections to
+    upload and vanished returns the keys to delete. The file of every section is remembered, so
+    the failures of either action can be reported by file.
+    """
+
+    def __init__(self, sections_by_file: dict):
+        self.sections_by_file = sections_by_file
+        self.files_by_name = {os.path.basename(filename): filename for filename in sections_by_file}
+        self.indexed = {}
+        self.owners = {}
+        self.seen = set()
+        self.stats = {"uploaded": 0, "unchanged": 0, "deleted": 0, "failed": 0, "failed_ids": [], "failed_by_file": {}}
+
+    def add_indexed(self, document: dict):
+        self.indexed[document["id"]] = document.get("contenthash")
+        self.owners[document["id"]] = self.files_by_name.get(document.get("sourcefile"))
+
+    def changed_sections(self):
+        for filename, sections in self.sections_by_file.items():
+            for section in sections:
+                self.seen.add(section["id"])
+                self.owners[section["id"]] = filename
+                if self.indexed.get(section["id"]) == section["contenthash"]:
+                    self.stats["unchanged"] += 1
+                    continue
+                yield section
+
+    def uploaded(self, upload_stats: dict):
+        self.stats["uploaded"] = upload_stats["succeeded"]
+        self.stats["failed_ids"].extend(upload_stats["failed_keys"])
+
+    def vanished(self):
+        return [{"id": key} for key in self.indexed if key not in self.seen]
+
+    def deleted(self, delete_stats: dict):
+        self.stats["deleted"] = delete_stats["succeeded"]
+        self.stats["failed_ids"].extend(delete_stats["failed_keys"])
+
+    def finish(self):
+        stats = self.stats
+        stats["failed"] = len(stats["failed_ids"])
+        for key in stats["failed_ids"]:
+            stats["failed_by_file"].setdefault(self.owners.get(key), []).append(key)
+        filenames = list(self.sections_by_file)
+        logger.info(f"\tSynced {', '.join(repr(name) for name in filenames[:5])}{' ...' if len(filenames) > 5 else ''}: "
+                    f"{stats['uploaded']} sections uploaded, {stats['unchanged']} unchanged, {stats['deleted']} deleted")
+        return stats
+
+
 class CognitiveSearchHandler():
     
-    def __init__(self):
+    def __init__(self, metadata_fields: list = None):
         # TODO: THIS IS NOT THE WAY TO DO IT
         self.credential = AzureKeyCredential(os.getenv("AZURE_COGNITIVESEARCH_KEY"))
         self.endpoint = os.getenv("AZURE_COGNITIVESEARCH_ENDPOINT")
         self.index_name = os.getenv("AZURE_COGNITIVESEARCH_INDEXNAME")
+        # Extra filterable string fields set on every section, e.g. the metadata extracted by DocumentSplitter
+        self.metadata_fields = list(metadata_fields or [])
             
     # TODO: implement this later with managede identity for azure function, no time right now
     # def _ensure_crential(self):
     
     @log_function_call
     def _create_search_index_client(self):
-        self.index_client = SearchIndexClient(endpoint=self.endpoint, credential=self.credential)
+        self.index_client = get_search_index_client(endpoint=self.endpoint, credential=self.credential)
         return self.index_client
     
+    @log_function_call
+    def _index_fields(self):
+        fields = [
+            # Sortable so that keys can be read back in order, see _iter_by_key
+            SimpleField(name="id", type="Edm.String", key=True, filterable=True, sortable=True),
+            SearchableField(name="content", type="Edm.String", analyzer_name="en.microsoft"),
+            SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
+            SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
+            SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
+            SimpleField(name="contenthash", type="Edm.String")
+        ]
+        fields.extend(SimpleField(name=name, type="Edm.String", filterable=True, facetable=True)
+                      for name in self.metadata_fields)
+        return fields
+
+    @log_function_call
+    def _new_search_index(self, fields):
+        return SearchIndex(
+            name=self.index_name,
+            fields=fields,
+            semantic_settings=SemanticSettings(
+                configurations=[SemanticConfiguration(
+                    name='default',
+                    prioritized_fields=PrioritizedFields(
+                        title_field=None, prioritized_content_fields=[SemanticField(field_name='content')]))])
+        )
+
+    def _index_key(self):
+        return (self.endpoint, self.index_name, tuple(self.metadata_fields))
+
+    @log_function_call
+    def _missing_fields(self, search_index, fields):
+        """
+        Returns the fields that an existing index lacks, and adds them to search_index.
+
+        Fields can be added to an existing index, so indexes created before a field was introduced get it this way.
+        """
+        self._check_key_field(search_index)
+        existing_fields = {field.name for field in search_index.fields}
+        missing_fields = [field for field in fields if field.name not in existing_fields]
+        if missing_fields:
+            logger.debug(f"Adding fields {[field.name for field in missing_fields]} to search index {self.index_name}")
+            search_index.fields.extend(missing_fields)
+        return missing_fields
+
     @log_function_call
     def create_search_index(self):
+        index_key = self._index_key()
+        if index_key in _known_indexes:
+            return
         logger.debug(f"Ensuring search index {self.index_name} exists")
         self._create_search_index_client()
+        fields = self._index_fields()
         if self.index_name not in self.index_client.list_index_names():
-            search_index = SearchIndex(
-                name=self.index_name,
-                fields=[
-                    SimpleField(name="id", type="Edm.String", key=True),
-                    SearchableField(name="content", type="Edm.String", analyzer_name="en.microsoft"),
-                    SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
-                    SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
-                    SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True)
-                ],
-                semantic_settings=SemanticSettings(
-                    configurations=[SemanticConfiguration(
-                        name='default',
-                        prioritized_fields=PrioritizedFields(
-                            title_field=None, prioritized_content_fields=[SemanticField(field_name='content')]))])
-            )
+            search_index = self._new_search_index(fields)
             logger.debug(f"Creating {self.index_name} search index")
-            self._index_client.create_index(search_index)
+            self.index_client.create_index(search_index)
         else:
             logger.debug(f"Search index {self.index_name} already exists")
+            search_index = self.index_client.get_index(self.index_name)
+            if self._missing_fields(search_index, fields):
+                self.index_client.create_or_update_index(search_index)
+        _known_indexes.add(index_key)
     
+    @log_function_call
+    def _check_key_field(self, search_index):
+        # The attributes of an existing field cannot be changed, the index has to be rebuilt to get a sortable id
+        for field in search_index.fields:
+            if field.key and not field.sortable:
+                logger.error(f"The key field of search index {self.index_name} is not sortable, keys are read back "
+                             f"unordered, without the guarantees of paging by key, until the index is recreated")
+                _unsortable_key_indexes.add(self._index_key())
+
+    def _keys_sortable(self):
+        return self._index_key() not in _unsortable_key_indexes
+
     @log_function_call
     def _create_search_client(self):
         self.create_search_index()
-        self.search_client = SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
+        self.search_client = get_search_client(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
         return self.search_client
             
     @log_function_call
-    def upload_index_document(self, filename: str, sections: any):
-        logger.debug(f"Indexing sections from '{filename}' into search index '{self.index_name}'")
-        self._create_search_client(index_name=self.index_name)
-        i = 0
+    def _iter_batches(self, documents, batch_size: int, max_batch_bytes: int):
+        """
+        Groups documents into batches limited by both document count and serialized size.
+        """
         batch = []
-        for s in sections:
-            batch.append(s)
-            i += 1
-            if i % 1000 == 0:
-                results = self._search_client.upload_documents(documents=batch)
-                succeeded = sum([1 for r in results if r.succeeded])
-                logger.debug(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        batch_bytes = 0
+        for document in documents:
+            # json.dumps escapes non-ASCII characters, which overestimates rather than underestimates
+            document_bytes = len(json.dumps(document)) + len('"@search.action":"mergeOrUpload",')
+            if batch and (len(batch) >= batch_size or batch_bytes + document_bytes > max_batch_bytes):
+                yield batch
                 batch = []
+                batch_bytes = 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            yield batch
+
+    @log_function_call
+    def _send_batch(self, batch: list, action: str, max_retries: int, retry_delay: float):
+        """
+        Sends one batch, resubmitting only the documents that failed with a retryable status.
 
-        if len(batch) > 0:
-            results = self._search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            logger.debug(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        Returns:
+            tuple: The number of succeeded documents and the keys of the documents that failed.
+        """
+        send = getattr(self.search_client, f"{action}_documents")
+        pending = batch
+        succeeded = 0
+        failed_keys = []
+        for attempt in range(max_retries + 1):
+            try:
+                results = send(documents=pending)
+            except HttpResponseError as e:
+                self._check_retryable(e, attempt, max_retries, pending)
+            else:
+                succeeded += sum([1 for r in results if r.succeeded])
+                given_up, pending = self._retry_pending(results, pending, attempt, max_retries)
+                failed_keys.extend(given_up)
+                if pending is None:
+                    return succeeded, sorted(failed_keys)
+            time.sleep(retry_delay * (2 ** attempt))
+
+    def _check_retryable(self, error: HttpResponseError, attempt: int, max_retries: int, pending: list):
+        """
+        Raises error unless the whole indexing request is worth sending again.
+        """
+        if error.status_code not in RETRYABLE_STATUS_CODES or attempt == max_retries:
+            raise error
+        logger.warning(f"Indexing request failed with {error.status_code}, retrying {len(pending)} sections")
+
+    def _retry_pending(self, results: list, pending: list, attempt: int, max_retries: int):
+        """
+        Returns the keys of the sections that failed for good in this attempt, and the sections of pending
+        to send again or None when the batch is done.
+
+        The sections that failed without a retryable status are given up on right away, so their keys
+        have to be kept across attempts, the retry only sends the others.
+        """
+        failed_keys = {r.key for r in results if not r.succeeded}
+        retry_keys = {r.key for r in results if not r.succeeded and r.status_code in RETRYABLE_STATUS_CODES}
+        if not retry_keys or attempt == max_retries:
+            return sorted(failed_keys), None
+        if failed_keys != retry_keys:
+            logger.error(f"\tSections failed without retry: {sorted(failed_keys - retry_keys)}")
+        return sorted(failed_keys - retry_keys), [d for d in pending if d["id"] in retry_keys]
+
+    @log_function_call
+    def _index_documents(self, documents, action: str = "upload", batch_size: int = MAX_BATCH_DOCUMENTS,
+                         max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4,
+                         max_retries: int = 3, retry_delay: float = 1):
+        """
+        Runs an indexing action over documents with several batches in flight at once.
+
+        documents may be a generator; it is consumed lazily, so memory stays bounded by
+        max_concurrency + 1 batches and the first batch is sent before the producer has finished.
+
+        Returns:
+            dict: The number of documents sent, succeeded and failed, the keys of the failed ones, and the throughput.
+        """
+        run = _IndexRun(action)
+        with stage("index"), ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            in_flight = set()
+            for batch in self._iter_batches(documents, batch_size, max_batch_bytes):
+                if len(in_flight) >= max_concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        run.collect(future.result())
+                in_flight.add(executor.submit(self._send_batch, batch, action, max_retries, retry_delay))
+                run.sent(batch)
+            for future in wait(in_flight)[0]:
+                run.collect(future.result())
+        return run.finish()
 
     @log_function_call
-    def remove_from_index(self, filename: str = None):
-        logger.debug(f"Removing sections from '{filename or '<all>'}' from search index '{self.index_name}'")
-        self._create_search_client(index_name=self.index_name)
+    def upload_index_document(self, filename: str, sections: any, batch_size: int = MAX_BATCH_DOCUMENTS,
+                              max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4, max_retries: int = 3):
+        """
+        Uploads sections to the search index in batches as they are produced.
+
+        Batches are cut by both section count and payload size and up to max_concurrency of them
+        are sent at once. Sections that fail with a retryable status are resubmitted with backoff.
+        """
+        logger.debug(f"Indexing sections from '{filename}' into search index '{self.index_name}'")
+        self._create_search_client()
+        return self._index_documents(sections, action="upload", batch_size=batch_size, max_batch_bytes=max_batch_bytes,
+                                     max_concurrency=max_concurrency, max_retries=max_retries)
+
+    @log_function_call
+    def _odata_string(self, value: str):
+        return "'" + value.replace("'", "''") + "'"
+
+    @log_function_call
+    def _key_page_filter(self, filter: str, last_key: str):
+        """
+        Returns filter restricted to the keys after last_key, for the next page of _iter_by_key.
+        """
+        if last_key is None:
+            return filter
+        after = f"id gt {self._odata_string(last_key)}"
+        return after if filter is None else f"({filter}) and {after}"
+
+    @log_function_call
+    def _iter_by_key(self, filter: str, select: list, page_size: int = KEY_PAGE_SIZE):
+        """
+        Yields every document matching filter in key order, one query per page of page_size.
+
+        Each page starts after the last key of the previous one rather than at a $skip offset,
+        so the results are deterministic and not capped by the limit the service puts on $skip.
+        Indexes created before the key was made sortable cannot be ordered by it, their documents
+        are read with one unordered search instead.
+        """
+        if not self._keys_sortable():
+            yield from self.search_client.search("", filter=filter, select=select)
+            return
+        last_key = None
         while True:
-            filter = None if filename == None else f"sourcefile eq '{os.path.basename(filename)}'"
-            r = self._search_client.search("", filter=filter, top=1000, include_total_count=True)
-            if r.get_count() == 0:
-                break
-            r = self._search_client.delete_documents(documents=[{"id": d["id"]} for d in r])
-            logger.debug(f"\tRemoved {len(r)} sections from index")
-            # It can take a few seconds for search results to reflect changes, so wait a bit
-            time.sleep(2)
+            page = list(self.search_client.search("", filter=self._key_page_filter(filter, last_key), select=select,
+                                                  order_by=["id"], top=page_size))
+            yield from page
+            if len(page) < page_size:
+                return
+            last_key = page[-1]["id"]
+
+    @log_function_call
+    def get_indexed_hashes(self, filename: any):
+        """
+        Returns the content hash of every section indexed for filename, or for a list of filenames, keyed by section id.
+        """
+        filenames = [filename] if isinstance(filename, str) else filename
+        self._create_search_client()
+        results = self._iter_by_key(self._sourcefile_filter(filenames), select=["id", "contenthash"])
+        return {r["id"]: r.get("contenthash") for r in results}
+
+    @log_function_call
+    def sync_index_document(self, filename: str, sections: any, batch_size: int = MAX_BATCH_DOCUMENTS,
+                            max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4, max_retries: int = 3):
+        """
+        Brings the indexed sections of filename in line with sections, touching only what changed.
+
+        Sections must carry a contenthash. Those whose id is not indexed yet or whose hash differs
+        from the indexed one are merged or uploaded, those with the same hash are skipped, and
+        indexed sections whose id no longer appears are deleted.
+
+        Returns:
+            dict: The number of sections uploaded, unchanged, deleted and failed, and the ids of the failed ones.
+        """
+        return self.sync_index_documents({filename: sections}, batch_size=batch_size, max_batch_bytes=max_batch_bytes,
+                                         max_concurrency=max_concurrency, max_retries=max_retries)
+
+    @log_function_call
+    def sync_index_documents(self, sections_by_file: dict, batch_size: int = MAX_BATCH_DOCUMENTS,
+                             max_batch_bytes: int = MAX_BATCH_BYTES, max_concurrency: int = 4, max_retries: int = 3):
+        """
+        Same as sync_index_document for several files at once.
+
+        The indexed hashes of all files are read with one query, and the changed sections of all
+        files are sent through one batcher, so small documents share full-size batches instead of
+        each sending its own.
+
+        Args:
+            sections_by_file (dict): The sections of each file, keyed by filename.
+
+        Returns:
+            dict: The statistics of sync_index_document, with the ids of the failed sections also by filename.
+        """
+        logger.debug(f"Syncing sections from {len(sections_by_file)} files into search index '{self.index_name}'")
+        self._create_search_client()
+        sync = _IndexSync(sections_by_file)
+        for r in self._iter_by_key(self._sourcefile_filter(list(sections_by_file)), select=["id", "contenthash", "sourcefile"]):
+            sync.add_indexed(r)
+        sync.uploaded(self._index_documents(sync.changed_sections(), action="merge_or_upload", batch_size=batch_size,
+                                            max_batch_bytes=max_batch_bytes, max_concurrency=max_concurrency,
+                                            max_retries=max_retries))
+        vanished = sync.vanished()
+        if vanished:
+            sync.deleted(self._index_documents(vanished, action="delete", max_concurrency=max_concurrency,
+                                               max_retries=max_retries))
+        return sync.finish()
+
+    @log_function_call
+    def _sourcefile_filter(self, filenames: list):
+        names = [os.path.basename(name) for name in filenames]
+        if len(names) == 1:
+            return f"sourcefile eq {self._odata_string(names[0])}"
+        if any("|" in name for name in names):
+            return " or ".join(f"sourcefile eq {self._odata_string(name)}" for name in names)
+        return f"search.in(sourcefile, {self._odata_string('|'.join(names))}, '|')"
+
+    def _files_to_remove(self, filename: any):
+        """
+        Returns filename as a list, None for the whole index and an empty list for no file at all.
+        """
+        filenames = [filename] if isinstance(filename, str) else filename
+        if filenames is not None:
+            filenames = list(filenames)
+        if filenames != []:
+            logger.debug(f"Removing sections from '{filenames or '<all>'}' from search index '{self.index_name}'")
+        return filenames
+
+    @log_function_call
+    def _count(self, filter: str):
+        return self.search_client.search("", filter=filter, top=0, include_total_count=True).get_count()
+
+    @log_function_call
+    def remove_from_index(self, filename: any = None, max_concurrency: int = 4, confirm: bool = True, timeout: float = 30):
+        """
+        Deletes every section of one or more source files, or of the whole index when filename is None.
+
+        An empty list of source files deletes nothing. Only the id field is read back. All matching keys are collected before the first delete,
+        so paging never shifts under concurrent deletions, and the deletes run on the concurrent
+        batcher. With confirm, the remaining count is polled with a growing interval until it
+        reaches zero or timeout seconds have passed.
+
+        Args:
+            filename (str or list): The source file, or list of source files, to remove.
+
+        Returns:
+            dict: The number of sections deleted and, with confirm, still visible in the index.
+        """
+        stats = {"deleted": 0, "remaining": None}
+        filenames = self._files_to_remove(filename)
+        if filenames == []:
+            return stats
+        self._create_search_client()
+        filter = None if filenames is None else self._sourcefile_filter(filenames)
+        keys = [r["id"] for r in self._iter_by_key(filter, select=["id"])]
+        if keys:
+            delete_stats = self._index_documents(({"id": key} for key in keys), action="delete",
+                                                 max_concurrency=max_concurrency)
+            stats["deleted"] = delete_stats["succeeded"]
+            logger.debug(f"\tRemoved {stats['deleted']} sections from index")
+        if confirm:
+            # It can take a moment for search results to reflect changes, poll instead of waiting a fixed time
+            deadline = time.time() + timeout
+            delay = 0.25
+            stats["remaining"] = self._count(filter)
+            while stats["remaining"] > 0 and time.time() < deadline:
+                time.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay *= 2
+                stats["remaining"] = self._count(filter)
+            if stats["remaining"] > 0:
+                logger.warning(f"\t{stats['remaining']} sections still visible in index after {timeout}s")
+        return stats
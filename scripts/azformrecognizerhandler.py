@@ -1,16 +1,75 @@
 import os
 import logging
+import pypdf
 from common import logger_config, log_function_call
+from instrumentation import stage
 from azure.identity import ClientSecretCredential, DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from clientregistry import get_default_credential, get_document_analysis_client
+from analyzecache import AnalyzeResultCache, analyze_result_from_dict
+from analysisscheduler import AnalysisScheduler, ScheduledPolling
 
 
 logger_config()
 logger = logging.getLogger("file")
 
+
+@log_function_call
+def merge_analyze_results(partials: list, first_pages: list):
+    """
+    Merges the results of analyzing consecutive page ranges of one document into a single result.
+
+    The contents are joined with a newline, and every span offset of a partial result is moved
+    by the length of the content before it. Page numbers, including those of bounding regions,
+    are made absolute when the service numbered the range from 1.
+
+    Args:
+        partials (list): The AnalyzeResult of each range, in page order.
+        first_pages (list): The first page number of each range.
+
+    Returns:
+        AnalyzeResult: The result as if the whole document had been analyzed at once.
+    """
+    def _shift(value, offset_shift, page_shift):
+        if isinstance(value, list):
+            return [_shift(item, offset_shift, page_shift) for item in value]
+        if not isinstance(value, dict):
+            return value
+        shifted = {key: _shift(item, offset_shift, page_shift) for key, item in value.items()}
+        if "offset" in shifted and "length" in shifted and isinstance(shifted["offset"], int):
+            shifted["offset"] += offset_shift
+        if isinstance(shifted.get("page_number"), int):
+            shifted["page_number"] += page_shift
+        return shifted
+
+    merged = None
+    for partial, first_page in zip(partials, first_pages):
+        data = partial.to_dict()
+        page_numbers = [page["page_number"] for page in data.get("pages") or []]
+        page_shift = first_page - min(page_numbers) if page_numbers else 0
+        if merged is None:
+            merged = _shift(data, 0, page_shift)
+            merged["content"] = merged.get("content") or ""
+            continue
+        offset_shift = len(merged["content"]) + 1
+        data = _shift(data, offset_shift, page_shift)
+        merged["content"] += "\n" + (data.get("content") or "")
+        for key, value in data.items():
+            if isinstance(value, list):
+                merged[key] = (merged.get(key) or []) + value
+    merged["pages"] = sorted(merged.get("pages") or [], key=lambda page: page["page_number"])
+    return analyze_result_from_dict(merged)
+
+
 class FormRecognizerHandler():
-    def __init__(self):
+    def __init__(self, cache: AnalyzeResultCache = None):
+        self.model_id = "prebuilt-document"
+        # PDFs with more pages are analyzed as ranges of this many pages, at most range_concurrency at a time
+        self.pages_per_range = int(os.getenv("FORMRECOGNIZER_PAGES_PER_RANGE") or 100)
+        self.range_concurrency = int(os.getenv("FORMRECOGNIZER_RANGE_CONCURRENCY") or 4)
+        # Results of documents analyzed before, by blob ETag, see AnalyzeResultCache
+        self.cache = cache
         endpoint = os.getenv("AZ_FORMRECOGNIZER_ENDPOINT")
         if endpoint == None or endpoint == "":
             logger.error("Form Recognizer endpoint is not defined")
@@ -29,8 +88,8 @@ class FormRecognizerHandler():
         AzureKeyCredential with the value of the environment variable as the credential.
         2. If the environment variable is not set, checks if the sp (Service Principal) parameter
         is provided. If it is, uses it as the credential.
-        3. If neither the environment variable nor the sp parameter is set, uses DefaultAzureCredential
-        to automatically obtain the appropriate credential.
+        3. If neither the environment variable nor the sp parameter is set, uses the process-wide
+        DefaultAzureCredential from the client registry to automatically obtain the appropriate credential.
 
         Returns:
             TokenCredential: The credential attribute.
@@ -38,11 +97,14 @@ class FormRecognizerHandler():
         if not hasattr(self, "credential"):
             env_cred = os.getenv("AZ_FORMRECOGNIZER_KEY")
             if env_cred == None:
-                if sp == None: self.credential = DefaultAzureCredential()
+                if sp == None: self.credential = self._default_credential()
                 else: self.credential = sp
             else: self.credential = AzureKeyCredential(env_cred)
 
         return self.credential
+
+    def _default_credential(self):
+        return get_default_credential()
     
     @log_function_call
     def create_formrecognizer_client(self):
@@ -50,15 +112,16 @@ class FormRecognizerHandler():
         Creates and returns a FormRecognizer client.
 
         This method ensures the existence of the credential attribute by calling the
-        _ensure_crendetial method. Then, it creates a DocumentAnalysisClient using the
-        endpoint from the service_info dictionary and the credential. Finally, it returns
-        the created FormRecognizer client.
+        _ensure_crendetial method. Then, it gets the DocumentAnalysisClient for the endpoint
+        from the service_info dictionary and the credential from the client registry, which
+        reuses one client per endpoint and credential across invocations. Finally, it returns
+        the FormRecognizer client.
 
         Returns:
             DocumentAnalysisClient: The created FormRecognizer client.
         """
         self._ensure_crendetial()
-        self.formrecognizer_client = DocumentAnalysisClient(endpoint=self.service_info["endpoint"], credential=self.credential)
+        self.formrecognizer_client = get_document_analysis_client(endpoint=self.service_info["endpoint"], credential=self.credential)
         return self.formrecognizer_client
     
     @log_function_call
@@ -86,18 +149,139 @@ class FormRecognizerHandler():
 
         return self.formrecognizer_client
     
-    def analyze_document(self, document_url):
+    @log_function_call
+    def _cache_key(self, source: str, etag: str):
+        if self.cache is None or not etag:
+            return None
+        return self.cache.make_key(source, etag, self.model_id)
+
+    def _document_cache_key(self, document):
+        return None if isinstance(document, str) else self._cache_key(document.source, document.etag)
+
+    def _begin_arguments(self, document, pages: str = None):
+        """
+        Returns the name of the client method that starts the analysis of document, and its arguments.
+        """
+        if isinstance(document, str):
+            return "begin_analyze_document_from_url", {"model_id": self.model_id, "document_url": document}
+        arguments = {"model_id": self.model_id, "document": document.open()}
+        if pages is not None:
+            arguments["pages"] = pages
+        return "begin_analyze_document", arguments
+
+    def _begin(self, document, pages: str = None, **kwargs):
+        method, arguments = self._begin_arguments(document, pages)
+        return getattr(self.formrecognizer_client, method)(**arguments, **kwargs)
+
+    @log_function_call
+    def _page_ranges(self, document):
+        """
+        Splits a downloaded PDF into (first, last) page ranges, or returns None when it is analyzed whole.
+        """
+        if not self.pages_per_range:
+            return None
+        try:
+            page_count = len(pypdf.PdfReader(document.open()).pages)
+        except Exception as e:
+            logger.debug(f"Not splitting {document.source} into page ranges: {e}")
+            return None
+        if page_count <= self.pages_per_range:
+            return None
+        return [(first, min(first + self.pages_per_range - 1, page_count))
+                for first in range(1, page_count + 1, self.pages_per_range)]
+
+    @log_function_call
+    def _begin_scheduled(self, document, pages: str = None):
+        """
+        Starts the analysis of a document without polling it, and returns its polling method for an AnalysisScheduler.
+        """
+        self._ensure_formrecognizer_client()
+        polling = ScheduledPolling(path_format_arguments={"endpoint": self.service_info["endpoint"].rstrip("/")})
+        return self._begin(document, pages, polling=polling).polling_method()
+
+    @log_function_call
+    def _analyze_in_ranges(self, document, page_ranges):
+        """
+        Analyzes the page ranges concurrently, with at most range_concurrency operations in flight, and merges the results.
+        """
+        logger.info(f"Analyzing {document.source} as {len(page_ranges)} page ranges")
+        scheduler = AnalysisScheduler(max_in_flight=self.range_concurrency)
+        partials = {}
+        for page_range, result, error in scheduler.run(page_ranges,
+                                                       lambda page_range: self._begin_scheduled(document, pages=f"{page_range[0]}-{page_range[1]}")):
+            if error is not None:
+                raise error
+            partials[page_range] = result
+        return merge_analyze_results([partials[page_range] for page_range in page_ranges],
+                                     [first for first, _ in page_ranges])
+
+    @log_function_call
+    def analyze_documents(self, documents, scheduler: AnalysisScheduler = None):
+        """
+        Analyzes many documents at once and yields (document, result, error) as each analysis completes.
+
+        The analyses are started up front and polled together by one AnalysisScheduler, which caps
+        the operations in flight and adapts its polling interval, instead of one blocking poller
+        per document. Documents already in the cache are yielded first without an analysis, and
+        new results are added to it. A document that fails is yielded with its exception.
+
+        Args:
+            documents (iterable): URLs of documents, or BlobBuffers already downloaded.
+            scheduler (AnalysisScheduler): The scheduler to use, one configured from the environment by default.
+        """
+        scheduler = scheduler or AnalysisScheduler()
+        to_analyze = []
+        for document in documents:
+            cache_key = self._document_cache_key(document)
+            cached = self.cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                yield document, cached, None
+            else:
+                to_analyze.append((document, cache_key))
+        if not to_analyze:
+            return
+        logger.info(f"Analyzing {len(to_analyze)} documents, at most {scheduler.max_in_flight} at a time")
+        for (document, cache_key), result, error in scheduler.run(to_analyze, lambda item: self._begin_scheduled(item[0])):
+            if error is None and cache_key is not None:
+                self.cache.put(cache_key, result)
+            yield document, result, error
+
+    @log_function_call
+    def analyze_blob(self, blob_handler):
+        """
+        Analyzes the blob of blob_handler, downloading it only when its ETag is not in the cache.
+
+        Returns:
+            DocumentAnalysisResult: The result of the document analysis.
+        """
+        if self.cache is not None:
+            properties = blob_handler.get_blob_properties()
+            cached = self.cache.get(self._cache_key(blob_handler.blob_url, properties.etag))
+            if cached is not None:
+                logger.info(f"Using the cached analysis of {blob_handler.blob_url}")
+                self.result = cached
+                return self.result
+        # Already looked up, the result is still added to the cache
+        return self.analyze_document(blob_handler.download_to_buffer(), use_cache=False)
+
+    def analyze_document(self, document, use_cache: bool = True):
         """
-        Analyzes a document located at the specified URL.
+        Analyzes a document given by URL or as a BlobBuffer already downloaded.
 
-        This method ensures the existence of the formrecognizer_client attribute by calling the
+        A BlobBuffer whose ETag was analyzed before is answered from the cache when one is set
+        and use_cache is true, and a new result is added to it. Otherwise, this method ensures
+        the existence of the formrecognizer_client attribute by calling the
         _ensure_formrecognizer_client method. Then, it initiates the document analysis by calling
-        begin_analyze_document_from_url on the formrecognizer_client with the model_id and document_url
-        parameters. It waits for the analysis result by calling poller.result(). Finally, it returns
-        the analysis result.
+        begin_analyze_document_from_url on the formrecognizer_client with the model_id and document
+        URL, or begin_analyze_document with a read-only stream over the buffer so the service does
+        not have to fetch the file again. A PDF of more than pages_per_range pages is analyzed as
+        page ranges running concurrently, whose results are merged, see merge_analyze_results.
+        It waits for the analysis result by calling poller.result().
+        Finally, it returns the analysis result.
 
         Args:
-            document_url (str): The URL of the document to analyze.
+            document (str or BlobBuffer): The URL of the document, or its downloaded content.
+            use_cache (bool): Whether to look the document up in the cache first.
 
         Returns:
             DocumentAnalysisResult: The result of the document analysis.
@@ -107,9 +291,21 @@ class FormRecognizerHandler():
 
         """
         try:
+            cache_key = self._document_cache_key(document)
+            if cache_key is not None and use_cache:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    self.result = cached
+                    return self.result
             self._ensure_formrecognizer_client()
-            poller = self.formrecognizer_client.begin_analyze_document_from_url(model_id="prebuilt-document", document_url=document_url)
-            self.result = poller.result()
+            with stage("analyze"):
+                page_ranges = None if isinstance(document, str) else self._page_ranges(document)
+                if page_ranges:
+                    self.result = self._analyze_in_ranges(document, page_ranges)
+                else:
+                    self.result = self._begin(document).result()
+            if cache_key is not None:
+                self.cache.put(cache_key, self.result)
             return self.result
         except Exception as e:
             logger.error("Error occurred during document analysis: %s", str(e))
@@ -0,0 +1,337 @@
+import time
+import asyncio
+import hashlib
+import logging
+import weakref
+import threading
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from common import logger_config, log_function_call
+from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.core.credentials import AzureKeyCredential, AzureSasCredential
+from azure.core.pipeline.transport import RequestsTransport, AioHttpTransport
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
+from azure.search.documents.indexes import SearchIndexClient
+from azure.search.documents.indexes.aio import SearchIndexClient as AsyncSearchIndexClient
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+# Connections kept open per host in the shared pool
+POOL_MAXSIZE = 32
+
+_clients = {}
+_credentials = {}
+_lock = threading.RLock()
+_session = None
+# aio clients are bound to the event loop they were created on, so they are shared per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+class CachedTokenCredential():
+    """
+    Wraps a TokenCredential so that every client in the process shares its access tokens.
+
+    A token is fetched once per set of scopes and reused until it is within REFRESH_BEFORE_EXPIRY
+    seconds of expiring, at which point the next caller refreshes it ahead of the deadline
+    instead of every client waiting for its own token to lapse.
+    """
+    REFRESH_BEFORE_EXPIRY = 300
+
+    def __init__(self, credential):
+        self.credential = credential
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, token):
+        return token is not None and token.expires_on - time.time() > self.REFRESH_BEFORE_EXPIRY
+
+    def get_token(self, *scopes, **kwargs):
+        # Claims challenges always need a new token
+        if kwargs.get("claims"):
+            return self.credential.get_token(*scopes, **kwargs)
+        key = (scopes, kwargs.get("tenant_id"))
+        token = self._tokens.get(key)
+        if not self._is_fresh(token):
+            with self._lock:
+                token = self._tokens.get(key)
+                if not self._is_fresh(token):
+                    token = self.credential.get_token(*scopes, **kwargs)
+                    self._tokens[key] = token
+        return token
+
+    def close(self):
+        # Shared for the lifetime of the process, clients must not close it
+        pass
+
+
+class AsyncCachedTokenCredential(CachedTokenCredential):
+    """
+    CachedTokenCredential for the async credentials of azure.identity.aio, whose get_token is a coroutine.
+
+    Like the aio clients, it belongs to the event loop it was created on.
+    """
+
+    def __init__(self, credential):
+        super().__init__(credential)
+        self._lock = asyncio.Lock()
+
+    async def get_token(self, *scopes, **kwargs):
+        if kwargs.get("claims"):
+            return await self.credential.get_token(*scopes, **kwargs)
+        key = (scopes, kwargs.get("tenant_id"))
+        token = self._tokens.get(key)
+        if not self._is_fresh(token):
+            async with self._lock:
+                token = self._tokens.get(key)
+                if not self._is_fresh(token):
+                    token = await self.credential.get_token(*scopes, **kwargs)
+                    self._tokens[key] = token
+        return token
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def _credential_key(credential):
+    """
+    Identifies a credential by its secret for key and SAS credentials, by identity otherwise.
+    """
+    def _digest(secret):
+        return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+    if credential is None:
+        return None
+    if isinstance(credential, str):
+        return ("str", _digest(credential))
+    if isinstance(credential, AzureKeyCredential):
+        return ("key", _digest(credential.key))
+    if isinstance(credential, AzureSasCredential):
+        return ("sas", _digest(credential.signature))
+    return ("token", id(credential))
+
+
+def _shared_credential(credential):
+    """
+    Returns the credential to hand to a client, wrapping token credentials in a CachedTokenCredential.
+    """
+    if credential is None or not hasattr(credential, "get_token") or isinstance(credential, CachedTokenCredential):
+        return credential
+    key = id(credential)
+    with _lock:
+        if key not in _credentials:
+            _credentials[key] = (credential, CachedTokenCredential(credential))
+        return _credentials[key][1]
+
+
+def _transport():
+    """
+    Returns a transport on the process-wide requests session, so all clients share one connection pool.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return RequestsTransport(session=_session, session_owner=False)
+
+
+@log_function_call
+def use_session(session: requests.Session):
+    """
+    Sends the requests of every sync client created from now on through session.
+
+    The clients created so far are forgotten. This is the hook for running against local
+    stand-ins of the services, by mounting a transport adapter that serves their requests.
+    """
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = session
+
+
+def _get_client(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                logger.debug(f"Creating shared {key[0]} client for {key[1]}")
+                client = factory()
+                _clients[key] = client
+    return client
+
+
+@log_function_call
+def get_default_credential():
+    """
+    Returns the process-wide DefaultAzureCredential, with token caching.
+    """
+    with _lock:
+        if "default" not in _credentials:
+            _credentials["default"] = (None, CachedTokenCredential(DefaultAzureCredential()))
+        return _credentials["default"][1]
+
+
+@log_function_call
+def get_blob_service_client(account_url: str, credential):
+    key = ("blob", account_url, _credential_key(credential))
+    return _get_client(key, lambda: BlobServiceClient(account_url=account_url,
+                                                      credential=_shared_credential(credential),
+                                                      transport=_transport()))
+
+
+@log_function_call
+def get_document_analysis_client(endpoint: str, credential):
+    key = ("formrecognizer", endpoint, _credential_key(credential))
+    return _get_client(key, lambda: DocumentAnalysisClient(endpoint=endpoint,
+                                                           credential=_shared_credential(credential),
+                                                           transport=_transport()))
+
+
+@log_function_call
+def get_search_index_client(endpoint: str, credential):
+    key = ("searchindex", endpoint, _credential_key(credential))
+    return _get_client(key, lambda: SearchIndexClient(endpoint=endpoint,
+                                                      credential=_shared_credential(credential),
+                                                      transport=_transport()))
+
+
+@log_function_call
+def get_search_client(endpoint: str, index_name: str, credential):
+    key = ("search", f"{endpoint}/indexes/{index_name}", _credential_key(credential))
+    return _get_client(key, lambda: SearchClient(endpoint=endpoint, index_name=index_name,
+                                                 credential=_shared_credential(credential),
+                                                 transport=_transport()))
+
+
+def _loop_clients():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.get(loop)
+        if clients is None:
+            clients = _async_clients[loop] = {}
+        return clients
+
+
+def _get_async_client(key, factory):
+    """
+    Same as _get_client for aio clients, which are shared by the tasks of the running event loop only.
+    """
+    clients = _loop_clients()
+    client = clients.get(key)
+    if client is None:
+        with _lock:
+            client = clients.get(key)
+            if client is None:
+                logger.debug(f"Creating shared {key[0]} client for {key[1]}")
+                client = factory()
+                clients[key] = client
+    return client
+
+
+def get_aiohttp_session():
+    """
+    Returns the aiohttp session of the running event loop, shared by every aio client and by the OpenAI calls.
+    """
+    return _get_async_client(("aiohttp", None), lambda: aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=POOL_MAXSIZE)))
+
+
+def _async_transport():
+    return AioHttpTransport(session=get_aiohttp_session(), session_owner=False)
+
+
+def _shared_async_credential(credential):
+    """
+    Same as _shared_credential for the aio clients, the token cache is shared by the tasks of the running event loop.
+    """
+    if credential is None or not hasattr(credential, "get_token") or isinstance(credential, AsyncCachedTokenCredential):
+        return credential
+    return _get_async_client(("credential", id(credential)), lambda: AsyncCachedTokenCredential(credential))
+
+
+@log_function_call
+def get_async_default_credential():
+    """
+    Returns the DefaultAzureCredential of azure.identity.aio for the running event loop, with token caching.
+    """
+    return _get_async_client(("credential", "default"), lambda: AsyncCachedTokenCredential(AsyncDefaultAzureCredential()))
+
+
+@log_function_call
+def get_async_blob_service_client(account_url: str, credential):
+    key = ("aio-blob", account_url, _credential_key(credential))
+    return _get_async_client(key, lambda: AsyncBlobServiceClient(account_url=account_url,
+                                                                 credential=_shared_async_credential(credential),
+                                                                 transport=_async_transport()))
+
+
+@log_function_call
+def get_async_document_analysis_client(endpoint: str, credential):
+    key = ("aio-formrecognizer", endpoint, _credential_key(credential))
+    return _get_async_client(key, lambda: AsyncDocumentAnalysisClient(endpoint=endpoint,
+                                                                      credential=_shared_async_credential(credential),
+                                                                      transport=_async_transport()))
+
+
+@log_function_call
+def get_async_search_index_client(endpoint: str, credential):
+    key = ("aio-searchindex", endpoint, _credential_key(credential))
+    return _get_async_client(key, lambda: AsyncSearchIndexClient(endpoint=endpoint,
+                                                                 credential=_shared_async_credential(credential),
+                                                                 transport=_async_transport()))
+
+
+@log_function_call
+def get_async_search_client(endpoint: str, index_name: str, credential):
+    key = ("aio-search", f"{endpoint}/indexes/{index_name}", _credential_key(credential))
+    return _get_async_client(key, lambda: AsyncSearchClient(endpoint=endpoint, index_name=index_name,
+                                                            credential=_shared_async_credential(credential),
+                                                            transport=_async_transport()))
+
+
+@log_function_call
+def clear():
+    """
+    Forgets every shared client and credential, the next request creates new ones.
+    """
+    global _session
+    with _lock:
+        _clients.clear()
+        _credentials.clear()
+        _async_clients.clear()
+        _session = None
+
+
+async def aclose():
+    """
+    Closes the aio clients and the aiohttp session of the running event loop.
+    """
+    with _lock:
+        clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    session = clients.pop(("aiohttp", None), None)
+    for key, client in clients.items():
+        if key == ("credential", "default"):
+            # The wrapper does not close, as clients must not close a shared credential
+            await client.credential.close()
+        elif not isinstance(client, AsyncCachedTokenCredential):
+            await client.close()
+    if session is not None:
+        await session.close()
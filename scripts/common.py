@@ -3,12 +3,17 @@ import logging.config
 import os.path
 import time
 import inspect
+import functools
 from datetime import datetime
+from instrumentation import metrics
 
 
 # Set default log configuration file path and log folder
 cur_dir = os.path.dirname(__file__)
 
+# Log the arguments and result of every decorated call, this formats whole documents so keep it for debugging
+log_function_calls = (os.getenv("LOG_FUNCTION_CALLS") or "").lower() in ("1", "true", "yes")
+
 
 def convert_to_realpath(path):
     """
@@ -51,21 +56,82 @@ def logger_config(config_filepath=default_log_config):
 
 def log_function_call(func):
     """
-    Decorator for debugging
+    Decorator for debugging and instrumentation
+    Records the latency of each call in the instrumentation histograms when they are enabled,
+    logs arguments and results at DEBUG level when LOG_FUNCTION_CALLS is set
+    With both off a call costs two flag checks on top of the function itself
     """
+    try:
+        file_name = os.path.basename(inspect.getfile(func))
+    except TypeError:
+        file_name = "<unknown>"
+    metric_name = f"function.{os.path.splitext(file_name)[0]}.{func.__qualname__}"
+
+    if inspect.iscoroutinefunction(func):
+        return _log_coroutine_call(func, file_name, metric_name)
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
+        if not log_function_calls and not metrics.enabled:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                logging.exception('%s - %s - end function with Exception: %s', func.__name__, file_name, str(e))
+                raise e
+        sampled = metrics.sampled()
+        log_call = log_function_calls and logging.getLogger().isEnabledFor(logging.DEBUG)
+        start_time = time.perf_counter()
         try:
-            file_path = inspect.getfile(func)
-            file_name = os.path.basename(file_path)
-            logging.debug('%s - %s - start function with args: %s', func.__name__, file_name, args)
+            if log_call:
+                logging.debug('%s - %s - start function with args: %s', func.__name__, file_name, args)
             result = func(*args, **kwargs)
-            end_time = time.time()
-            logging.debug('%s - %s - %s - end function with result: %s', func.__name__, file_name,
-                          end_time-start_time, result)
+            end_time = time.perf_counter()
+            if sampled:
+                metrics.record(metric_name, end_time - start_time)
+            if log_call:
+                logging.debug('%s - %s - %s - end function with result: %s', func.__name__, file_name,
+                              end_time-start_time, result)
+            return result
+        except Exception as e:
+            end_time = time.perf_counter()
+            if sampled:
+                metrics.record(metric_name, end_time - start_time)
+            logging.exception('%s - %s - %s - end function with Exception: %s', func.__name__, file_name,
+                              end_time-start_time, str(e))
+            raise e
+    return wrapper
+
+
+def _log_coroutine_call(func, file_name, metric_name):
+    """
+    log_function_call for coroutine functions, timing the call until the coroutine has finished
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not log_function_calls and not metrics.enabled:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                logging.exception('%s - %s - end function with Exception: %s', func.__name__, file_name, str(e))
+                raise e
+        sampled = metrics.sampled()
+        log_call = log_function_calls and logging.getLogger().isEnabledFor(logging.DEBUG)
+        start_time = time.perf_counter()
+        try:
+            if log_call:
+                logging.debug('%s - %s - start function with args: %s', func.__name__, file_name, args)
+            result = await func(*args, **kwargs)
+            end_time = time.perf_counter()
+            if sampled:
+                metrics.record(metric_name, end_time - start_time)
+            if log_call:
+                logging.debug('%s - %s - %s - end function with result: %s', func.__name__, file_name,
+                              end_time-start_time, result)
             return result
         except Exception as e:
-            end_time = time.time()
+            end_time = time.perf_counter()
+            if sampled:
+                metrics.record(metric_name, end_time - start_time)
             logging.exception('%s - %s - %s - end function with Exception: %s', func.__name__, file_name,
                               end_time-start_time, str(e))
             raise e
@@ -1,42 +1,66 @@
 import os
 import re
+import json
+import hashlib
 import logging
 from common import logger_config, log_function_call
 from azblobhanlder import BlobHandler
 from documentprocessing import ProcessDocument
 from azformrecognizerhandler import FormRecognizerHandler
 from azcognitivesearchhandler import CognitiveSearchHandler
+from analyzecache import analyze_cache_from_env
 
 
 logger_config()
 logger = logging.getLogger("file")
 
+@log_function_call
+def blob_name_from_file_page(filename, page=0):
+    if os.path.splitext(filename)[1].lower() == ".pdf":
+        return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".pdf"
+    else:
+        return os.path.basename(filename)
+
+
+@log_function_call
+def create_sections(filename: str, sections, metadata: dict = None):
+    """
+    Turns (section, page number) pairs into search documents, with the metadata fields set on each one.
+
+    The id of a section is derived from its text, with a counter for repeated text, rather than
+    from its position, so text inserted in the document does not renumber the sections after it.
+    Sections are cut at fixed lengths though, so the sections right after an edit change as well
+    until the cuts fall on the same sentence endings again; only those are rewritten by the
+    contenthash diff of sync_index_document.
+    """
+    metadata = {field: str(value) for field, value in (metadata or {}).items()}
+    # Part of every hash, so a change of metadata alone re-uploads the sections as well
+    metadata_json = json.dumps(metadata, sort_keys=True) if metadata else ""
+    occurrences = {}
+    for section, pagenum in sections:
+        sourcepage = blob_name_from_file_page(filename, pagenum)
+        section_digest = hashlib.sha256(section.encode("utf-8")).hexdigest()[:32]
+        occurrence = occurrences[section_digest] = occurrences.get(section_digest, -1) + 1
+        document = {
+            "id": re.sub("[^0-9a-zA-Z_-]", "_", f"{filename}-{section_digest}-{occurrence}"),
+            "content": section,
+            # "category": args.category,
+            "sourcepage": sourcepage,
+            "sourcefile": filename,
+            # Lets sync_index_document skip sections that are already indexed as they are
+            "contenthash": hashlib.sha256(f"{sourcepage}\n{section}{metadata_json}".encode("utf-8")).hexdigest()
+        }
+        document.update(metadata)
+        yield document
+
+
 @log_function_call
 def create_document_index(blob_url: str):
-    
-    @log_function_call
-    def _blob_name_from_file_page(filename, page=0):
-        if os.path.splitext(filename)[1].lower() == ".pdf":
-            return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".pdf"
-        else:
-            return os.path.basename(filename)
-    
-    @log_function_call
-    def _create_sections(filename: str, sections):
-        for i, (section, pagenum) in enumerate(sections):
-            yield {
-                "id": re.sub("[^0-9a-zA-Z_-]", "_", f"{filename}-{i}"),
-                "content": section,
-                # "category": args.category,
-                "sourcepage": _blob_name_from_file_page(filename, pagenum),
-                "sourcefile": filename
-            }
-
-    blob_proc = BlobHandler(blob_url=blob_url)
-    form_recog_proc = FormRecognizerHandler()
-    form_recog_proc.analyze_document(blob_proc.blob_url)
+    blob_proc = BlobHandler(blob_url=blob_url, credential=os.getenv("AZURE_STORAGEACCOUNT_SAS"))
+    form_recog_proc = FormRecognizerHandler(cache=analyze_cache_from_env(blob_proc.blob_service_client))
+    form_recog_proc.analyze_blob(blob_proc)
     document_proc = ProcessDocument(form_recognizer_results=form_recog_proc.result)
-    document_proc.split_text()
-    sections = _create_sections(blob_proc.blob_info["blob_name"])
+    # Sections are cut lazily and only the changed ones are uploaded, batch by batch as they arrive
+    sections = create_sections(blob_proc.blob_info["blob_name"], document_proc.iter_sections())
     cog_search_proc = CognitiveSearchHandler()
-    cog_search_proc.upload_index_document(filename=blob_proc.blob_info["blob_name"], sections=sections)
+    cog_search_proc.sync_index_document(filename=blob_proc.blob_info["blob_name"], sections=sections)
@@ -1,6 +1,11 @@
+import re
 import html
+import heapq
+import bisect
 import logging
+from array import array
 from common import logger_config, log_function_call
+from instrumentation import stage
 from azure.ai.formrecognizer import AnalyzeResult
 from azure.ai.formrecognizer._models import DocumentPage
 
@@ -8,6 +13,74 @@ from azure.ai.formrecognizer._models import DocumentPage
 logger_config()
 logger = logging.getLogger("file")
 
+class PageMap():
+    """
+    Holds the text of a document as one buffer together with the start offset of every page.
+
+    Text is appended page by page and joined once, on first access. Lookups from a character
+    offset to its page number are a binary search over the page start offsets.
+    """
+
+    def __init__(self):
+        self.page_nums = []
+        self.offsets = array("q")
+        self.length = 0
+        self._parts = []
+        self._text = None
+
+    def append(self, page_num, page_text):
+        """
+        Appends text to the buffer, starting a new page entry when page_num changes.
+
+        Args:
+            page_num (int): The page number the text belongs to.
+            page_text (str): The text to append.
+        """
+        if not self.page_nums or self.page_nums[-1] != page_num:
+            self.page_nums.append(page_num)
+            self.offsets.append(self.length)
+        if self._text is not None:
+            self._parts = [self._text]
+            self._text = None
+        self._parts.append(page_text)
+        self.length += len(page_text)
+
+    @property
+    def text(self):
+        """
+        str: The concatenated text of all pages.
+        """
+        if self._text is None:
+            self._text = "".join(self._parts)
+            self._parts = []
+        return self._text
+
+    def find_page(self, offset):
+        """
+        Finds the page number for a given offset in the buffer.
+
+        Args:
+            offset (int): The offset for which to find the page number.
+
+        Returns:
+            int: The page number.
+        """
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        return self.page_nums[max(index, 0)]
+
+    def __len__(self):
+        return len(self.page_nums)
+
+    def __iter__(self):
+        """
+        Yields (page_num, offset, page_text) tuples, one per page.
+        """
+        text = self.text
+        ends = list(self.offsets[1:]) + [self.length]
+        for page_num, offset, end in zip(self.page_nums, self.offsets, ends):
+            yield page_num, offset, text[offset:end]
+
+
 class ProcessDocument():
 
     def __init__(self, form_recognizer_results: AnalyzeResult):
@@ -17,6 +90,32 @@ class ProcessDocument():
         self.SECTION_OVERLAP = 100
         self.SENTENCE_ENDINGS = [".", "!", "?"]
         self.WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+        self.page_map = None
+
+    @log_function_call
+    def _build_table_index(self):
+        """
+        Indexes the tables of the analysis result by page and their cells by row.
+
+        Every table is filed under the page of its first bounding region, and its cells are
+        bucketed by row index and sorted by column index, so each table is walked only once
+        however many pages and rows the document has.
+
+        Returns:
+            dict: The tables on each page, keyed by page number.
+        """
+        self.tables_by_page = {}
+        self.table_rows = {}
+        for table in self.form_recognizer_results.tables or []:
+            self.tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
+            rows = [[] for _ in range(table.row_count)]
+            for cell in table.cells:
+                if 0 <= cell.row_index < table.row_count:
+                    rows[cell.row_index].append(cell)
+            for row_cells in rows:
+                row_cells.sort(key=lambda cell: cell.column_index)
+            self.table_rows[id(table)] = rows
+        return self.tables_by_page
 
     @log_function_call
     def _table_to_html(self, table):
@@ -24,7 +123,7 @@ class ProcessDocument():
         Converts a table object into an HTML table.
 
         This function takes a table object as input and converts it into an HTML table representation.
-        It iterates through the cells of the table, grouping them by rows, and generates the HTML
+        It iterates through the rows of the table from the table index, and generates the HTML
         table structure. Each cell is assigned the appropriate HTML tag (th for column/header cells,
         td for data cells) based on its kind. The cell spans are also taken into account to set the
         corresponding colspan and rowspan attributes in the HTML table. The content of each cell is
@@ -36,19 +135,20 @@ class ProcessDocument():
         Returns:
             str: The HTML representation of the table.
         """
-        table_html = "<table>"
-        rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
-        for row_cells in rows:
-            table_html += "<tr>"
+        if not hasattr(self, "table_rows"):
+            self._build_table_index()
+        parts = ["<table>"]
+        for row_cells in self.table_rows[id(table)]:
+            parts.append("<tr>")
             for cell in row_cells:
                 tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
                 cell_spans = ""
                 if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
                 if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-                table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-            table_html += "</tr>"
-        table_html += "</table>"
-        return table_html
+                parts.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+            parts.append("</tr>")
+        parts.append("</table>")
+        return "".join(parts)
 
     @log_function_call
     def _extract_page_text(self, page: DocumentPage):
@@ -61,69 +161,105 @@ class ProcessDocument():
         Returns:
             str: The extracted text from the page.
         """
-        page_text = ""
-        for line in page.lines:
-            page_text += " ".join([word.content for word in line.get_words()]) + " "
-        return page_text
+        return "".join(" ".join(word.content for word in line.get_words()) + " " for line in page.lines)
 
     @log_function_call
-    def _get_tables_on_page(self, all_tables, page_number):
+    def _get_tables_on_page(self, page_number):
         """
         Retrieves the tables on a specific page.
 
         Args:
-            all_tables (list): All tables detected in the documfent.
             page_number (int): The page number for which to retrieve the tables.
 
         Returns:
             list: The tables on the specified page.
         """
-        return [table for table in all_tables if table.bounding_regions[0].page_number == page_number]
+        return self.tables_by_page.get(page_number, [])
 
     @log_function_call
-    def _get_table_chars(self, text, tables):
+    def _get_page_content(self, page: DocumentPage):
         """
-        Retrieves the character indices that correspond to table spans.
+        Retrieves the content of a page from the content of the document.
 
         Args:
-            text (str): The text from the page.
+            page (DocumentPage): The page from which to get the content.
+
+        Returns:
+            tuple: The content of the page and its offset in the content of the document.
+        """
+        span = page.spans[0]
+        return self.form_recognizer_results.content[span.offset:span.offset + span.length], span.offset
+
+    @log_function_call
+    def _get_table_spans(self, text_length, tables, page_offset=0):
+        """
+        Retrieves the character ranges that correspond to table spans.
+
+        The spans are moved to be relative to the page, clipped to the page text and resolved
+        into non-overlapping ranges in a single sweep over their boundaries. Where spans of
+        several tables overlap, the table with the highest ID owns the range.
+
+        Args:
+            text_length (int): The length of the text from the page.
             tables (list): The tables on the page.
+            page_offset (int): The offset of the page in the content of the document.
 
         Returns:
-            list: The table characters with their corresponding table ID.
+            list: Sorted (start, end, table_id) tuples covering every table character.
         """
-        table_chars = [-1] * len(text)
+        intervals = []
         for table_id, table in enumerate(tables):
             for span in table.spans:
-                for i in range(span.offset, span.offset + span.length):
-                    if 0 <= i < len(table_chars):
-                        table_chars[i] = table_id
-        return table_chars
+                start = max(span.offset - page_offset, 0)
+                end = min(span.offset - page_offset + span.length, text_length)
+                if start < end:
+                    intervals.append((start, end, table_id))
+        intervals.sort()
+        boundaries = sorted({start for start, _, _ in intervals} | {end for _, end, _ in intervals})
+
+        table_spans = []
+        active = []
+        next_interval = 0
+        for range_start, range_end in zip(boundaries, boundaries[1:]):
+            while next_interval < len(intervals) and intervals[next_interval][0] <= range_start:
+                _, end, table_id = intervals[next_interval]
+                heapq.heappush(active, (-table_id, end))
+                next_interval += 1
+            while active and active[0][1] <= range_start:
+                heapq.heappop(active)
+            if not active:
+                continue
+            table_id = -active[0][0]
+            if table_spans and table_spans[-1][1] == range_start and table_spans[-1][2] == table_id:
+                table_spans[-1] = (table_spans[-1][0], range_end, table_id)
+            else:
+                table_spans.append((range_start, range_end, table_id))
+        return table_spans
 
     @log_function_call
-    def _generate_page_text(self, text, table_chars, tables_on_page):
+    def _generate_page_text(self, text, table_spans, tables_on_page):
         """
         Generates the page text by replacing table spans with HTML representations.
 
         Args:
             text (str): The text from the page.
-            table_chars (list): The table characters with their corresponding table ID.
+            table_spans (list): The sorted (start, end, table_id) ranges from _get_table_spans.
             tables_on_page (list): The tables on the page.
 
         Returns:
             str: The generated page text with tables represented as HTML.
         """
-        page_text = ""
+        parts = []
         added_tables = set()
-        for idx, char in enumerate(text):
-            if table_chars[idx] == -1:
-                page_text += char
-            else:
-                table_id = table_chars[idx]
-                if table_id not in added_tables:
-                    page_text += self._table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-        return page_text
+        position = 0
+        for start, end, table_id in table_spans:
+            parts.append(text[position:start])
+            if table_id not in added_tables:
+                parts.append(self._table_to_html(tables_on_page[table_id]))
+                added_tables.add(table_id)
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
 
     @log_function_call
     def _get_document_text(self):
@@ -135,30 +271,26 @@ class ProcessDocument():
         the text by concatenating the individual words. It also extracts the tables by identifying
         the table spans on each page and adding them to the page text. The table spans are replaced
         with their corresponding HTML representation using the _table_to_html function. The function
-        builds a page map that stores the page number, offset, and page text for each page. Finally,
-        it returns the page map.
+        builds a page map that holds the text of all pages in one buffer along with the offset where
+        each page starts. Finally, it returns the page map.
 
         Args:
             form_recognizer_results (AnalyzeResult): The results of the Form Recognizer analysis.
 
         Returns:
-            list: A list of tuples representing the page map. Each tuple contains the page number,
-            offset, and page text.
+            PageMap: The document text with the start offset of each page.
         """
-        self.page_map = []
-        offset = 0
+        self.page_map = PageMap()
+        self._build_table_index()
 
         for page_num, page in enumerate(self.form_recognizer_results.pages):
-            page_text = self._extract_page_text(page)
-            self.page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+            self.page_map.append(page_num, self._extract_page_text(page))
 
-            tables_on_page = self._get_tables_on_page(self.form_recognizer_results.tables, page_num + 1)
-            table_chars = self._get_table_chars(page.spans[0].text, tables_on_page)
+            tables_on_page = self._get_tables_on_page(page_num + 1)
+            page_content, page_offset = self._get_page_content(page)
+            table_spans = self._get_table_spans(len(page_content), tables_on_page, page_offset)
 
-            page_text = self._generate_page_text(page.spans[0].text, table_chars, tables_on_page)
-            self.page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+            self.page_map.append(page_num, self._generate_page_text(page_content, table_spans, tables_on_page))
 
         return self.page_map
 
@@ -173,16 +305,70 @@ class ProcessDocument():
         Returns:
             int: The page number.
         """
-        for i, (page_num, page_offset, _) in enumerate(self.page_map):
-            if offset >= page_offset and offset < self.page_map[i + 1][1]:
-                return page_num
-        return self.page_map[-1][0]
+        return self.page_map.find_page(offset)
+
+    @log_function_call
+    def get_page_map(self):
+        """
+        Returns the page map of the document, building it on first use only.
+
+        Returns:
+            PageMap: The document text with the start offset of each page.
+        """
+        if self.page_map is None:
+            with stage("page_map"):
+                self._get_document_text()
+        return self.page_map
+
+    @log_function_call
+    def get_content(self):
+        """
+        Returns the text of the document as read by the Form Recognizer service, every page once.
+
+        The page map holds each page twice, as its line text and again with the tables rendered as
+        HTML, which suits the search sections but doubles the text sent for metadata extraction.
+
+        Returns:
+            str: The content of the analysis result.
+        """
+        return self.form_recognizer_results.content or ""
+
+    @log_function_call
+    def _build_boundary_index(self, text):
+        """
+        Records the positions of sentence endings and word breaks in the text.
+
+        The positions are collected once per document with a compiled regex and stored as sorted
+        arrays, so that _find_sentence_end and _find_sentence_start can locate the nearest
+        boundary with a binary search instead of walking the text character by character.
+
+        Args:
+            text (str): The text to index.
+
+        Returns:
+            tuple: The sorted sentence ending positions and word break positions.
+        """
+        def _positions(chars):
+            pattern = re.compile("[" + "".join(re.escape(char) for char in chars if len(char) == 1) + "]")
+            return array("q", (match.start() for match in pattern.finditer(text)))
+
+        self._boundary_text = text
+        self.sentence_ending_positions = _positions(self.SENTENCE_ENDINGS)
+        self.word_break_positions = _positions(self.WORDS_BREAKS)
+        return self.sentence_ending_positions, self.word_break_positions
+
+    def _ensure_boundary_index(self, text):
+        if getattr(self, "_boundary_text", None) is not text:
+            self._build_boundary_index(text)
 
     @log_function_call
     def _find_sentence_end(self, text, end, length):
         """
         Finds the end of the sentence or a whole word boundary within the section limit.
 
+        The search moves forward from end and stops at the first sentence ending before the
+        search limit, remembering the last word break it passed on the way.
+
         Args:
             text (str): The text to search.
             end (int): The current end position.
@@ -191,11 +377,17 @@ class ProcessDocument():
         Returns:
             int: The updated end position.
         """
+        self._ensure_boundary_index(text)
         last_word = -1
-        while end < length and (end - self.MAX_SECTION_LENGTH) < self.SENTENCE_SEARCH_LIMIT and text[end] not in self.SENTENCE_ENDINGS:
-            if text[end] in self.WORDS_BREAKS:
-                last_word = end
-            end += 1
+        limit = min(length, self.MAX_SECTION_LENGTH + self.SENTENCE_SEARCH_LIMIT)
+        if end < limit:
+            endings = self.sentence_ending_positions
+            index = bisect.bisect_left(endings, end)
+            stop = endings[index] if index < len(endings) and endings[index] < limit else limit
+            index = bisect.bisect_left(self.word_break_positions, stop) - 1
+            if index >= 0 and self.word_break_positions[index] >= end:
+                last_word = self.word_break_positions[index]
+            end = stop
         if end < length and text[end] not in self.SENTENCE_ENDINGS and last_word > 0:
             end = last_word  # Fall back to at least keeping a whole word
         end = min(end + 1, length)  # Adjust the end position
@@ -206,6 +398,9 @@ class ProcessDocument():
         """
         Finds the start of the sentence or a whole word boundary within the section limit.
 
+        The search moves backward from start and stops at the first sentence ending within the
+        search limit, remembering the last word break it passed on the way.
+
         Args:
             text (str): The text to search.
             start (int): The current start position.
@@ -214,38 +409,48 @@ class ProcessDocument():
         Returns:
             int: The updated start position.
         """
+        self._ensure_boundary_index(text)
         last_word = -1
-        while start > 0 and (end - start - self.MAX_SECTION_LENGTH) < self.SENTENCE_SEARCH_LIMIT and text[start] not in self.SENTENCE_ENDINGS:
-            if text[start] in self.WORDS_BREAKS:
-                last_word = start
-            start -= 1
+        limit = max(1, end - self.MAX_SECTION_LENGTH - self.SENTENCE_SEARCH_LIMIT + 1)
+        if start >= limit:
+            endings = self.sentence_ending_positions
+            index = bisect.bisect_right(endings, start) - 1
+            stop = endings[index] if index >= 0 and endings[index] >= limit else limit - 1
+            index = bisect.bisect_right(self.word_break_positions, stop)
+            if index < len(self.word_break_positions) and self.word_break_positions[index] <= start:
+                last_word = self.word_break_positions[index]
+            start = stop
         if start > 0 and text[start] not in self.SENTENCE_ENDINGS and last_word > 0:
             start = last_word
         start = max(start + 1, 0)  # Adjust the start position
         return start
 
     @log_function_call
-    def split_text(self):
+    def iter_sections(self):
         """
-        Splits the text from the page map into sections based on specified parameters.
+        Splits the text from the page map into sections, yielding each section as soon as it is cut.
 
-        Returns:
-            list: A list of tuples containing the section text and its corresponding page number.
+        Yields:
+            tuple: The section text and its corresponding page number.
         """
-        self._get_document_text()
-        all_text = "".join(p[2] for p in self.page_map)
+        all_text = self.get_page_map().text
+        self._build_boundary_index(all_text)
         length = len(all_text)
         start = 0
-        self.sections = []
+        if length <= self.SECTION_OVERLAP:
+            # Too short for the loop below to cut even one section
+            if all_text:
+                yield (all_text, self._find_page(0))
+            return
 
         while start + self.SECTION_OVERLAP < length:
             end = min(start + self.MAX_SECTION_LENGTH, length)
 
-            end = self.find_sentence_end(all_text, end, length)
-            start = self.find_sentence_start(all_text, start, end)
+            end = self._find_sentence_end(all_text, end, length)
+            start = self._find_sentence_start(all_text, start, end)
 
             section_text = all_text[start:end]
-            self.sections.append((section_text, self.find_page(start)))
+            yield (section_text, self._find_page(start))
 
             last_table_start = section_text.rfind("<table")
             if last_table_start > 2 * self.SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table"):
@@ -254,6 +459,15 @@ class ProcessDocument():
                 start = end - self.SECTION_OVERLAP
 
         if start + self.SECTION_OVERLAP < end:
-            self.sections.append((all_text[start:end], self.find_page(start)))
+            yield (all_text[start:end], self._find_page(start))
+
+    @log_function_call
+    def split_text(self):
+        """
+        Splits the text from the page map into sections based on specified parameters.
 
+        Returns:
+            list: A list of tuples containing the section text and its corresponding page number.
+        """
+        self.sections = list(self.iter_sections())
         return self.sections
@@ -1,24 +1,90 @@
+import re
+import json
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import pypdf
+import tiktoken
 from retry import retry
 from langchain.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.docstore.document import Document
 import openai
+from openai.openai_object import OpenAIObject
 from common import logger_config, log_function_call
+from instrumentation import stage
 from utils import fix_json
+from llmcache import LLMResponseCache
 
 
 logger_config()
 logger = logging.getLogger("file")
 
+# Characters per chunk, and shared by consecutive chunks
+CHUNK_SIZE = 1400
+CHUNK_OVERLAP = 200
+# Tokens added by the chat format for every message, and once to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+# Kept free in every packed request, the system prompt grows as the metadata gets filled in
+PACK_MARGIN_TOKENS = 64
+
+
+class _ConvergenceDetector():
+    """
+    Follows the running answer of sequential extraction and tells when it has converged.
+
+    The answer has converged once every metadata field holds a real value and the values have
+    stayed the same for rounds answers in a row. With rounds None, it never converges.
+    """
+
+    def __init__(self, splitter, rounds: int = None):
+        self.splitter = splitter
+        self.rounds = rounds
+        self.stable = 0
+        self.previous = None
+
+    def update(self, answer: str):
+        if not self.rounds:
+            return False
+        try:
+            parsed = fix_json(answer)
+            values = {field: parsed.get(field) for field in self.splitter.metadata_list}
+        except Exception:
+            values = None
+        if values is None or any(self.splitter._is_placeholder(value) for value in values.values()):
+            self.stable = 0
+            self.previous = None
+            return False
+        self.stable = self.stable + 1 if values == self.previous else 0
+        self.previous = values
+        return self.stable >= self.rounds
+
 
 class DocumentSplitter():
 
-    def __init__(self, api_key: str, api_base: str, deployment_id: str) -> None:
+    def __init__(self, api_key: str, api_base: str, deployment_id: str, cache: LLMResponseCache = None,
+                 token_budget: int = None, encoding_name: str = "cl100k_base", early_stop_rounds: int = None) -> None:
         openai.api_type = "azure"
         openai.api_key = api_key
         openai.api_base = api_base
         openai.api_version = "2023-03-15-preview"  # subject to change
         self.deployment_id = deployment_id
+        self.cache = cache
+        # Tokens one chat request may use, prompt and reply included. When set, chunks are packed into
+        # as few requests as fit the budget instead of sending one request per chunk, see _pack_chunks
+        self.token_budget = token_budget
+        self.encoding_name = encoding_name
+        self._encoding = None
+        # In sequential mode, stop once every field is filled in and has not changed for this many chunks
+        self.early_stop_rounds = early_stop_rounds
+        self.chat_parameters = {
+            "temperature": 0.2,
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "max_tokens": 800,
+            "top_p": 0.95
+        }
         self.metadata_list = [
             "contractName",
             "contractID",
@@ -64,14 +130,39 @@ class DocumentSplitter():
             If number of field not matching with the above format then get rid of fields not matching.
             The user will provide paragraph of the document, that need to extract information."""
 
+    @log_function_call
+    def _load_pages(self, document):
+        """
+        Loads the pages of a PDF given as a path or URL, or as a BlobBuffer already downloaded.
+        """
+        if isinstance(document, str):
+            # PyPDFLoader downloads and parses the file in one step
+            with stage("download"):
+                loader = PyPDFLoader(document)
+                return loader.load_and_split()
+        # Same documents as PyPDFLoader.load_and_split, read straight from the shared buffer
+        with stage("extract"):
+            pdf_reader = pypdf.PdfReader(document.open())
+            pages = [Document(page_content=page.extract_text(), metadata={"source": document.source, "page": page_number})
+                     for page_number, page in enumerate(pdf_reader.pages)]
+            return RecursiveCharacterTextSplitter().split_documents(pages)
+
     @log_function_call
     def _document_splitter(self, document):
-        loader = PyPDFLoader(document)
-        pages = loader.load_and_split()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1400, chunk_overlap=200)
-        chunks = text_splitter.split_documents(pages)
+        pages = self._load_pages(document)
+        with stage("chunk"):
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                                           add_start_index=True)
+            chunks = text_splitter.split_documents(pages)
         return chunks
 
+    @log_function_call
+    def _text_splitter(self, text: str):
+        with stage("chunk"):
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                                           add_start_index=True)
+            return text_splitter.create_documents([text])
+
     @log_function_call
     def _construct_system_message(self, metadata: str = None):
         if metadata != None:
@@ -102,16 +193,31 @@ class DocumentSplitter():
 
     @log_function_call
     @retry(Exception, tries=4, delay=2, backoff=2)
+    def _openai_chat_request(self, messages: list[dict[str, str]]):
+        return openai.ChatCompletion.create(engine=self.deployment_id, messages=messages, **self.chat_parameters)
+
+    @log_function_call
     def _openai_chat(self, messages: list[dict[str, str]], max_tries: int = 3):
-        self.chat = openai.ChatCompletion.create(engine=self.deployment_id,
-                                                 messages=messages,
-                                                 temperature=0.2,
-                                                 frequency_penalty=0,
-                                                 presence_penalty=0,
-                                                 max_tokens=800,
-                                                 top_p=0.95)
+        """
+        Sends a chat completion request, answering it from the response cache when one is set.
+        """
+        if self.cache is None:
+            with stage("llm"):
+                self.chat = self._openai_chat_request(messages)
+            return self.chat
+        key = self._chat_cache_key(messages)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.chat = OpenAIObject.construct_from(cached)
+            return self.chat
+        with stage("llm"):
+            self.chat = self._openai_chat_request(messages)
+        self.cache.put(key, self.chat.to_dict_recursive())
         return self.chat
 
+    def _chat_cache_key(self, messages: list[dict[str, str]]):
+        return self.cache.make_key(self.deployment_id, messages, self.chat_parameters)
+
     @log_function_call
     def _format_json(self, text):
         fixed_json = fix_json(text)
@@ -125,16 +231,240 @@ class DocumentSplitter():
         return result
 
     @log_function_call
-    def split(self, document):
-        chunks = self._document_splitter(document)
-        result = {"metadata": "", "chunks": []}
+    def _is_placeholder(self, value):
+        """
+        Tells whether a metadata value is still empty or the "<...>" placeholder from the template.
+        """
+        if value is None:
+            return True
+        value = str(value).strip()
+        return value == "" or re.fullmatch(r"<[^<>]*>", value) is not None
+
+    @log_function_call
+    def _extract_partial(self, text):
+        """
+        Extracts metadata from one piece of the document, without any previous answer.
+        """
+        return self._parse_partial(self._openai_chat(messages=self._partial_messages(text)))
+
+    def _partial_messages(self, text):
+        system_prompt = self.system_prompt_template.format(metadata=self.few_shot_metadata,
+                                                           few_shot_metadata=self.few_shot_metadata)
+        return [{"role": "system", "content": system_prompt}, {"role": "user", "content": text}]
+
+    def _parse_partial(self, chat):
+        try:
+            return fix_json(chat.choices[0].message.content)
+        except Exception as e:
+            logger.warning(f"Ignoring unparsable partial metadata: {e}")
+            return {}
+
+    @log_function_call
+    def _merge_partials(self, partials):
+        """
+        Merges partial metadata, keeping for each field the first real value in document order.
+        """
+        result = json.loads(self.few_shot_metadata)
+        for field in self.metadata_list:
+            for partial in partials:
+                value = partial.get(field) if isinstance(partial, dict) else None
+                if not self._is_placeholder(value):
+                    result[field] = value
+                    break
+        return {field: result[field] for field in self.metadata_list}
+
+    @log_function_call
+    def _split_sequential(self, chunks, result):
         self._construct_system_message()
+        detector = _ConvergenceDetector(self, self.early_stop_rounds)
+        start_time = time.perf_counter()
+        requests = 0
         for chunk in chunks:
-            result["chunks"].append(chunk.page_content)
-            logger.debug(chunk.metadata)
             self._next_message(message=chunk.page_content)
             self.chat = self._openai_chat(messages=self.messages)
-            self._construct_system_message(self.chat.choices[0].message.content)
-            self._next_message(history=self.chat.choices[0].message.content)
+            requests += 1
+            if self._take_answer(detector):
+                break
+        return self._sequential_result(result, len(chunks), requests, start_time)
+
+    def _take_answer(self, detector: _ConvergenceDetector):
+        """
+        Threads the answer in self.chat into the next request, and tells whether it has converged.
+        """
+        answer = self.chat.choices[0].message.content
+        self._construct_system_message(answer)
+        self._next_message(history=answer)
+        return detector.update(answer)
+
+    def _sequential_result(self, result, planned: int, sent: int, start_time: float):
         result["metadata"] = self._format_json(self.chat.choices[0].message.content)
+        result["stats"] = self._request_stats(planned, sent, time.perf_counter() - start_time)
+        return result
+
+    @log_function_call
+    def _split_map_reduce(self, chunks, result, max_concurrency: int, group_size: int):
+        groups = self._map_groups(chunks, group_size)
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            partials = list(executor.map(self._extract_partial, groups))
+        return self._map_reduce_result(result, partials, start_time)
+
+    def _map_groups(self, chunks, group_size: int):
+        return ["\n".join(chunk.page_content for chunk in chunks[i:i + group_size])
+                for i in range(0, len(chunks), group_size)]
+
+    def _map_reduce_result(self, result, partials: list, start_time: float):
+        result["metadata"] = self._merge_partials(partials)
+        result["stats"] = self._request_stats(len(partials), len(partials), time.perf_counter() - start_time)
         return result
+
+    @log_function_call
+    def _request_stats(self, planned: int, sent: int, seconds: float):
+        """
+        Reports the chat requests of one document, with the calls and time saved by stopping early.
+
+        The latency saved is estimated from the mean time of the requests that were sent.
+        """
+        stats = {
+            "requests": sent,
+            "requests_planned": planned,
+            "calls_saved": planned - sent,
+            "seconds": seconds,
+            "latency_saved_seconds": (planned - sent) * seconds / sent if sent else 0.0
+        }
+        if stats["calls_saved"]:
+            logger.info(f"Metadata converged after {sent} of {planned} requests, saved {stats['calls_saved']} calls "
+                        f"and about {stats['latency_saved_seconds']:.1f}s")
+        return stats
+
+    @log_function_call
+    def _count_tokens(self, text: str):
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    @log_function_call
+    def _pack_budget(self, mode: str):
+        """
+        Returns how many tokens of document text fit in one request of the given mode.
+
+        The budget is net of the system prompt, the reply (max_tokens) and the per-message
+        overhead. In sequential mode _next_message keeps the previous user message and the
+        answer to it in every request, so half of the rest is left for the new text.
+        """
+        system_prompt = self.system_prompt_template.format(metadata=self.few_shot_metadata,
+                                                           few_shot_metadata=self.few_shot_metadata)
+        reply_tokens = self.chat_parameters["max_tokens"]
+        available = (self.token_budget - self._count_tokens(system_prompt) - reply_tokens
+                     - TOKENS_PER_REPLY - PACK_MARGIN_TOKENS)
+        if mode == "sequential":
+            available = (available - reply_tokens - 3 * TOKENS_PER_MESSAGE) // 2
+        else:
+            available -= 2 * TOKENS_PER_MESSAGE
+        if available <= 0:
+            logger.error(f"Token budget {self.token_budget} leaves no room for document text")
+            raise ValueError(f"Token budget {self.token_budget} leaves no room for document text")
+        return available
+
+    @log_function_call
+    def _overlap(self, previous, chunk):
+        """
+        Returns how many leading characters of chunk repeat the end of previous, from their start_index.
+        """
+        if previous is None or "start_index" not in chunk.metadata or "start_index" not in previous.metadata:
+            return 0
+        # Chunks of different pages never overlap
+        if {k: v for k, v in chunk.metadata.items() if k != "start_index"} != \
+                {k: v for k, v in previous.metadata.items() if k != "start_index"}:
+            return 0
+        previous_end = previous.metadata["start_index"] + len(previous.page_content)
+        overlap = min(max(previous_end - chunk.metadata["start_index"], 0), len(chunk.page_content))
+        # The start indexes of pieces that were split twice are relative to different texts, check the overlap is real
+        if overlap and not previous.page_content.endswith(chunk.page_content[:overlap]):
+            return 0
+        return overlap
+
+    @log_function_call
+    def _pack_chunks(self, chunks, max_tokens: int):
+        """
+        Packs consecutive chunks into documents of at most max_tokens tokens each.
+
+        The overlap between consecutive chunks is dropped, so packed text is not sent twice. A
+        chunk that is larger than max_tokens on its own is sent alone.
+        """
+        packs = []
+        texts = []
+        tokens = 0
+        previous = None
+        for chunk in chunks:
+            text = chunk.page_content[self._overlap(previous, chunk):].lstrip()
+            previous = chunk
+            if not text:
+                continue
+            text_tokens = self._count_tokens(text)
+            if texts and tokens + text_tokens > max_tokens:
+                packs.append(Document(page_content="\n".join(texts), metadata={"chunks": len(texts)}))
+                texts = []
+                tokens = 0
+            texts.append(text)
+            tokens += text_tokens
+        if texts:
+            packs.append(Document(page_content="\n".join(texts), metadata={"chunks": len(texts)}))
+        return packs
+
+    @log_function_call
+    def _request_chunks(self, chunks, mode: str):
+        """
+        Returns the pieces of text to send to the model, the chunks themselves or their packs when a token budget is set.
+        """
+        if not self.token_budget:
+            return chunks
+        packs = self._pack_chunks(chunks, self._pack_budget(mode))
+        logger.info(f"Packed {len(chunks)} chunks into {len(packs)} requests of at most {self.token_budget} tokens")
+        return packs
+
+    @log_function_call
+    def _split_chunks(self, chunks, mode: str, max_concurrency: int, group_size: int):
+        result, request_chunks = self._start_split(chunks, mode)
+        if mode == "map_reduce":
+            return self._split_map_reduce(request_chunks, result, max_concurrency, group_size)
+        return self._split_sequential(request_chunks, result)
+
+    def _start_split(self, chunks, mode: str):
+        """
+        Returns the result to fill in, holding the chunks, and the pieces of text to send in the given mode.
+        """
+        if mode not in ("sequential", "map_reduce"):
+            logger.error(f"Unknown split mode {mode}")
+            raise ValueError(f"Unknown split mode {mode}")
+        result = {"metadata": "", "chunks": []}
+        for chunk in chunks:
+            result["chunks"].append(chunk.page_content)
+            logger.debug(chunk.metadata)
+        return result, self._request_chunks(chunks, mode)
+
+    @log_function_call
+    def split(self, document, mode: str = "sequential", max_concurrency: int = 4, group_size: int = 1):
+        """
+        Splits the document into chunks and extracts the metadata_list fields from them.
+
+        mode "sequential" sends the chunks one after another and threads the previous answer into
+        the next system prompt. mode "map_reduce" sends groups of group_size chunks independently,
+        at most max_concurrency at a time, and merges the partial answers: for each field the
+        first non-placeholder value in document order wins.
+
+        With a token_budget, the chunks are packed into as few requests as fit the budget first,
+        and group_size applies to the packs. The returned chunks are never packed. With
+        early_stop_rounds, sequential mode stops as soon as the answer has converged, and
+        result["stats"] reports the requests sent and the calls and latency saved.
+        """
+        chunks = self._document_splitter(document)
+        return self._split_chunks(chunks, mode, max_concurrency, group_size)
+
+    @log_function_call
+    def split_text(self, text: str, mode: str = "sequential", max_concurrency: int = 4, group_size: int = 1):
+        """
+        Same as split, for text that has already been extracted from the document.
+        """
+        chunks = self._text_splitter(text)
+        return self._split_chunks(chunks, mode, max_concurrency, group_size)
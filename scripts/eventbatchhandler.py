@@ -0,0 +1,210 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from common import logger_config, log_function_call
+from instrumentation import stage
+from eventcreateandmodify import BlobCreateModifyEventHandler
+from azformrecognizerhandler import FormRecognizerHandler
+from azcognitivesearchhandler import CognitiveSearchHandler
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+SUBSCRIPTION_VALIDATION_EVENT = "Microsoft.EventGrid.SubscriptionValidationEvent"
+
+
+@log_function_call
+def get_validation_response(events: list):
+    """
+    Returns the answer to the Event Grid subscription validation handshake, or None for other events.
+    """
+    for event in events:
+        if event.get("eventType") == SUBSCRIPTION_VALIDATION_EVENT:
+            return {"validationResponse": event["data"]["validationCode"]}
+    return None
+
+
+class BlobEventBatchHandler():
+    """
+    Processes a batch of Event Grid blob events in one invocation.
+
+    PutBlob events are deduplicated by URL. The documents run concurrently on the process-wide
+    clients of clientregistry. In the "unified" ingestion mode, the documents of the batch are
+    analyzed together by one AnalysisScheduler, see FormRecognizerHandler.analyze_documents, and
+    their sections are synced to the search index together, so they share full-size index batches
+    instead of each document sending its own.
+    """
+
+    def __init__(self, events: list, openai_api_key: str, openai_api_base: str, openai_deployment_id: str,
+                 max_concurrency: int = None):
+        self.events = events
+        self.openai_config = {"openai_api_key": openai_api_key,
+                              "openai_api_base": openai_api_base,
+                              "openai_deployment_id": openai_deployment_id}
+        self.max_concurrency = max_concurrency or int(os.getenv("EVENT_BATCH_CONCURRENCY") or 4)
+
+    @log_function_call
+    def _blob_urls(self):
+        """
+        Returns the blob URLs of the PutBlob events, each once, in the order they were last written.
+        """
+        urls = {}
+        for event in self.events:
+            data = event.get("data") or {}
+            if (data.get("api") or "").lower() != "putblob":
+                continue
+            urls.pop(data["url"], None)
+            urls[data["url"]] = None
+        return list(urls)
+
+    @log_function_call
+    def _prepare(self, blob_url: str):
+        """
+        Runs what comes before the analysis for one document, or everything outside the unified mode.
+
+        Returns:
+            dict: The event handler, the pipeline and the downloaded document when the document is indexed, and the status.
+        """
+        event_handler = BlobCreateModifyEventHandler(blob_url=blob_url, **self.openai_config)
+        if event_handler.is_unchanged():
+            logger.info(f"Skipping {blob_url}, already processed with the same content")
+            return {"url": blob_url, "handler": event_handler, "pipeline": None, "status": "unchanged"}
+        if event_handler.ingestion_mode != "unified":
+            event_handler.process()
+            return {"url": blob_url, "handler": event_handler, "pipeline": None, "status": "processed"}
+        pipeline = event_handler.create_pipeline()
+        return {"url": blob_url, "handler": event_handler, "pipeline": pipeline, "status": "processed",
+                "document": pipeline.blob_handler.download_to_buffer()}
+
+    @log_function_call
+    def _prepare_safely(self, blob_url: str):
+        try:
+            return self._prepare(blob_url)
+        except Exception as e:
+            logger.error(f"Failed to process {blob_url}: {e}")
+            return {"url": blob_url, "handler": None, "pipeline": None, "status": "failed", "error": str(e)}
+
+    @log_function_call
+    def _analyze(self, prepared: list):
+        """
+        Analyzes the downloaded documents together, failing those whose analysis failed.
+        """
+        by_document = {id(result["document"]): result for result in prepared}
+        form_recog_proc = FormRecognizerHandler(cache=prepared[0]["pipeline"].analyze_cache)
+        try:
+            with stage("batch_analyze"):
+                for document, analysis, error in form_recog_proc.analyze_documents([result["document"] for result in prepared]):
+                    result = by_document[id(document)]
+                    # The buffer is not needed past the analysis
+                    del result["document"]
+                    if error is not None:
+                        logger.error(f"Failed to analyze {result['url']}: {error}")
+                        result.update({"pipeline": None, "status": "failed", "error": str(error)})
+                        continue
+                    result["pipeline"].use_analysis(analysis)
+        except Exception as e:
+            logger.error(f"Failed to analyze the batch: {e}")
+            for result in prepared:
+                if result.pop("document", None) is not None:
+                    result.update({"pipeline": None, "status": "failed", "error": str(e)})
+
+    @log_function_call
+    def _extract(self, result: dict):
+        """
+        Extracts the metadata of an analyzed document and uploads its chunks, failing it when either fails.
+        """
+        try:
+            result["pipeline"].extract_metadata()
+            result["pipeline"].upload_chunks()
+            result["split_stats"] = result["pipeline"].split_stats
+        except Exception as e:
+            logger.error(f"Failed to process {result['url']}: {e}")
+            result.update({"pipeline": None, "status": "failed", "error": str(e)})
+
+    @log_function_call
+    def _sync_rounds(self, indexed: list):
+        """
+        Splits the documents to index into rounds in which every file name appears once.
+
+        The index knows a document by its file name only, so blobs of the same name in different
+        folders or containers replace each other's sections. They are synced in successive rounds,
+        in the order they were written, so the index ends up with the last one as it would if
+        the events had come one by one.
+        """
+        rounds = []
+        for result in indexed:
+            filename = result["pipeline"].filename
+            for sync_round in rounds:
+                if filename not in sync_round:
+                    sync_round[filename] = result
+                    break
+            else:
+                rounds.append({filename: result})
+        for sync_round in rounds[1:]:
+            for filename, result in sync_round.items():
+                logger.warning(f"{result['url']} has the same file name as another blob of the batch, "
+                               f"the index keeps the sections of the last one written")
+        return rounds
+
+    @log_function_call
+    def _sync_index(self, indexed: list):
+        """
+        Syncs the sections of the documents to the index, marking those whose sections failed.
+
+        Returns:
+            list: The statistics of every sync round.
+        """
+        search_handler = CognitiveSearchHandler(metadata_fields=indexed[0]["pipeline"].doc_splitter.metadata_list)
+        index_stats = []
+        for sync_round in self._sync_rounds(indexed):
+            try:
+                with stage("batch_index"):
+                    stats = search_handler.sync_index_documents(
+                        {filename: result["pipeline"].iter_index_sections() for filename, result in sync_round.items()})
+            except Exception as e:
+                logger.error(f"Failed to index {len(sync_round)} documents: {e}")
+                for result in sync_round.values():
+                    result.update({"status": "failed", "error": str(e)})
+                continue
+            for filename, failed_ids in stats["failed_by_file"].items():
+                results = [sync_round[filename]] if filename in sync_round else list(sync_round.values())
+                for result in results:
+                    result.update({"status": "failed", "error": f"{len(failed_ids)} sections failed to index"})
+            index_stats.append({key: value for key, value in stats.items() if key != "failed_by_file"})
+        return index_stats
+
+    @log_function_call
+    def process(self):
+        """
+        Processes every document of the batch and flushes their sections to the index together.
+
+        A document that fails does not stop the others. Documents are recorded in the processing
+        manifest only once all of their sections are indexed, so a retried batch redoes just the
+        ones that failed. Documents are told apart by their full blob URL.
+
+        Returns:
+            dict: The status of every document and the statistics of each index sync round.
+        """
+        urls = self._blob_urls()
+        logger.info(f"Processing {len(urls)} blobs")
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = list(executor.map(self._prepare_safely, urls))
+            prepared = [result for result in results if result["pipeline"] is not None]
+            if prepared:
+                self._analyze(prepared)
+                list(executor.map(self._extract, [result for result in prepared if result["pipeline"] is not None]))
+
+        indexed = [result for result in results if result["pipeline"] is not None]
+        index_stats = self._sync_index(indexed) if indexed else None
+
+        for result in results:
+            if result["status"] == "processed":
+                result["handler"].record_processed()
+        summary = {
+            "documents": [{key: value for key, value in result.items() if key not in ("handler", "pipeline")}
+                          for result in results],
+            "index_stats": index_stats
+        }
+        summary["failed"] = sum(1 for result in results if result["status"] == "failed")
+        return summary
@@ -4,7 +4,13 @@ from dotenv import load_dotenv
 from azure.identity import ChainedTokenCredential, ManagedIdentityCredential
 from azure.core.credentials import AzureSasCredential
 from documentsplitter import DocumentSplitter
+from llmcache import get_llm_cache
+from analyzecache import analyze_cache_from_env
+from processingmanifest import PIPELINE_VERSION, ProcessingManifest, BlobManifestStore, get_local_manifest_store
 from azblobhanlder import BlobHandler
+from azcognitivesearchhandler import IndexingError
+from clientregistry import get_blob_service_client
+from ingestionpipeline import IngestionPipeline
 from common import logger_config, log_function_call
 
 
@@ -14,17 +20,47 @@ load_dotenv()
 
 
 class BlobCreateModifyEventHandler:
+    # Replaced by the async handlers in AsyncBlobCreateModifyEventHandler
+    doc_splitter_class = DocumentSplitter
+    blob_handler_class = BlobHandler
+    pipeline_class = IngestionPipeline
+
     def __init__(self, blob_url: str,  # credential: ManagedIdentityCredential
                  openai_api_key: str, openai_api_base: str, openai_deployment_id: str):
         self.blob_url = blob_url
         # self.managed_identity_credential = ManagedIdentityCredential()
         # self.chained_credential = ChainedTokenCredential(self.managed_identity_credential)
-        self.doc_splitter = DocumentSplitter(api_key=openai_api_key,
-                                             api_base=openai_api_base,
-                                             deployment_id=openai_deployment_id)
+        llm_cache_path = os.getenv("LLM_CACHE_PATH")
+        self.llm_cache = None
+        if llm_cache_path:
+            self.llm_cache = get_llm_cache(llm_cache_path, max_bytes=int(os.getenv("LLM_CACHE_MAX_MB") or 256) * 1024 * 1024)
+        self.doc_splitter = self.doc_splitter_class(api_key=openai_api_key,
+                                                    api_base=openai_api_base,
+                                                    deployment_id=openai_deployment_id,
+                                                    cache=self.llm_cache,
+                                                    token_budget=int(os.getenv("METADATA_TOKEN_BUDGET") or 0) or None,
+                                                    early_stop_rounds=int(os.getenv("METADATA_EARLY_STOP_ROUNDS") or 0) or None)
         # self.blob_handler = BlobHandler(blob_url=self.blob_url,
         #                                 credential=self.chained_credential)
-        self.blob_handler = BlobHandler(blob_url=self.blob_url, credential=os.getenv("AZURE_STORAGEACCOUNT_SAS"))
+        self.blob_handler = self.blob_handler_class(blob_url=self.blob_url, credential=os.getenv("AZURE_STORAGEACCOUNT_SAS"))
+        # "chunks" only splits and uploads chunks, "unified" also indexes the document, see ingest
+        self.ingestion_mode = os.getenv("INGESTION_MODE") or "chunks"
+        # Skip blobs that were overwritten with identical content, see ProcessingManifest.
+        # The mode is part of the version so switching modes processes every blob again.
+        manifest_version = f"{PIPELINE_VERSION}-{self.ingestion_mode}"
+        # The manifest and the analysis cache are synchronous, also for the async handler
+        blob_service_client = get_blob_service_client(account_url=self.blob_handler.blob_info["account_url"],
+                                                      credential=self.blob_handler.credential)
+        self.analyze_cache = analyze_cache_from_env(blob_service_client)
+        self.manifest = None
+        if os.getenv("PROCESSING_MANIFEST_CONTAINER"):
+            manifest_container = blob_service_client.get_container_client(os.getenv("PROCESSING_MANIFEST_CONTAINER"))
+            self.manifest = ProcessingManifest(BlobManifestStore(manifest_container), manifest_version)
+        elif os.getenv("PROCESSING_MANIFEST_PATH"):
+            self.manifest = ProcessingManifest(get_local_manifest_store(os.getenv("PROCESSING_MANIFEST_PATH")), manifest_version)
+        # "sequential" or "map_reduce", see DocumentSplitter.split
+        self.split_mode = os.getenv("METADATA_EXTRACTION_MODE") or "sequential"
+        self.split_concurrency = int(os.getenv("METADATA_EXTRACTION_CONCURRENCY") or 4)
 
     @log_function_call
     def _blob_name_from_file_page(self, filename, page=0):
@@ -33,14 +69,79 @@ class BlobCreateModifyEventHandler:
         else:
             return os.path.basename(filename)
 
+    @log_function_call
+    def is_unchanged(self):
+        """
+        Tells whether this version of the blob was already processed, from its properties alone.
+        """
+        if self.manifest is None:
+            return False
+        self.blob_properties = self.blob_handler.get_blob_properties()
+        return self.manifest.is_unchanged(self.blob_url, self.blob_properties)
+
+    @log_function_call
+    def record_processed(self):
+        """
+        Marks this version of the blob as processed, only call it once process() returned without an error.
+        """
+        if self.manifest is None:
+            return
+        if not hasattr(self, "blob_properties"):
+            self.blob_properties = self.blob_handler.get_blob_properties()
+        self.manifest.record(self.blob_url, self.blob_properties)
+
     @log_function_call
     def split_and_blob_upload(self):
-        splitted_doc = self.doc_splitter.split(self.blob_url)
-        metdata = splitted_doc["metadata"]
-        chunks = splitted_doc["chunks"]
+        """
+        Splits the blob into chunks and uploads them with the extracted metadata.
+
+        Raises:
+            BlobUploadError: Some of the chunks failed to upload.
+        """
+        document = self.blob_handler.download_to_buffer()
+        splitted_doc = self.doc_splitter.split(document, mode=self.split_mode, max_concurrency=self.split_concurrency)
+        if self.llm_cache is not None:
+            logger.info(f"LLM cache: {self.llm_cache.stats()}")
+        return self.blob_handler.upload_files(self._chunk_blobs(splitted_doc), container="index",
+                                              metadata=splitted_doc["metadata"])
+
+    def _chunk_blobs(self, splitted_doc: dict):
         filename = self.blob_handler.blob_info["blob_name"]
-        i = 0
-        for chunk in chunks:
-            blob_name = self._blob_name_from_file_page(filename, i)
-            i += 1
-            self.blob_handler.upload_file(blob_name=blob_name, data=chunk, container="index", metadata=metdata)
+        return [(self._blob_name_from_file_page(filename, i), chunk) for i, chunk in enumerate(splitted_doc["chunks"])]
+
+    @log_function_call
+    def create_pipeline(self):
+        return self.pipeline_class(blob_handler=self.blob_handler, doc_splitter=self.doc_splitter,
+                                   split_mode=self.split_mode, split_concurrency=self.split_concurrency,
+                                   analyze_cache=self.analyze_cache)
+
+    @log_function_call
+    def ingest(self):
+        """
+        Uploads the chunks and indexes the document from a single Form Recognizer parse, see IngestionPipeline.
+
+        Raises:
+            BlobUploadError: Some of the chunks failed to upload.
+            IndexingError: Some of the sections failed to index or to be deleted.
+        """
+        pipeline = self.create_pipeline()
+        return self._check_ingested(pipeline, pipeline.run())
+
+    def _check_ingested(self, pipeline, result: dict):
+        if self.llm_cache is not None:
+            logger.info(f"LLM cache: {self.llm_cache.stats()}")
+        if result["index_stats"]["failed"]:
+            raise IndexingError(pipeline.filename, result["index_stats"]["failed_ids"])
+        return result
+
+    @log_function_call
+    def process(self):
+        if self._check_mode() == "unified":
+            return self.ingest()
+        return self.split_and_blob_upload()
+
+    def _check_mode(self):
+        if self.ingestion_mode not in ("chunks", "unified"):
+            logger.error(f"Unknown ingestion mode {self.ingestion_mode}")
+            raise ValueError(f"Unknown ingestion mode {self.ingestion_mode}")
+        return self.ingestion_mode
@@ -0,0 +1,149 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from common import logger_config, log_function_call
+from instrumentation import stage
+from azblobhanlder import BlobHandler
+from documentsplitter import DocumentSplitter
+from documentprocessing import ProcessDocument
+from azformrecognizerhandler import FormRecognizerHandler
+from azcognitivesearchhandler import CognitiveSearchHandler
+from analyzecache import AnalyzeResultCache
+from createindexsection import blob_name_from_file_page, create_sections
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+
+class IngestionPipeline():
+    """
+    Processes one blob for both chunk upload and search indexing, parsing it only once.
+
+    The blob is downloaded and analyzed by Form Recognizer a single time, and that one result is
+    used for everything downstream. Its content, the plain page text, is split into the chunks that
+    DocumentSplitter extracts the metadata from and that are uploaded to the chunk container, as the
+    chunks mode does with the text of the PDF. The page map built by ProcessDocument is cut into the
+    sections that are synced to the search index with the metadata attached.
+    """
+
+    def __init__(self, blob_handler: BlobHandler, doc_splitter: DocumentSplitter, chunk_container: str = "index",
+                 split_mode: str = "sequential", split_concurrency: int = 4, analyze_cache: AnalyzeResultCache = None):
+        self.blob_handler = blob_handler
+        self.doc_splitter = doc_splitter
+        self.chunk_container = chunk_container
+        self.split_mode = split_mode
+        self.split_concurrency = split_concurrency
+        self.analyze_cache = analyze_cache
+        self.filename = blob_handler.blob_info["blob_name"]
+        self.document_proc = None
+        self.metadata = None
+        self.chunks = None
+        self.split_stats = None
+
+    @log_function_call
+    def analyze(self):
+        """
+        Downloads the blob and runs the Form Recognizer analysis, the only parse of the document.
+
+        With an analyze_cache, a blob whose ETag was analyzed before is neither downloaded nor analyzed again.
+
+        Returns:
+            ProcessDocument: The processor holding the analysis result and its page map.
+        """
+        form_recog_proc = FormRecognizerHandler(cache=self.analyze_cache)
+        form_recog_proc.analyze_blob(self.blob_handler)
+        return self.use_analysis(form_recog_proc.result)
+
+    @log_function_call
+    def use_analysis(self, result):
+        """
+        Takes an analysis made elsewhere in place of analyze(), such as one of FormRecognizerHandler.analyze_documents.
+
+        Returns:
+            ProcessDocument: The processor holding the analysis result and its page map.
+        """
+        self.document_proc = ProcessDocument(form_recognizer_results=result)
+        self.document_proc.get_page_map()
+        return self.document_proc
+
+    @log_function_call
+    def extract_metadata(self):
+        """
+        Splits the document content into chunks and extracts the metadata from them.
+
+        The content holds every page once, the page map would send each page twice, see ProcessDocument.get_content.
+
+        Returns:
+            dict: The extracted metadata.
+        """
+        if self.document_proc is None:
+            self.analyze()
+        splitted_doc = self.doc_splitter.split_text(self._metadata_text(), mode=self.split_mode,
+                                                    max_concurrency=self.split_concurrency)
+        return self._take_split(splitted_doc)
+
+    def _metadata_text(self):
+        return self.document_proc.get_content()
+
+    def _take_split(self, splitted_doc: dict):
+        self.metadata = splitted_doc["metadata"]
+        self.chunks = splitted_doc["chunks"]
+        self.split_stats = splitted_doc.get("stats")
+        return self.metadata
+
+    @log_function_call
+    def upload_chunks(self):
+        """
+        Uploads the chunks to the chunk container, with the metadata set on every blob.
+
+        Returns:
+            list: The per-blob status returned by BlobHandler.upload_files.
+
+        Raises:
+            BlobUploadError: Some of the chunks failed to upload.
+        """
+        return self.blob_handler.upload_files(self._chunk_blobs(), container=self.chunk_container, metadata=self.metadata)
+
+    def _chunk_blobs(self):
+        return [(blob_name_from_file_page(self.filename, i), chunk) for i, chunk in enumerate(self.chunks)]
+
+    @log_function_call
+    def iter_index_sections(self):
+        """
+        Yields the search documents of the blob, cut from the page map so every section knows its page.
+
+        The chunks are cut from the document content instead, see extract_metadata.
+        """
+        return create_sections(self.filename, self.document_proc.iter_sections(), metadata=self.metadata)
+
+    @log_function_call
+    def index_sections(self, search_handler: CognitiveSearchHandler = None):
+        """
+        Syncs the sections to the search index, adding the metadata fields to the index if needed.
+
+        Returns:
+            dict: The sync statistics returned by CognitiveSearchHandler.sync_index_document.
+        """
+        if search_handler is None:
+            search_handler = CognitiveSearchHandler(metadata_fields=self.doc_splitter.metadata_list)
+        return search_handler.sync_index_document(filename=self.filename, sections=self.iter_index_sections())
+
+    @log_function_call
+    def run(self, search_handler: CognitiveSearchHandler = None):
+        """
+        Runs every step. Chunk upload and indexing only depend on the text and the metadata, so they run side by side.
+
+        Returns:
+            dict: The metadata, the chunk upload status and the index sync statistics.
+        """
+        with stage("pipeline"):
+            self.analyze()
+            self.extract_metadata()
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                upload_future = executor.submit(self.upload_chunks)
+                index_future = executor.submit(self.index_sections, search_handler)
+                return self._run_result(upload_future.result(), index_future.result())
+
+    def _run_result(self, upload_status: list, index_stats: dict):
+        return {"metadata": self.metadata, "split_stats": self.split_stats, "upload_status": upload_status,
+                "index_stats": index_stats}
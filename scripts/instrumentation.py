@@ -0,0 +1,180 @@
+import os
+import json
+import math
+import time
+import random
+import logging
+import threading
+import functools
+import contextlib
+
+
+# Configured by common.logger_config, which imports this module
+logger = logging.getLogger("file")
+
+
+def _env_flag(name):
+    return (os.getenv(name) or "").lower() in ("1", "true", "yes")
+
+
+class Histogram():
+    """
+    Latency histogram with logarithmic buckets.
+
+    Each power of two from one microsecond up is split into BUCKETS_PER_OCTAVE buckets, which
+    keeps percentiles within about 20% of the true value using a few dozen counters.
+    """
+    BUCKETS_PER_OCTAVE = 4
+    MIN_SECONDS = 1e-6
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = {}
+
+    def _bucket(self, seconds):
+        if seconds <= self.MIN_SECONDS:
+            return 0
+        return int(math.log2(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_OCTAVE) + 1
+
+    def _upper_bound(self, bucket):
+        return self.MIN_SECONDS * 2 ** (bucket / self.BUCKETS_PER_OCTAVE)
+
+    def record(self, seconds):
+        bucket = self._bucket(seconds)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-th percentile (0 < q <= 100).
+        """
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * q / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {f"{self._upper_bound(bucket):.6g}": self.buckets[bucket] for bucket in sorted(self.buckets)}
+        }
+
+
+class Metrics():
+    """
+    Process-wide latency histograms for functions and pipeline stages.
+
+    Recording is off unless INSTRUMENTATION_ENABLED is set (or configure(enabled=True) is called);
+    while off, the decorators and stage() do nothing but check a flag. When on, only a
+    INSTRUMENTATION_SAMPLE_RATE fraction of calls is timed.
+    """
+
+    def __init__(self):
+        self.enabled = _env_flag("INSTRUMENTATION_ENABLED")
+        self.sample_rate = float(os.getenv("INSTRUMENTATION_SAMPLE_RATE") or 1.0)
+        self.started_at = time.time()
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool = None, sample_rate: float = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def sampled(self):
+        """
+        Tells whether the current call should be timed.
+        """
+        return self.enabled and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "dumped_at": time.time(),
+                "sample_rate": self.sample_rate,
+                "histograms": {name: self._histograms[name].to_dict() for name in sorted(self._histograms)}
+            }
+
+    def dump(self, path: str = None):
+        """
+        Serializes the histograms to JSON, writing them to path when one is given and logging them otherwise.
+
+        Returns:
+            str: The JSON document.
+        """
+        snapshot = self.snapshot()
+        document = json.dumps(snapshot, indent=2)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(document)
+        else:
+            logger.info(f"Instrumentation: {json.dumps(snapshot, separators=(',', ':'))}")
+        return document
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self.started_at = time.time()
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Times a pipeline stage such as download, extract, chunk, analyze, page_map, llm, blob_upload or index.
+    """
+    if not metrics.sampled():
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(f"stage.{name}", time.perf_counter() - start_time)
+
+
+def timed(name: str):
+    """
+    Decorator recording the latency of every call under name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.sampled():
+                return func(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record(name, time.perf_counter() - start_time)
+        return wrapper
+    return decorator
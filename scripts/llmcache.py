@@ -0,0 +1,120 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from common import logger_config, log_function_call
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class LLMResponseCache():
+    """
+    Disk-backed cache of chat completion responses, stored in SQLite.
+
+    Entries are keyed by a hash of the deployment ID, the messages and the sampling parameters,
+    so only an identical request is answered from the cache. When the stored responses grow
+    past max_bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                     "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                                     "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    @staticmethod
+    def make_key(deployment_id: str, messages: list[dict[str, str]], parameters: dict):
+        """
+        Hashes everything that determines the response of a chat completion request.
+        """
+        request = json.dumps({"deployment_id": deployment_id, "messages": messages, "parameters": parameters},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    @log_function_call
+    def get(self, key: str):
+        """
+        Returns the cached response for key as a dict, or None on a miss.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self._connection:
+                self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    @log_function_call
+    def put(self, key: str, response: dict):
+        text = json.dumps(response, ensure_ascii=False)
+        with self._lock:
+            with self._connection:
+                self._connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_access) "
+                                         "VALUES (?, ?, ?, ?)", (key, text, len(text), time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._connection.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                total -= size
+            with self._connection:
+                self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            self.evictions += len(evicted)
+
+    @log_function_call
+    def stats(self):
+        """
+        Returns the hit and miss counters of this process together with the size of the cache.
+        """
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+@log_function_call
+def get_llm_cache(path: str, max_bytes: int = 256 * 1024 * 1024):
+    """
+    Returns the process-wide cache stored at path, opening it on first use.
+    """
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = LLMResponseCache(path, max_bytes=max_bytes)
+        return _caches[path]
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from common import logger_config, log_function_call
+from azure.core.exceptions import ResourceNotFoundError
+
+
+logger_config()
+logger = logging.getLogger("file")
+
+# Bump whenever a change to the pipeline should reprocess documents that were already processed
+PIPELINE_VERSION = "1"
+
+_local_stores = {}
+_local_stores_lock = threading.Lock()
+
+
+class LocalManifestStore():
+    """
+    Keeps manifest entries in one JSON file on the local disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+
+    def get(self, key: str):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+            # Write to a temporary file first so a crash never leaves a truncated manifest behind
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+
+
+class BlobManifestStore():
+    """
+    Keeps manifest entries as one small JSON blob per source blob in a container.
+    """
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+        self._container_checked = False
+
+    def _blob_name(self, key: str):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, key: str):
+        try:
+            data = self.container_client.download_blob(self._blob_name(key)).readall()
+        except ResourceNotFoundError:
+            return None
+        return json.loads(data)
+
+    def put(self, key: str, entry: dict):
+        if not self._container_checked:
+            if not self.container_client.exists():
+                self.container_client.create_container()
+            self._container_checked = True
+        self.container_client.upload_blob(self._blob_name(key), json.dumps(entry), overwrite=True)
+
+
+class ProcessingManifest():
+    """
+    Remembers which version of each blob has been processed by which version of the pipeline.
+
+    Entries are keyed by blob URL and hold the content MD5 and ETag of the blob as it was when it
+    was processed. Blob storage gives every overwrite a new ETag even when the bytes are the same,
+    so the content MD5 is compared first and the ETag is only used for blobs without one.
+    """
+
+    def __init__(self, store, pipeline_version: str = PIPELINE_VERSION):
+        self.store = store
+        self.pipeline_version = pipeline_version
+
+    @log_function_call
+    def _fingerprint(self, properties):
+        content_md5 = properties.content_settings.content_md5
+        return {
+            "content_md5": base64.b64encode(content_md5).decode("ascii") if content_md5 else None,
+            "etag": properties.etag
+        }
+
+    @log_function_call
+    def is_unchanged(self, blob_url: str, properties):
+        """
+        Tells whether the blob, as described by its properties, was already processed by this pipeline version.
+        """
+        entry = self.store.get(blob_url)
+        if entry is None or entry.get("pipeline_version") != self.pipeline_version:
+            return False
+        fingerprint = self._fingerprint(properties)
+        if fingerprint["content_md5"] and entry.get("content_md5"):
+            return fingerprint["content_md5"] == entry["content_md5"]
+        return fingerprint["etag"] == entry.get("etag")
+
+    @log_function_call
+    def record(self, blob_url: str, properties):
+        """
+        Records that the blob, as described by its properties, has been processed.
+        """
+        entry = self._fingerprint(properties)
+        entry.update({"pipeline_version": self.pipeline_version, "processed_at": time.time()})
+        self.store.put(blob_url, entry)
+        return entry
+
+
+@log_function_call
+def get_local_manifest_store(path: str):
+    """
+    Returns the process-wide store for the manifest file at path, loading it on first use.
+    """
+    with _local_stores_lock:
+        if path not in _local_stores:
+            _local_stores[path] = LocalManifestStore(path)
+        return _local_stores[path]
@@ -0,0 +1,37 @@
+import os
+import sys
+import pytest
+import requests
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+scripts_dir = os.path.join(root_dir, 'scripts/')
+sys.path.append(root_dir)
+sys.path.append(scripts_dir)
+
+# The modules log to ./logs, which has to exist before they are imported
+os.makedirs("logs", exist_ok=True)
+
+
+@pytest.fixture
+def fake_services(monkeypatch):
+    """
+    Routes the shared SDK clients to the in-process stand-ins of loadtest.fakeservices, without latency.
+    """
+    import clientregistry
+    from azblobhanlder import _known_containers
+    from azcognitivesearchhandler import _known_indexes, _unsortable_key_indexes
+    from loadtest.fakeservices import FakeServices
+
+    services = FakeServices({name: {"latency": 0} for name in ("storage", "formrecognizer", "search", "openai")},
+                            analyze_seconds=0, analyze_seconds_per_page=0)
+    for name, value in services.environment().items():
+        monkeypatch.setenv(name, value)
+    session = requests.Session()
+    session.mount("https://", services.adapter)
+    clientregistry.use_session(session)
+    yield services
+    clientregistry.clear()
+    _known_containers.clear()
+    _known_indexes.clear()
+    _unsortable_key_indexes.clear()
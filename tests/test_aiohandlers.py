@@ -0,0 +1,269 @@
+import re
+import time
+import threading
+import asyncio
+from types import SimpleNamespace
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import HttpResponseError
+from openai.openai_object import OpenAIObject
+from aiohandlers import AsyncCognitiveSearchHandler, AsyncDocumentSplitter, AsyncFormRecognizerHandler
+from azblobhanlder import BlobBuffer
+from azcognitivesearchhandler import _unsortable_key_indexes
+from clientregistry import AsyncCachedTokenCredential, _shared_async_credential, aclose
+from createindexsection import create_sections
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+class FakeAsyncSearchClient():
+    """
+    An index of one file, enough for the keyset paging and the actions of sync_index_documents.
+    """
+
+    def __init__(self, sortable=True):
+        self.documents = {}
+        self.sortable = sortable
+
+    async def search(self, search_text, filter=None, select=None, order_by=None, top=None, **kwargs):
+        if order_by and not self.sortable:
+            raise HttpResponseError(message="Field 'id' is not sortable.")
+        after = re.search(r"id gt '([^']*)'", filter or "")
+        keys = sorted(key for key in self.documents if after is None or key > after.group(1))
+        return _aiter([self.documents[key] for key in keys[:top]])
+
+    async def merge_or_upload_documents(self, documents):
+        self.documents.update({document["id"]: document for document in documents})
+        return [SimpleNamespace(key=document["id"], succeeded=True, status_code=200) for document in documents]
+
+    async def delete_documents(self, documents):
+        for document in documents:
+            self.documents.pop(document["id"], None)
+        return [SimpleNamespace(key=document["id"], succeeded=True, status_code=200) for document in documents]
+
+
+class ScriptedAsyncSearchClient():
+
+    def __init__(self, statuses):
+        self.statuses = {key: list(codes) for key, codes in statuses.items()}
+
+    async def merge_or_upload_documents(self, documents):
+        results = []
+        for document in documents:
+            codes = self.statuses.get(document["id"])
+            status_code = codes.pop(0) if codes else 200
+            results.append(SimpleNamespace(key=document["id"], succeeded=status_code < 300, status_code=status_code))
+        return results
+
+
+class FakeAsyncAnalysisClient():
+    """
+    Analyzes a document into its first bytes, failing the sources in failing, and records the analyses in flight.
+    """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def begin_analyze_document(self, model_id, document, pages=None):
+        content = document.read(4)
+        client = self
+
+        class Poller():
+
+            async def result(self):
+                client.in_flight += 1
+                client.max_in_flight = max(client.max_in_flight, client.in_flight)
+                await asyncio.sleep(0.01)
+                client.in_flight -= 1
+                if content in client.failing:
+                    raise HttpResponseError(message="The file is corrupted")
+                return SimpleNamespace(content=content)
+
+        return Poller()
+
+
+def _buffer(data, source):
+    buffer = BlobBuffer(len(data), source=source, etag="0x1")
+    buffer.writer().write(data)
+    return buffer
+
+
+class FakeAsyncCredential():
+
+    def __init__(self):
+        self.requests = 0
+
+    async def get_token(self, *scopes, **kwargs):
+        self.requests += 1
+        await asyncio.sleep(0)
+        return AccessToken("token", int(time.time()) + 3600)
+
+
+class FakeCache():
+    """
+    Records the thread of every cache access, the event loop must not block on them.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.threads = set()
+
+    def make_key(self, *args):
+        return repr(args)
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        self.threads.add(threading.get_ident())
+        self.entries[key] = value
+
+
+def test_sync_index_documents_only_uploads_inserted_section(fake_services):
+    handler = AsyncCognitiveSearchHandler()
+    search_client = FakeAsyncSearchClient()
+
+    async def _create_search_client():
+        handler.search_client = search_client
+        return search_client
+
+    handler._create_search_client = _create_search_client
+
+    async def _sync():
+        await handler.sync_index_document("a.pdf", create_sections("a.pdf", [("First.", 0), ("Second.", 0), ("Third.", 1)]))
+        return await handler.sync_index_documents({"a.pdf": create_sections("a.pdf", [("First.", 0), ("Inserted.", 0),
+                                                                                      ("Third.", 1)])})
+
+    stats = asyncio.run(_sync())
+
+    assert (stats["uploaded"], stats["unchanged"], stats["deleted"], stats["failed"]) == (1, 2, 1, 0)
+    assert len(search_client.documents) == 3
+
+
+def test_sync_index_documents_reads_unsortable_keys_unordered(fake_services):
+    handler = AsyncCognitiveSearchHandler()
+    search_client = FakeAsyncSearchClient(sortable=False)
+    _unsortable_key_indexes.add(handler._index_key())
+
+    async def _create_search_client():
+        handler.search_client = search_client
+        return search_client
+
+    handler._create_search_client = _create_search_client
+
+    async def _sync():
+        await handler.sync_index_document("a.pdf", create_sections("a.pdf", [("First.", 0), ("Second.", 0)]))
+        return await handler.sync_index_document("a.pdf", create_sections("a.pdf", [("First.", 0)]))
+
+    stats = asyncio.run(_sync())
+
+    assert (stats["uploaded"], stats["unchanged"], stats["deleted"], stats["failed"]) == (0, 1, 1, 0)
+
+
+def test_send_batch_keeps_failures_of_every_attempt(fake_services):
+    handler = AsyncCognitiveSearchHandler()
+    handler.search_client = ScriptedAsyncSearchClient({"b": [429], "c": [400]})
+    batch = [{"id": key} for key in ("a", "b", "c")]
+
+    outcome = asyncio.run(handler._send_batch(batch, "merge_or_upload", max_retries=3, retry_delay=0))
+
+    assert outcome == (2, ["c"])
+
+
+def test_page_ranges_are_counted_off_the_event_loop(fake_services):
+    handler = AsyncFormRecognizerHandler()
+    handler.formrecognizer_client = FakeAsyncAnalysisClient()
+    threads = set()
+    page_ranges = handler._page_ranges
+
+    def _page_ranges(document):
+        threads.add(threading.get_ident())
+        return page_ranges(document)
+
+    handler._page_ranges = _page_ranges
+
+    async def _analyze():
+        return await handler.analyze_document(_buffer(b"%PDF-1.4", "contract.pdf")), threading.get_ident()
+
+    result, loop_thread = asyncio.run(_analyze())
+
+    assert result.content == b"%PDF"
+    assert threads and loop_thread not in threads
+
+
+def test_analyze_documents_yields_every_document(fake_services):
+    handler = AsyncFormRecognizerHandler()
+    handler.formrecognizer_client = FakeAsyncAnalysisClient(failing=[b"doc2"])
+    documents = [_buffer(f"doc{i}".encode("ascii"), f"doc{i}.pdf") for i in range(5)]
+
+    async def _analyze():
+        return [analysis async for analysis in handler.analyze_documents(documents, max_in_flight=2)]
+
+    analyses = asyncio.run(_analyze())
+
+    assert sorted(document.source for document, _, _ in analyses) == [f"doc{i}.pdf" for i in range(5)]
+    for document, result, error in analyses:
+        if document.source == "doc2.pdf":
+            assert result is None and isinstance(error, HttpResponseError)
+        else:
+            assert error is None and result.content == document.source[:4].encode("ascii")
+    assert handler.formrecognizer_client.max_in_flight == 2
+
+
+def test_async_credential_fetches_one_token_for_concurrent_callers():
+    credential = FakeAsyncCredential()
+
+    async def _get_tokens():
+        cached = AsyncCachedTokenCredential(credential)
+        return await asyncio.gather(*(cached.get_token("scope") for _ in range(5)))
+
+    tokens = asyncio.run(_get_tokens())
+
+    assert credential.requests == 1
+    assert {token.token for token in tokens} == {"token"}
+
+
+def test_aio_clients_share_a_cached_credential():
+    credential = FakeAsyncCredential()
+
+    async def _share():
+        shared = _shared_async_credential(credential)
+        try:
+            return shared, _shared_async_credential(credential), _shared_async_credential("account-key")
+        finally:
+            await aclose()
+
+    first, second, key = asyncio.run(_share())
+
+    assert isinstance(first, AsyncCachedTokenCredential) and first is second
+    assert first.credential is credential
+    # Key and SAS credentials are passed as they are
+    assert key == "account-key"
+
+
+def test_llm_cache_is_used_off_the_event_loop():
+    cache = FakeCache()
+    splitter = AsyncDocumentSplitter(api_key="key", api_base="https://openai.invalid", deployment_id="deployment", cache=cache)
+    requests = []
+
+    async def _openai_chat_request(messages):
+        requests.append(messages)
+        return OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": "{}"}}]})
+
+    splitter._openai_chat_request = _openai_chat_request
+    messages = [{"role": "user", "content": "Contract"}]
+
+    async def _chat_twice():
+        await splitter._openai_chat(messages)
+        await splitter._openai_chat(messages)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(_chat_twice())
+
+    assert len(requests) == 1
+    assert cache.threads and loop_thread not in cache.threads
@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+from azure.core.utils import CaseInsensitiveDict
+from analysisscheduler import AnalysisScheduler, ScheduledPolling
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeOperation():
+    """
+    Completes at a set time on the fake clock, and asks for a delay between polls when given one.
+    """
+
+    def __init__(self, item, clock, duration, retry_after=None, tracker=None):
+        self.item = item
+        self.clock = clock
+        self.done_at = clock() + duration
+        self._retry_after = retry_after
+        self.tracker = tracker
+        self.poll_times = []
+
+    def poll(self):
+        self.poll_times.append(self.clock())
+        if self.clock() < self.done_at:
+            return False
+        self.tracker["in_flight"] -= 1
+        return True
+
+    def retry_after(self):
+        return self._retry_after
+
+    def resource(self):
+        return f"result of {self.item}"
+
+
+def _scheduler(clock, max_in_flight):
+    return AnalysisScheduler(max_in_flight=max_in_flight, min_interval=1, max_interval=10, sleep=clock.sleep, clock=clock)
+
+
+def _begin(clock, durations, tracker, operations, retry_after=None):
+    def begin(item):
+        tracker["in_flight"] += 1
+        tracker["peak"] = max(tracker["peak"], tracker["in_flight"])
+        operations[item] = FakeOperation(item, clock, durations[item], retry_after, tracker)
+        return operations[item]
+    return begin
+
+
+def test_in_flight_operations_are_capped():
+    clock = FakeClock()
+    tracker = {"in_flight": 0, "peak": 0}
+    durations = {item: 3 for item in range(7)}
+
+    results = list(_scheduler(clock, 2).run(range(7), _begin(clock, durations, tracker, {})))
+
+    assert sorted(item for item, _, _ in results) == list(range(7))
+    assert tracker["peak"] == 2
+
+
+def test_results_are_yielded_as_operations_complete():
+    clock = FakeClock()
+    durations = {"slow": 20, "fast": 2, "medium": 8}
+
+    results = list(_scheduler(clock, 3).run(["slow", "fast", "medium"],
+                                            _begin(clock, durations, {"in_flight": 0, "peak": 0}, {})))
+
+    assert [(item, result, error) for item, result, error in results] == [
+        ("fast", "result of fast", None), ("medium", "result of medium", None), ("slow", "result of slow", None)]
+
+
+def test_polls_wait_for_retry_after():
+    clock = FakeClock()
+    operations = {}
+
+    list(_scheduler(clock, 1).run(["document"], _begin(clock, {"document": 20}, {"in_flight": 0, "peak": 0},
+                                                       operations, retry_after=7)))
+
+    poll_times = operations["document"].poll_times
+    assert all(later - earlier >= 7 for earlier, later in zip(poll_times, poll_times[1:]))
+
+
+def test_none_items_do_not_end_the_run():
+    clock = FakeClock()
+    durations = {None: 1, "next": 1}
+
+    results = list(_scheduler(clock, 1).run([None, "next"], _begin(clock, durations, {"in_flight": 0, "peak": 0}, {})))
+
+    assert [item for item, _, _ in results] == [None, "next"]
+
+
+def _polling(headers):
+    polling = ScheduledPolling()
+    polling._pipeline_response = SimpleNamespace(http_response=SimpleNamespace(headers=CaseInsensitiveDict(headers)))
+    return polling
+
+
+def test_retry_after_reads_the_response_headers():
+    assert _polling({"Retry-After": "5"}).retry_after() == 5
+    assert _polling({"retry-after-ms": "250", "Retry-After": "5"}).retry_after() == 0.25
+    assert _polling({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}).retry_after() == 0
+    assert _polling({}).retry_after() is None
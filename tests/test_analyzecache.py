@@ -0,0 +1,89 @@
+import os
+import time
+import analyzecache
+from analyzecache import AnalyzeResultCache, LocalAnalyzeResultStore, analyze_cache_from_env
+from clientregistry import get_blob_service_client
+from eventcreateandmodify import BlobCreateModifyEventHandler
+
+
+class Result():
+
+    def __init__(self, content):
+        self.content = content
+
+    def to_dict(self):
+        return {"api_version": "2023-07-31", "model_id": "prebuilt-document", "content": self.content, "pages": []}
+
+
+class CountingStore(LocalAnalyzeResultStore):
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.listings = 0
+
+    def list(self):
+        self.listings += 1
+        return super().list()
+
+
+def test_hit_survives_eviction_before_use(tmp_path):
+    cache = AnalyzeResultCache(LocalAnalyzeResultStore(str(tmp_path)))
+    key = cache.make_key("https://account/documents/contract.pdf", "0x1", "prebuilt-document")
+    cache.put(key, Result("Contract text"))
+
+    cached = cache.get(key)
+    cache.store.delete(key)
+
+    assert cached.content == "Contract text"
+
+
+def test_miss_when_not_stored(tmp_path):
+    cache = AnalyzeResultCache(LocalAnalyzeResultStore(str(tmp_path)))
+
+    assert cache.get(cache.make_key("https://account/documents/contract.pdf", "0x1", "prebuilt-document")) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_store_is_listed_only_when_over_the_limit(tmp_path):
+    store = CountingStore(str(tmp_path))
+    size = AnalyzeResultCache(store).put("probe.json.gz", Result("x" * 10))
+    store.delete("probe.json.gz")
+    store.listings = 0
+    cache = AnalyzeResultCache(store, max_bytes=size * 3)
+
+    for i in range(3):
+        cache.put(f"{i}.json.gz", Result("x" * 10))
+        os.utime(tmp_path / f"{i}.json.gz", (time.time() - 100 + i, time.time() - 100 + i))
+    # Listed once for the starting total, the puts are tracked from there
+    assert store.listings == 1
+
+    cache.put("3.json.gz", Result("x" * 10))
+
+    assert cache.stats()["evictions"] == 1
+    assert sorted(name for name, _, _ in store.list()) == ["1.json.gz", "2.json.gz", "3.json.gz"]
+
+
+def test_blob_cache_is_shared_by_the_events_of_a_process(fake_services, monkeypatch):
+    monkeypatch.setattr(analyzecache, "_caches", {})
+    monkeypatch.setenv("ANALYZE_CACHE_CONTAINER", "analyze-cache")
+    monkeypatch.delenv("ANALYZE_CACHE_PATH", raising=False)
+    handlers = [BlobCreateModifyEventHandler(blob_url=f"{fake_services.account_url}/documents/{name}", openai_api_key="key",
+                                             openai_api_base="https://openai.invalid", openai_deployment_id="deployment")
+                for name in ("a.pdf", "b.pdf")]
+
+    assert handlers[0].analyze_cache is handlers[1].analyze_cache
+    assert isinstance(handlers[0].analyze_cache.store, analyzecache.BlobAnalyzeResultStore)
+
+
+def test_blob_caches_are_kept_by_container(fake_services, monkeypatch):
+    monkeypatch.setattr(analyzecache, "_caches", {})
+    monkeypatch.delenv("ANALYZE_CACHE_PATH", raising=False)
+    blob_service_client = get_blob_service_client(account_url=fake_services.account_url, credential=None)
+
+    monkeypatch.setenv("ANALYZE_CACHE_CONTAINER", "first")
+    first = analyze_cache_from_env(blob_service_client)
+    monkeypatch.setenv("ANALYZE_CACHE_CONTAINER", "second")
+    second = analyze_cache_from_env(blob_service_client)
+
+    assert first is not second
+    assert second.store.container_client.container_name == "second"
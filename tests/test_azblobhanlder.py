@@ -0,0 +1,131 @@
+import io
+import os
+import random
+import pytest
+import azblobhanlder
+from azblobhanlder import BlobBuffer, BlobHandler, BlobUploadError
+
+CONTRACT_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "contract.pdf")
+
+
+class FakeContainerClient():
+
+    def __init__(self, existing=(), failing=()):
+        self.blobs = {name: (b"", None) for name in existing}
+        self.failing = set(failing)
+
+    def upload_blob(self, name, data, overwrite=False, metadata=None):
+        if name in self.failing:
+            raise ConnectionError(f"{name} timed out")
+        if name in self.blobs and not overwrite:
+            raise ValueError(f"{name} already exists")
+        self.blobs[name] = (data, metadata)
+
+
+def _handler(container_client):
+    handler = BlobHandler(blob_url="https://account.blob.core.windows.net/documents/contract.pdf", credential="sas")
+    handler._ensure_container = lambda container: container_client
+    return handler
+
+
+def test_upload_files_overwrites_chunks_with_metadata():
+    container_client = FakeContainerClient(existing=["contract-0.pdf"])
+    handler = _handler(container_client)
+
+    statuses = handler.upload_files([("contract-0.pdf", b"first"), ("contract-1.pdf", b"second")],
+                                    container="index", metadata={"contractName": "Supply"})
+
+    assert [status["succeeded"] for status in statuses] == [True, True]
+    assert container_client.blobs["contract-0.pdf"] == (b"first", {"contractName": "Supply"})
+
+
+def test_upload_files_raises_when_any_upload_failed():
+    container_client = FakeContainerClient(failing=["contract-1.pdf"])
+    handler = _handler(container_client)
+
+    with pytest.raises(BlobUploadError) as error:
+        handler.upload_files([("contract-0.pdf", b"first"), ("contract-1.pdf", b"second"), ("contract-2.pdf", b"third")],
+                             container="index")
+
+    assert [status["blob_name"] for status in error.value.failed] == ["contract-1.pdf"]
+    # The other uploads were still made
+    assert sorted(container_client.blobs) == ["contract-0.pdf", "contract-2.pdf"]
+
+
+
+def _data(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def _write_in_ranges(buffer, data, range_size):
+    """
+    Writes data in ranges, out of order, the way parallel ranged downloads land.
+    """
+    writer = buffer.writer()
+    starts = list(range(0, len(data), range_size))
+    random.Random(1).shuffle(starts)
+    for start in starts:
+        writer.seek(start)
+        writer.write(data[start:start + range_size])
+
+
+def test_ranges_written_out_of_order_read_back_whole():
+    data = _data(10000)
+    buffer = BlobBuffer(len(data), source="contract.pdf")
+
+    _write_in_ranges(buffer, data, 1024)
+
+    assert buffer.open().read() == data
+
+
+def test_readers_keep_their_own_position():
+    data = _data(4096)
+    buffer = BlobBuffer(len(data))
+    buffer.writer().write(data)
+    first, second = buffer.open(), buffer.open()
+
+    assert first.read(100) == data[:100]
+    assert second.read(10) == data[:10]
+    assert first.read(100) == data[100:200]
+    # Reading past the end returns what is left, then nothing
+    second.seek(-5, io.SEEK_END)
+    assert second.read(100) == data[-5:]
+    assert second.read(100) == b""
+    second.seek(-10, io.SEEK_SET)
+    assert second.tell() == 0
+
+
+def test_buffered_reader_matches_the_data():
+    data = _data(50000)
+    buffer = BlobBuffer(len(data))
+    buffer.writer().write(data)
+
+    reader = io.BufferedReader(buffer.open(), buffer_size=4096)
+    reader.seek(12345)
+
+    assert reader.read(1000) == data[12345:13345]
+    assert reader.read() == data[13345:]
+
+
+def test_memory_mapped_buffer_round_trip(monkeypatch):
+    monkeypatch.setattr(azblobhanlder, "MMAP_THRESHOLD", 1)
+    data = _data(10000)
+    buffer = BlobBuffer(len(data))
+
+    _write_in_ranges(buffer, data, 4096)
+
+    assert buffer.open().read() == data
+    buffer.close()
+
+
+def test_download_to_buffer_round_trip(fake_services):
+    with open(CONTRACT_PDF, "rb") as f:
+        data = f.read()
+    fake_services.storage.put_blob("documents", "contract.pdf", data)
+    handler = BlobHandler(blob_url=f"{fake_services.account_url}/documents/contract.pdf",
+                          credential=os.getenv("AZURE_STORAGEACCOUNT_SAS"))
+
+    buffer = handler.download_to_buffer()
+
+    assert buffer.size == len(data)
+    assert buffer.open().read() == data
@@ -0,0 +1,149 @@
+import json
+from types import SimpleNamespace
+from azcognitivesearchhandler import CognitiveSearchHandler, _known_indexes
+from createindexsection import create_sections
+
+
+class ScriptedSearchClient():
+    """
+    Answers each indexing request with the status codes scripted for its keys, 200 once a key has none left.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = {key: list(codes) for key, codes in statuses.items()}
+        self.requests = []
+
+    def merge_or_upload_documents(self, documents):
+        self.requests.append([document["id"] for document in documents])
+        results = []
+        for document in documents:
+            codes = self.statuses.get(document["id"])
+            status_code = codes.pop(0) if codes else 200
+            results.append(SimpleNamespace(key=document["id"], succeeded=status_code < 300, status_code=status_code))
+        return results
+
+
+def _sections(filename, count):
+    return [{"id": f"{filename.replace('.', '-')}-{i:03d}", "content": f"Section {i}", "category": "",
+             "sourcepage": f"{filename}-{i}", "sourcefile": filename, "contenthash": str(i)} for i in range(count)]
+
+
+def _make_key_unsortable(fake_services):
+    """
+    Turns the index into one created before its key field was sortable.
+    """
+    CognitiveSearchHandler().create_search_index()
+    for field in fake_services.search.indexes["loadtest"]["fields"]:
+        if field["name"] == "id":
+            field["sortable"] = False
+    _known_indexes.clear()
+
+
+def _index(sections):
+    handler = CognitiveSearchHandler()
+    handler.upload_index_document("batch", sections)
+    return handler
+
+
+def test_iter_by_key_pages_in_key_order(fake_services):
+    sections = _sections("a.pdf", 17) + _sections("b.pdf", 5)
+    handler = _index(sections)
+    queries = fake_services.search.requests
+
+    keys = [r["id"] for r in handler._iter_by_key(handler._sourcefile_filter(["a.pdf"]), select=["id"], page_size=5)]
+
+    assert keys == sorted(section["id"] for section in sections if section["sourcefile"] == "a.pdf")
+    # Three full pages and a partial one
+    assert fake_services.search.requests - queries == 4
+
+
+def test_index_with_unsortable_key_is_read_unordered(fake_services):
+    _make_key_unsortable(fake_services)
+    handler = _index(_sections("a.pdf", 3) + _sections("b.pdf", 2))
+
+    assert not handler._keys_sortable()
+    assert handler.get_indexed_hashes("b.pdf") == {"b-pdf-000": "0", "b-pdf-001": "1"}
+    stats = handler.sync_index_document("a.pdf", _sections("a.pdf", 2))
+    assert (stats["uploaded"], stats["unchanged"], stats["deleted"]) == (0, 2, 1)
+    assert handler.remove_from_index(["a.pdf"]) == {"deleted": 2, "remaining": 0}
+    assert sorted(fake_services.search.documents["loadtest"]) == ["b-pdf-000", "b-pdf-001"]
+
+
+def test_get_indexed_hashes(fake_services):
+    handler = _index(_sections("a.pdf", 3) + _sections("b.pdf", 2))
+
+    assert handler.get_indexed_hashes("b.pdf") == {"b-pdf-000": "0", "b-pdf-001": "1"}
+
+
+def test_remove_from_index_with_no_files_deletes_nothing(fake_services):
+    handler = _index(_sections("a.pdf", 3))
+
+    assert handler.remove_from_index([], confirm=False)["deleted"] == 0
+    assert len(fake_services.search.documents["loadtest"]) == 3
+
+
+def test_remove_from_index_deletes_only_the_files(fake_services):
+    handler = _index(_sections("a.pdf", 3) + _sections("b.pdf", 2))
+
+    stats = handler.remove_from_index(["a.pdf"])
+
+    assert stats == {"deleted": 3, "remaining": 0}
+    assert sorted(fake_services.search.documents["loadtest"]) == ["b-pdf-000", "b-pdf-001"]
+
+
+def test_sync_index_document_only_uploads_inserted_section(fake_services):
+    handler = CognitiveSearchHandler()
+    handler.sync_index_document("a.pdf", create_sections("a.pdf", [("First.", 0), ("Second.", 0), ("Third.", 1)]))
+
+    stats = handler.sync_index_document("a.pdf", create_sections("a.pdf", [("First.", 0), ("Inserted.", 0),
+                                                                           ("Second.", 0), ("Third.", 1)]))
+
+    assert (stats["uploaded"], stats["unchanged"], stats["deleted"]) == (1, 3, 0)
+
+
+def test_iter_batches_cuts_by_count(fake_services):
+    handler = CognitiveSearchHandler()
+    sections = _sections("a.pdf", 7)
+
+    batches = list(handler._iter_batches(sections, batch_size=3, max_batch_bytes=1024 * 1024))
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [section for batch in batches for section in batch] == sections
+
+
+def test_iter_batches_cuts_by_size(fake_services):
+    handler = CognitiveSearchHandler()
+    sections = _sections("a.pdf", 5)
+    # Room for two sections but not three
+    max_batch_bytes = 2 * (len(json.dumps(sections[0])) + len('"@search.action":"mergeOrUpload",')) + 1
+
+    batches = list(handler._iter_batches(sections, batch_size=1000, max_batch_bytes=max_batch_bytes))
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_iter_batches_keeps_oversized_section_alone(fake_services):
+    handler = CognitiveSearchHandler()
+    sections = _sections("a.pdf", 3)
+
+    assert [len(batch) for batch in handler._iter_batches(sections, batch_size=1000, max_batch_bytes=1)] == [1, 1, 1]
+
+
+def test_send_batch_keeps_failures_of_every_attempt(fake_services):
+    handler = CognitiveSearchHandler()
+    handler.search_client = ScriptedSearchClient({"a-pdf-001": [429], "a-pdf-002": [400]})
+
+    succeeded, failed_keys = handler._send_batch(_sections("a.pdf", 3), "merge_or_upload", max_retries=3, retry_delay=0)
+
+    # Only the throttled section is sent again, the rejected one is still reported
+    assert handler.search_client.requests == [["a-pdf-000", "a-pdf-001", "a-pdf-002"], ["a-pdf-001"]]
+    assert (succeeded, failed_keys) == (2, ["a-pdf-002"])
+
+
+def test_send_batch_reports_sections_still_throttled_after_the_last_retry(fake_services):
+    handler = CognitiveSearchHandler()
+    handler.search_client = ScriptedSearchClient({"a-pdf-000": [429, 429, 429], "a-pdf-001": [400]})
+
+    succeeded, failed_keys = handler._send_batch(_sections("a.pdf", 3), "merge_or_upload", max_retries=2, retry_delay=0)
+
+    assert (succeeded, failed_keys) == (1, ["a-pdf-000", "a-pdf-001"])
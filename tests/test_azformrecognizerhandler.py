@@ -0,0 +1,46 @@
+from analyzecache import analyze_result_from_dict
+from azformrecognizerhandler import merge_analyze_results
+from benchmarks.synthetic import make_analyze_result_dict
+from documentprocessing import ProcessDocument
+
+
+def _shift(value, offset_shift, page_shift):
+    if isinstance(value, list):
+        return [_shift(item, offset_shift, page_shift) for item in value]
+    if not isinstance(value, dict):
+        return value
+    shifted = {key: _shift(item, offset_shift, page_shift) for key, item in value.items()}
+    if isinstance(shifted.get("offset"), int) and "length" in shifted:
+        shifted["offset"] += offset_shift
+    if isinstance(shifted.get("page_number"), int):
+        shifted["page_number"] += page_shift
+    return shifted
+
+
+def _analyze_range(data, first, last, numbered_from_one):
+    """
+    Returns what the service answers for the pages first to last of the document of data: the
+    content of those pages alone, with offsets into it and, for some API versions, pages numbered from 1.
+    """
+    pages = [page for page in data["pages"] if first <= page["page_number"] <= last]
+    start = pages[0]["spans"][0]["offset"]
+    end = pages[-1]["spans"][0]["offset"] + pages[-1]["spans"][0]["length"]
+    tables = [table for table in data["tables"] if first <= table["bounding_regions"][0]["page_number"] <= last]
+    partial = dict(data, content=data["content"][start:end], pages=pages, tables=tables)
+    return analyze_result_from_dict(_shift(partial, -start, 1 - first if numbered_from_one else 0))
+
+
+def _page_map(result):
+    return list(ProcessDocument(form_recognizer_results=result).get_page_map())
+
+
+def test_merged_ranges_give_the_page_map_of_the_whole_document():
+    data = make_analyze_result_dict(pages=7, lines_per_page=5, tables_per_page=2, rows=3, columns=2, seed=3)
+    page_ranges = [(1, 3), (4, 6), (7, 7)]
+
+    for numbered_from_one in (True, False):
+        partials = [_analyze_range(data, first, last, numbered_from_one) for first, last in page_ranges]
+        merged = merge_analyze_results(partials, [first for first, _ in page_ranges])
+
+        assert [page.page_number for page in merged.pages] == list(range(1, 8))
+        assert _page_map(merged) == _page_map(analyze_result_from_dict(data))
@@ -0,0 +1,28 @@
+from createindexsection import create_sections
+
+
+def _ids(sections):
+    return [document["id"] for document in create_sections("contract.pdf", sections)]
+
+
+def test_inserted_section_keeps_the_ids_after_it():
+    before = [("First.", 0), ("Second.", 0), ("Third.", 1)]
+    after = [("First.", 0), ("Inserted.", 0), ("Second.", 0), ("Third.", 1)]
+
+    ids_before = _ids(before)
+    ids_after = _ids(after)
+
+    assert ids_after[0] == ids_before[0]
+    assert ids_after[2:] == ids_before[1:]
+    assert ids_after[1] not in ids_before
+
+
+def test_repeated_sections_get_distinct_ids():
+    ids = _ids([("Same.", 0), ("Same.", 1), ("Same.", 2)])
+
+    assert len(set(ids)) == 3
+
+
+def test_ids_are_valid_keys():
+    for document_id in _ids([("Ünïcode text, with punctuation!", 0)]):
+        assert all(char.isascii() and (char.isalnum() or char in "_-") for char in document_id)
@@ -0,0 +1,305 @@
+import html
+import random
+from types import SimpleNamespace
+from azure.ai.formrecognizer import AnalyzeResult
+from documentprocessing import PageMap, ProcessDocument
+
+
+def _line(content, offset):
+    return {"content": content, "polygon": [], "spans": [{"offset": offset, "length": len(content)}]}
+
+
+def _words(content, offset):
+    words = []
+    for word in content.split(" "):
+        words.append({"content": word, "polygon": [], "confidence": 1.0, "span": {"offset": offset, "length": len(word)}})
+        offset += len(word) + 1
+    return words
+
+
+def _analyze_result():
+    """
+    Builds a two page AnalyzeResult from a to_dict payload, as the service returns it: every span,
+    including the page spans, is an offset into the content of the whole document.
+    """
+    pages = []
+    tables = []
+    content = ""
+    for page_number, (before, cells, after) in enumerate([("First page line.", [], ""),
+                                                          ("Second page line.", [["Name", "Qty"], ["Bolt", "4"]], "Last line.")],
+                                                         start=1):
+        page_start = len(content)
+        lines = [_line(before, page_start)]
+        words = _words(before, page_start)
+        content += before + "\n"
+        if cells:
+            table_start = len(content)
+            table_cells = []
+            for row, row_cells in enumerate(cells):
+                for column, text in enumerate(row_cells):
+                    table_cells.append({"kind": "columnHeader" if row == 0 else "content", "row_index": row,
+                                        "column_index": column, "row_span": 1, "column_span": 1, "content": text,
+                                        "bounding_regions": [{"page_number": page_number, "polygon": []}],
+                                        "spans": [{"offset": len(content), "length": len(text)}]})
+                    content += text + "\n"
+            tables.append({"row_count": len(cells), "column_count": len(cells[0]), "cells": table_cells,
+                           "bounding_regions": [{"page_number": page_number, "polygon": []}],
+                           "spans": [{"offset": table_start, "length": len(content) - table_start}]})
+        if after:
+            lines.append(_line(after, len(content)))
+            words.extend(_words(after, len(content)))
+            content += after + "\n"
+        pages.append({"page_number": page_number, "angle": 0, "width": 8.5, "height": 11, "unit": "inch",
+                      "spans": [{"offset": page_start, "length": len(content) - page_start}],
+                      "lines": lines, "words": words, "selection_marks": []})
+    result = AnalyzeResult.from_dict({"api_version": "2023-07-31", "model_id": "prebuilt-document", "content": content,
+                                      "pages": pages, "tables": tables, "paragraphs": [], "key_value_pairs": [],
+                                      "styles": [], "languages": [], "documents": []})
+    # from_dict leaves the lines unlinked from their page, which DocumentLine.get_words needs
+    for page in result.pages:
+        for line in page.lines:
+            line._parent = page
+    return result
+
+
+def test_get_document_text_reads_page_text_from_content():
+    processor = ProcessDocument(form_recognizer_results=_analyze_result())
+    page_map = processor._get_document_text()
+
+    pages = list(page_map)
+    assert [page_num for page_num, _, _ in pages] == [0, 1]
+    assert pages[0][2] == "First page line. First page line.\n"
+    table = ("<table><tr><th>Name</th><th>Qty</th></tr>"
+             "<tr><td>Bolt</td><td>4</td></tr></table>")
+    assert pages[1][2] == "Second page line. Last line. Second page line.\n" + table + "Last line.\n"
+
+
+def test_split_text_on_analyze_result():
+    processor = ProcessDocument(form_recognizer_results=_analyze_result())
+    processor.SECTION_OVERLAP = 10
+
+    sections = processor.split_text()
+
+    assert sections
+    assert "<table>" in "".join(text for text, _ in sections)
+
+
+def test_get_content_holds_every_page_once():
+    result = _analyze_result()
+    processor = ProcessDocument(form_recognizer_results=result)
+
+    content = processor.get_content()
+
+    assert content == result.content
+    assert content.count("Second page line.") == 1
+    assert processor.get_page_map().text.count("Second page line.") == 2
+
+
+def _table(spans, page_number=1, cells=(), row_count=0, column_count=0):
+    return SimpleNamespace(spans=[SimpleNamespace(offset=offset, length=length) for offset, length in spans],
+                           bounding_regions=[SimpleNamespace(page_number=page_number)], cells=list(cells),
+                           row_count=row_count, column_count=column_count)
+
+
+def _previous_table_chars(text, tables):
+    # The per-character marking that _get_table_spans replaced
+    table_chars = [-1] * len(text)
+    for table_id, table in enumerate(tables):
+        for span in table.spans:
+            for i in range(span.offset, span.offset + span.length):
+                if 0 <= i < len(table_chars):
+                    table_chars[i] = table_id
+    return table_chars
+
+
+def _previous_page_text(processor, text, table_chars, tables_on_page):
+    page_text = ""
+    added_tables = set()
+    for idx, char in enumerate(text):
+        if table_chars[idx] == -1:
+            page_text += char
+        else:
+            table_id = table_chars[idx]
+            if table_id not in added_tables:
+                page_text += processor._table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+    return page_text
+
+
+def _chars_from_spans(text_length, table_spans):
+    table_chars = [-1] * text_length
+    for start, end, table_id in table_spans:
+        table_chars[start:end] = [table_id] * (end - start)
+    return table_chars
+
+
+def test_table_spans_match_previous_marking():
+    rng = random.Random(1)
+    text = "".join(rng.choice("abc. ") for _ in range(200))
+    cases = [
+        [],
+        [_table([(10, 20)]), _table([(50, 30)])],
+        # Overlapping spans, the later table owns the overlap
+        [_table([(10, 40)]), _table([(30, 40)]), _table([(35, 5)])],
+        [_table([(60, 10)]), _table([(0, 100)])],
+        # Several spans per table, touching and out of the page
+        [_table([(0, 5), (5, 5), (190, 30)]), _table([(-10, 15), (100, 0)])],
+    ]
+    cases += [[_table([(rng.randrange(-20, 220), rng.randrange(0, 60)) for _ in range(rng.randrange(1, 3))])
+               for _ in range(rng.randrange(1, 5))] for _ in range(200)]
+
+    for tables in cases:
+        processor = ProcessDocument(form_recognizer_results=SimpleNamespace(tables=tables))
+        processor._table_to_html = lambda table, tables=tables: f"<table{tables.index(table)}>"
+        table_spans = processor._get_table_spans(len(text), tables)
+
+        assert _chars_from_spans(len(text), table_spans) == _previous_table_chars(text, tables)
+        assert (processor._generate_page_text(text, table_spans, tables)
+                == _previous_page_text(processor, text, _previous_table_chars(text, tables), tables))
+
+
+def test_table_spans_are_relative_to_the_page():
+    tables = [_table([(1010, 5)]), _table([(995, 10)])]
+    processor = ProcessDocument(form_recognizer_results=SimpleNamespace(tables=tables))
+
+    assert processor._get_table_spans(20, tables, page_offset=1000) == [(0, 5, 1), (10, 15, 0)]
+
+
+def _previous_table_to_html(table):
+    # Scans all cells once per row, as before the table index
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index)
+            for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html += "</tr>"
+    table_html += "</table>"
+    return table_html
+
+
+def _random_table(rng, page_count):
+    row_count, column_count = rng.randrange(1, 6), rng.randrange(1, 5)
+    cells = []
+    for row in range(row_count):
+        for column in range(column_count):
+            if rng.random() < 0.2:
+                continue  # Covered by a spanning cell
+            kind = rng.choice(["columnHeader", "rowHeader", "content", "content"])
+            cells.append(SimpleNamespace(kind=kind, row_index=row, column_index=column, row_span=rng.choice([1, 1, 2]),
+                                         column_span=rng.choice([1, 1, 3]), content=rng.choice(["a", "<b>", "x & y", ""])))
+    rng.shuffle(cells)
+    return _table([], page_number=rng.randrange(1, page_count + 1), cells=cells, row_count=row_count,
+                  column_count=column_count)
+
+
+def test_table_index_matches_previous_rendering():
+    rng = random.Random(3)
+    for _ in range(50):
+        tables = [_random_table(rng, page_count=4) for _ in range(rng.randrange(0, 8))]
+        processor = ProcessDocument(form_recognizer_results=SimpleNamespace(tables=tables))
+        processor._build_table_index()
+
+        for page_number in range(1, 6):
+            on_page = [table for table in tables if table.bounding_regions[0].page_number == page_number]
+            assert processor._get_tables_on_page(page_number) == on_page
+        for table in tables:
+            assert processor._table_to_html(table) == _previous_table_to_html(table)
+
+
+def test_table_index_without_tables():
+    processor = ProcessDocument(form_recognizer_results=SimpleNamespace(tables=None))
+
+    assert processor._build_table_index() == {}
+    assert processor._get_tables_on_page(1) == []
+
+
+def _previous_sentence_end(processor, text, end, length):
+    # Walks the text character by character, as before the boundary index
+    last_word = -1
+    while end < length and (end - processor.MAX_SECTION_LENGTH) < processor.SENTENCE_SEARCH_LIMIT and text[end] not in processor.SENTENCE_ENDINGS:
+        if text[end] in processor.WORDS_BREAKS:
+            last_word = end
+        end += 1
+    if end < length and text[end] not in processor.SENTENCE_ENDINGS and last_word > 0:
+        end = last_word
+    return min(end + 1, length)
+
+
+def _previous_sentence_start(processor, text, start, end):
+    last_word = -1
+    while start > 0 and (end - start - processor.MAX_SECTION_LENGTH) < processor.SENTENCE_SEARCH_LIMIT and text[start] not in processor.SENTENCE_ENDINGS:
+        if text[start] in processor.WORDS_BREAKS:
+            last_word = start
+        start -= 1
+    if start > 0 and text[start] not in processor.SENTENCE_ENDINGS and last_word > 0:
+        start = last_word
+    return max(start + 1, 0)
+
+
+def _previous_sections(processor, text):
+    sections = []
+    length = len(text)
+    start = 0
+    while start + processor.SECTION_OVERLAP < length:
+        end = min(start + processor.MAX_SECTION_LENGTH, length)
+        end = _previous_sentence_end(processor, text, end, length)
+        start = _previous_sentence_start(processor, text, start, end)
+        section_text = text[start:end]
+        sections.append(section_text)
+        last_table_start = section_text.rfind("<table")
+        if last_table_start > 2 * processor.SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table"):
+            start = min(end - processor.SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - processor.SECTION_OVERLAP
+    if start + processor.SECTION_OVERLAP < end:
+        sections.append(text[start:end])
+    return sections
+
+
+def _text_processor(text, max_section_length, search_limit, overlap):
+    processor = ProcessDocument(form_recognizer_results=None)
+    processor.MAX_SECTION_LENGTH, processor.SENTENCE_SEARCH_LIMIT, processor.SECTION_OVERLAP = (max_section_length,
+                                                                                              search_limit, overlap)
+    processor.page_map = PageMap()
+    processor.page_map.append(0, text)
+    return processor
+
+
+def test_boundaries_match_previous_scan():
+    rng = random.Random(4)
+    for max_section_length, search_limit in [(40, 10), (60, 30), (1000, 100)]:
+        for length in [0, 1, 5, 37, 90, 250]:
+            text = "".join(rng.choice("ab ab,.;\n?") for _ in range(length))
+            processor = _text_processor(text, max_section_length, search_limit, overlap=10)
+
+            for end in range(length + 1):
+                assert (processor._find_sentence_end(text, end, length)
+                        == _previous_sentence_end(processor, text, end, length))
+            for end in range(1, length + 1):
+                for start in range(end):
+                    assert (processor._find_sentence_start(text, start, end)
+                            == _previous_sentence_start(processor, text, start, end))
+
+
+def test_sections_match_previous_split():
+    rng = random.Random(5)
+    for _ in range(20):
+        words = [rng.choice(["Contract", "term", "price,", "goods.", "<table><tr><td>x</td></tr></table>", "end!"])
+                 for _ in range(rng.randrange(30, 400))]
+        text = " ".join(words)
+        processor = _text_processor(text, max_section_length=120, search_limit=20, overlap=15)
+
+        assert [section for section, _ in processor.iter_sections()] == _previous_sections(processor, text)
+
+
+def test_text_shorter_than_overlap_is_one_section():
+    processor = _text_processor("Short contract.", max_section_length=1000, search_limit=100, overlap=100)
+
+    assert processor.split_text() == [("Short contract.", 0)]
+    assert _text_processor("", 1000, 100, 100).split_text() == []
@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import pytest
+from langchain.docstore.document import Document
+from langchain.document_loaders import PyPDFLoader
+from openai.openai_object import OpenAIObject
+from azblobhanlder import BlobBuffer
+from documentsplitter import DocumentSplitter, _ConvergenceDetector, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, PACK_MARGIN_TOKENS
+
+CONTRACT_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "contract.pdf")
+
+FILLED = {"contractName": "Supply agreement", "contractID": "SA-2024-001", "contractDate": "01012024",
+          "buyerName": "Contoso Ltd", "sellerName": "Fabrikam Inc"}
+
+
+def _words(text):
+    return len(text.split())
+
+
+@pytest.fixture
+def splitter():
+    splitter = DocumentSplitter(api_key="key", api_base="https://openai.invalid", deployment_id="deployment")
+    # tiktoken downloads its encodings, count words instead
+    splitter._count_tokens = _words
+    return splitter
+
+
+def _answer(metadata):
+    return OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": json.dumps(metadata)}}]})
+
+
+def _contract(sentences):
+    return " ".join(f"Clause {i} binds the buyer and the seller to the terms." for i in range(sentences))
+
+
+def test_pack_chunks_keeps_every_sentence_once_in_order(splitter):
+    text = _contract(200)
+    chunks = splitter._text_splitter(text)
+
+    packs = splitter._pack_chunks(chunks, max_tokens=600)
+
+    assert 1 < len(packs) < len(chunks)
+    # The overlap of consecutive chunks is sent once, so the packs read as the text itself
+    assert " ".join(pack.page_content for pack in packs).split() == text.split()
+    clauses = [int(number) for number in re.findall(r"Clause\s+(\d+)", " ".join(pack.page_content for pack in packs))]
+    assert clauses == list(range(200))
+    assert sum(pack.metadata["chunks"] for pack in packs) == len(chunks)
+
+
+def test_pack_chunks_stays_within_budget(splitter):
+    chunks = splitter._text_splitter(_contract(200))
+
+    packs = splitter._pack_chunks(chunks, max_tokens=600)
+
+    assert all(_words(pack.page_content) <= 600 for pack in packs)
+    # Each pack is as full as the next chunk allows
+    for pack, following in zip(packs, packs[1:]):
+        assert _words(pack.page_content) + _words(following.page_content.split("\n")[0]) > 600
+
+
+def test_pack_chunks_sends_oversized_chunk_alone(splitter):
+    chunks = [Document(page_content="short one"), Document(page_content=" ".join(["word"] * 50)),
+              Document(page_content="short two")]
+
+    packs = splitter._pack_chunks(chunks, max_tokens=10)
+
+    assert [pack.metadata["chunks"] for pack in packs] == [1, 1, 1]
+
+
+def test_overlap_is_the_tail_of_the_previous_chunk(splitter):
+    chunks = splitter._text_splitter(_contract(20))
+
+    for previous, chunk in zip(chunks, chunks[1:]):
+        overlap = splitter._overlap(previous, chunk)
+        assert overlap > 0
+        assert previous.page_content.endswith(chunk.page_content[:overlap])
+        assert not previous.page_content.endswith(chunk.page_content[:overlap + 1])
+
+
+def test_overlap_is_not_carried_across_pages(splitter):
+    previous = Document(page_content="The buyer pays", metadata={"page": 0, "start_index": 0})
+    chunk = Document(page_content="pays on delivery", metadata={"page": 1, "start_index": 10})
+
+    assert splitter._overlap(previous, chunk) == 0
+    assert splitter._overlap(None, chunk) == 0
+
+
+def test_pack_budget_is_net_of_prompt_and_reply(splitter):
+    splitter.token_budget = 8000
+    system_prompt = splitter.system_prompt_template.format(metadata=splitter.few_shot_metadata,
+                                                           few_shot_metadata=splitter.few_shot_metadata)
+    reply_tokens = splitter.chat_parameters["max_tokens"]
+    available = 8000 - _words(system_prompt) - reply_tokens - TOKENS_PER_REPLY - PACK_MARGIN_TOKENS
+
+    assert splitter._pack_budget("map_reduce") == available - 2 * TOKENS_PER_MESSAGE
+    # Sequential requests also carry the previous text and answer
+    assert splitter._pack_budget("sequential") == (available - reply_tokens - 3 * TOKENS_PER_MESSAGE) // 2
+
+
+def test_pack_budget_too_small_raises(splitter):
+    splitter.token_budget = 500
+
+    with pytest.raises(ValueError):
+        splitter._pack_budget("map_reduce")
+
+
+def test_detector_stops_after_unchanged_answers(splitter):
+    detector = _ConvergenceDetector(splitter, rounds=2)
+
+    assert [detector.update(json.dumps(FILLED)) for _ in range(3)] == [False, False, True]
+
+
+def test_detector_waits_for_every_field(splitter):
+    detector = _ConvergenceDetector(splitter, rounds=1)
+    partial = dict(FILLED, sellerName="<companyname>")
+
+    assert [detector.update(json.dumps(partial)) for _ in range(3)] == [False, False, False]
+    assert detector.update(json.dumps(FILLED)) is False
+    assert detector.update(json.dumps(FILLED)) is True
+
+
+def test_detector_resets_when_the_answer_changes(splitter):
+    detector = _ConvergenceDetector(splitter, rounds=2)
+    changed = dict(FILLED, contractDate="02012024")
+
+    answers = [FILLED, FILLED, changed, changed, changed]
+
+    assert [detector.update(json.dumps(answer)) for answer in answers] == [False, False, False, False, True]
+
+
+def test_detector_resets_on_unparsable_answer(splitter):
+    detector = _ConvergenceDetector(splitter, rounds=1)
+
+    assert detector.update(json.dumps(FILLED)) is False
+    assert detector.update("not json at all") is False
+    assert detector.update(json.dumps(FILLED)) is False
+    assert detector.update(json.dumps(FILLED)) is True
+
+
+@pytest.mark.parametrize("rounds", [None, 0])
+def test_detector_without_rounds_never_stops(splitter, rounds):
+    detector = _ConvergenceDetector(splitter, rounds=rounds)
+
+    assert not any(detector.update(json.dumps(FILLED)) for _ in range(10))
+
+
+def test_sequential_split_stops_once_converged(splitter):
+    splitter.early_stop_rounds = 2
+    requests = []
+
+    def _openai_chat(messages):
+        requests.append(messages)
+        return _answer(FILLED)
+
+    splitter._openai_chat = _openai_chat
+
+    result = splitter.split_text(_contract(200))
+
+    assert len(requests) == 3
+    assert result["metadata"] == FILLED
+    assert result["stats"]["requests"] == 3
+    assert result["stats"]["calls_saved"] == result["stats"]["requests_planned"] - 3 > 0
+
+
+def test_merge_partials_keeps_first_real_value_in_document_order(splitter):
+    partials = [{"contractName": "<contractname>", "buyerName": "Contoso Ltd"},
+                {},
+                {"contractName": "Supply agreement", "buyerName": "Northwind", "contractDate": "  "},
+                {"contractName": "Amendment", "contractDate": "01012024", "sellerName": None}]
+
+    assert splitter._merge_partials(partials) == {"contractName": "Supply agreement", "contractID": "<contractid-withoutspace>",
+                                                  "contractDate": "01012024", "buyerName": "Contoso Ltd",
+                                                  "sellerName": "<companyname>"}
+
+
+def test_map_reduce_split_merges_partials_and_skips_invalid_json(splitter):
+    requests = []
+
+    def _openai_chat(messages):
+        text = messages[-1]["content"]
+        requests.append(text)
+        first = int(re.search(r"Clause\s+(\d+)", text).group(1))
+        if first == 0:
+            return _answer({"contractName": "<contractname>", "contractID": "SA-2024-001", "contractDate": "",
+                            "buyerName": "Contoso Ltd", "sellerName": "<companyname>"})
+        if first < 100:
+            return OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": "No metadata"}}]})
+        return _answer({"contractName": "Supply agreement", "contractID": "SA-2024-999", "contractDate": "01012024",
+                        "buyerName": "Northwind", "sellerName": "Fabrikam Inc"})
+
+    splitter._openai_chat = _openai_chat
+
+    result = splitter.split_text(_contract(200), mode="map_reduce", max_concurrency=3, group_size=2)
+
+    assert len(requests) == result["stats"]["requests"] > 2
+    # Every chunk is sent in exactly one group
+    clauses = sorted(int(number) for text in requests for number in re.findall(r"Clause\s+(\d+)", text))
+    assert sorted(set(clauses)) == list(range(200))
+    assert result["metadata"] == {"contractName": "Supply agreement", "contractID": "SA-2024-001",
+                                  "contractDate": "01012024", "buyerName": "Contoso Ltd", "sellerName": "Fabrikam Inc"}
+
+
+def test_buffered_pages_match_pypdfloader(splitter):
+    with open(CONTRACT_PDF, "rb") as f:
+        data = f.read()
+    buffer = BlobBuffer(len(data), source=CONTRACT_PDF)
+    buffer.writer().write(data)
+
+    pages = splitter._load_pages(buffer)
+    expected = PyPDFLoader(CONTRACT_PDF).load_and_split()
+
+    assert len(pages) == len(expected) >= 3
+    assert all(page.page_content for page in pages)
+    assert [page.page_content for page in pages] == [page.page_content for page in expected]
+    assert [page.metadata for page in pages] == [page.metadata for page in expected]
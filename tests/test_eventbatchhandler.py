@@ -0,0 +1,93 @@
+import eventbatchhandler
+from eventbatchhandler import BlobEventBatchHandler
+from createindexsection import create_sections
+
+
+class FakeSplitter():
+    metadata_list = []
+
+
+class FakePipeline():
+
+    def __init__(self, filename, sections):
+        self.filename = filename
+        self.sections = sections
+        self.doc_splitter = FakeSplitter()
+
+    def iter_index_sections(self):
+        return create_sections(self.filename, self.sections)
+
+
+def _result(url, sections):
+    return {"url": url, "handler": None, "pipeline": FakePipeline(url.rsplit("/", 1)[1], sections), "status": "processed"}
+
+
+def _batch_handler():
+    return BlobEventBatchHandler(events=[], openai_api_key="key", openai_api_base="https://openai.invalid",
+                                 openai_deployment_id="deployment", max_concurrency=1)
+
+
+def test_blobs_with_the_same_name_are_synced_in_order(fake_services):
+    first = _result("https://account.blob.core.windows.net/a/contract.pdf", [("Old text.", 0)])
+    other = _result("https://account.blob.core.windows.net/a/other.pdf", [("Other text.", 0)])
+    second = _result("https://account.blob.core.windows.net/b/contract.pdf", [("New text.", 0)])
+
+    index_stats = _batch_handler()._sync_index([first, other, second])
+
+    assert len(index_stats) == 2
+    assert [result["status"] for result in (first, other, second)] == ["processed"] * 3
+    contents = sorted(document["content"] for document in fake_services.search.documents["loadtest"].values())
+    assert contents == ["New text.", "Other text."]
+
+
+def test_documents_with_failed_sections_are_failed(monkeypatch):
+    def _sync_index_documents(self, sections_by_file):
+        for sections in sections_by_file.values():
+            list(sections)
+        return {"uploaded": 1, "unchanged": 0, "deleted": 0, "failed": 1, "failed_ids": ["x"],
+                "failed_by_file": {"broken.pdf": ["x"]}}
+
+    monkeypatch.setattr(eventbatchhandler.CognitiveSearchHandler, "sync_index_documents", _sync_index_documents)
+    monkeypatch.setattr(eventbatchhandler.CognitiveSearchHandler, "__init__", lambda self, metadata_fields=None: None)
+    good = _result("https://account.blob.core.windows.net/a/good.pdf", [("Good.", 0)])
+    broken = _result("https://account.blob.core.windows.net/a/broken.pdf", [("Broken.", 0)])
+
+    _batch_handler()._sync_index([good, broken])
+
+    assert good["status"] == "processed"
+    assert broken["status"] == "failed"
+
+
+def _event(url):
+    return {"eventType": "Microsoft.Storage.BlobCreated", "data": {"api": "PutBlob", "url": url}}
+
+
+def test_unified_batch_is_analyzed_together(fake_services, monkeypatch):
+    import openai
+    import requests
+    from benchmarks import synthetic
+
+    session = requests.Session()
+    session.mount("https://", fake_services.adapter)
+    monkeypatch.setattr(openai, "requestssession", session, raising=False)
+    monkeypatch.setenv("INGESTION_MODE", "unified")
+    monkeypatch.setenv("FORMRECOGNIZER_POLL_INTERVAL", "0.01")
+    for name in ("LLM_CACHE_PATH", "ANALYZE_CACHE_PATH", "ANALYZE_CACHE_CONTAINER", "PROCESSING_MANIFEST_PATH",
+                 "PROCESSING_MANIFEST_CONTAINER"):
+        monkeypatch.delenv(name, raising=False)
+    fake_services.storage.containers.setdefault("documents", {})
+    urls = []
+    for i in range(3):
+        fake_services.storage.put_blob("documents", f"document-{i}.pdf", synthetic.make_pdf(pages=1, seed=i))
+        urls.append(f"{fake_services.account_url}/documents/document-{i}.pdf")
+    handler = BlobEventBatchHandler(events=[_event(url) for url in urls], openai_api_key="loadtest",
+                                    openai_api_base=fake_services.environment()["AZURE_OPENAI_ENDPOINT"],
+                                    openai_deployment_id="loadtest", max_concurrency=2)
+
+    summary = handler.process()
+
+    assert summary["failed"] == 0
+    assert [document["status"] for document in summary["documents"]] == ["processed"] * 3
+    assert fake_services.formrecognizer.stats()["requests"] >= 6
+    sourcefiles = {document["sourcefile"] for document in fake_services.search.documents["loadtest"].values()}
+    assert sourcefiles == {f"document-{i}.pdf" for i in range(3)}
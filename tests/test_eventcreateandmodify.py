@@ -0,0 +1,73 @@
+import pytest
+from azblobhanlder import BlobUploadError
+from azcognitivesearchhandler import IndexingError
+from eventcreateandmodify import BlobCreateModifyEventHandler
+
+
+class FakePipeline():
+
+    def __init__(self, index_stats):
+        self.filename = "contract.pdf"
+        self.index_stats = index_stats
+
+    def run(self):
+        return {"metadata": {}, "split_stats": None, "upload_status": [], "index_stats": self.index_stats}
+
+
+class FailingUploads():
+
+    def __init__(self, blob_handler):
+        self.blob_handler = blob_handler
+
+    def __getattr__(self, name):
+        return getattr(self.blob_handler, name)
+
+    def download_to_buffer(self):
+        return None
+
+    def upload_files(self, blobs, container=None, metadata=None):
+        statuses = [{"blob_name": name, "succeeded": False, "error": "timed out"} for name, _ in blobs]
+        raise BlobUploadError(container, statuses)
+
+
+class FakeSplitter():
+
+    def split(self, document, mode=None, max_concurrency=None):
+        return {"metadata": {}, "chunks": ["first", "second"]}
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.delenv("PROCESSING_MANIFEST_CONTAINER", raising=False)
+    monkeypatch.delenv("PROCESSING_MANIFEST_PATH", raising=False)
+    monkeypatch.delenv("ANALYZE_CACHE_PATH", raising=False)
+    monkeypatch.delenv("ANALYZE_CACHE_CONTAINER", raising=False)
+    monkeypatch.delenv("LLM_CACHE_PATH", raising=False)
+    return BlobCreateModifyEventHandler(blob_url="https://account.blob.core.windows.net/documents/contract.pdf",
+                                        openai_api_key="key", openai_api_base="https://openai.invalid",
+                                        openai_deployment_id="deployment")
+
+
+def test_ingest_raises_when_sections_failed(handler):
+    handler.create_pipeline = lambda: FakePipeline({"uploaded": 3, "unchanged": 0, "deleted": 0, "failed": 1,
+                                                    "failed_ids": ["contract-pdf-2"]})
+
+    with pytest.raises(IndexingError) as error:
+        handler.ingest()
+
+    assert error.value.failed_ids == ["contract-pdf-2"]
+
+
+def test_ingest_returns_when_every_section_indexed(handler):
+    handler.create_pipeline = lambda: FakePipeline({"uploaded": 3, "unchanged": 0, "deleted": 0, "failed": 0,
+                                                    "failed_ids": []})
+
+    assert handler.ingest()["index_stats"]["uploaded"] == 3
+
+
+def test_split_and_blob_upload_raises_when_chunks_failed(handler):
+    handler.blob_handler = FailingUploads(handler.blob_handler)
+    handler.doc_splitter = FakeSplitter()
+
+    with pytest.raises(BlobUploadError):
+        handler.split_and_blob_upload()
@@ -0,0 +1,24 @@
+import json
+import logging
+from instrumentation import Metrics
+
+
+def test_dump_writes_to_path(tmp_path):
+    metrics = Metrics()
+    metrics.record("stage.chunk", 0.25)
+
+    metrics.dump(str(tmp_path / "metrics.json"))
+
+    histograms = json.loads((tmp_path / "metrics.json").read_text())["histograms"]
+    assert histograms["stage.chunk"]["count"] == 1
+
+
+def test_dump_without_path_logs_the_snapshot(caplog):
+    metrics = Metrics()
+    metrics.record("stage.chunk", 0.25)
+
+    with caplog.at_level(logging.INFO, logger="file"):
+        metrics.dump()
+
+    logged = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Instrumentation: ")]
+    assert json.loads(logged[0][len("Instrumentation: "):])["histograms"]["stage.chunk"]["count"] == 1
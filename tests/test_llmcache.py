@@ -0,0 +1,91 @@
+import json
+import itertools
+from types import SimpleNamespace
+import pytest
+import llmcache
+from llmcache import LLMResponseCache
+
+MESSAGES = [{"role": "system", "content": "Fill in the metadata"}, {"role": "user", "content": "Supply agreement"}]
+PARAMETERS = {"temperature": 0.2, "max_tokens": 800, "top_p": 0.95}
+
+
+def _response(content):
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Makes every access one second later than the previous, so the least recently used entry is certain.
+    """
+    ticks = itertools.count(1)
+    monkeypatch.setattr(llmcache, "time", SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def test_key_does_not_depend_on_dict_order():
+    reordered_messages = [{"content": message["content"], "role": message["role"]} for message in MESSAGES]
+    reordered_parameters = dict(reversed(list(PARAMETERS.items())))
+
+    assert LLMResponseCache.make_key("deployment", MESSAGES, PARAMETERS) == \
+        LLMResponseCache.make_key("deployment", reordered_messages, reordered_parameters)
+
+
+def test_key_changes_with_the_request():
+    key = LLMResponseCache.make_key("deployment", MESSAGES, PARAMETERS)
+
+    assert key != LLMResponseCache.make_key("deployment", list(reversed(MESSAGES)), PARAMETERS)
+    assert key != LLMResponseCache.make_key("deployment", MESSAGES, dict(PARAMETERS, temperature=0.0))
+    assert key != LLMResponseCache.make_key("other-deployment", MESSAGES, PARAMETERS)
+
+
+def test_hit_and_miss_stats(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "llm.sqlite"))
+    key = cache.make_key("deployment", MESSAGES, PARAMETERS)
+
+    assert cache.get(key) is None
+    cache.put(key, _response("{}"))
+    assert cache.get(key) == _response("{}")
+    assert cache.get(key) == _response("{}")
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+    assert stats["bytes"] == len(json.dumps(_response("{}")))
+
+
+def test_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / "llm.sqlite")
+    cache = LLMResponseCache(path)
+    cache.put("key", _response("{}"))
+    cache.close()
+
+    assert LLMResponseCache(path).get("key") == _response("{}")
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    size = len(json.dumps(_response("x")))
+    cache = LLMResponseCache(str(tmp_path / "llm.sqlite"), max_bytes=3 * size)
+    for key in ("a", "b", "c"):
+        cache.put(key, _response("x"))
+    # Reading a makes b the least recently used
+    cache.get("a")
+
+    cache.put("d", _response("x"))
+
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in ("a", "c", "d"))
+    stats = cache.stats()
+    assert (stats["evictions"], stats["entries"]) == (1, 3)
+    assert stats["bytes"] <= 3 * size
+
+
+def test_large_response_evicts_everything_older(tmp_path, clock):
+    size = len(json.dumps(_response("x")))
+    cache = LLMResponseCache(str(tmp_path / "llm.sqlite"), max_bytes=3 * size)
+    for key in ("a", "b", "c"):
+        cache.put(key, _response("x"))
+
+    cache.put("large", _response("x" * (2 * size)))
+
+    assert cache.stats()["entries"] == 1
+    assert cache.get("large") is not None
@@ -0,0 +1,72 @@
+import os
+import hashlib
+from types import SimpleNamespace
+from clientregistry import get_blob_service_client
+from processingmanifest import ProcessingManifest, LocalManifestStore, BlobManifestStore
+
+BLOB_URL = "https://account.blob.core.windows.net/documents/contract.pdf"
+
+
+def _properties(data: bytes = None, etag: str = "0x1"):
+    content_md5 = hashlib.md5(data).digest() if data is not None else None
+    return SimpleNamespace(content_settings=SimpleNamespace(content_md5=content_md5), etag=etag)
+
+
+def _manifest(tmp_path, pipeline_version="1"):
+    return ProcessingManifest(LocalManifestStore(str(tmp_path / "manifest.json")), pipeline_version)
+
+
+def test_unrecorded_blob_is_changed(tmp_path):
+    assert not _manifest(tmp_path).is_unchanged(BLOB_URL, _properties(b"contract"))
+
+
+def test_same_content_is_unchanged_despite_new_etag(tmp_path):
+    manifest = _manifest(tmp_path)
+    manifest.record(BLOB_URL, _properties(b"contract", etag="0x1"))
+
+    # Overwriting a blob with the same bytes gives it a new ETag
+    assert manifest.is_unchanged(BLOB_URL, _properties(b"contract", etag="0x2"))
+
+
+def test_changed_content_is_changed(tmp_path):
+    manifest = _manifest(tmp_path)
+    manifest.record(BLOB_URL, _properties(b"contract", etag="0x1"))
+
+    assert not manifest.is_unchanged(BLOB_URL, _properties(b"amended contract", etag="0x1"))
+    assert not manifest.is_unchanged(BLOB_URL, _properties(b"amended contract", etag="0x2"))
+
+
+def test_etag_is_compared_without_content_md5(tmp_path):
+    manifest = _manifest(tmp_path)
+    manifest.record(BLOB_URL, _properties(etag="0x1"))
+
+    assert manifest.is_unchanged(BLOB_URL, _properties(etag="0x1"))
+    assert not manifest.is_unchanged(BLOB_URL, _properties(etag="0x2"))
+    # Also when only one side has an MD5
+    assert manifest.is_unchanged(BLOB_URL, _properties(b"contract", etag="0x1"))
+    assert not manifest.is_unchanged(BLOB_URL, _properties(b"contract", etag="0x2"))
+
+
+def test_new_pipeline_version_reprocesses(tmp_path):
+    _manifest(tmp_path).record(BLOB_URL, _properties(b"contract"))
+
+    assert not _manifest(tmp_path, pipeline_version="2").is_unchanged(BLOB_URL, _properties(b"contract"))
+
+
+def test_local_store_survives_reloading(tmp_path):
+    _manifest(tmp_path).record(BLOB_URL, _properties(b"contract"))
+
+    assert _manifest(tmp_path).is_unchanged(BLOB_URL, _properties(b"contract", etag="0x2"))
+    assert not os.path.exists(tmp_path / "manifest.json.tmp")
+
+
+def test_blob_store_round_trip(fake_services):
+    blob_service_client = get_blob_service_client(account_url=fake_services.account_url,
+                                                  credential=os.getenv("AZURE_STORAGEACCOUNT_SAS"))
+    manifest = ProcessingManifest(BlobManifestStore(blob_service_client.get_container_client("manifest")))
+
+    assert not manifest.is_unchanged(BLOB_URL, _properties(b"contract"))
+    manifest.record(BLOB_URL, _properties(b"contract", etag="0x1"))
+
+    assert manifest.is_unchanged(BLOB_URL, _properties(b"contract", etag="0x2"))
+    assert not manifest.is_unchanged(BLOB_URL, _properties(b"amended contract", etag="0x3"))